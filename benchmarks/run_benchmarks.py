@@ -0,0 +1,323 @@
+"""Benchmark the prompt creators, prompt extraction, generation and evaluators.
+
+Synthetic HellaSwag-shaped rows and CNN/DM-shaped stories are generated in a
+work directory, then every stage runs in its own subprocess so that its wall
+time and peak memory are measured in isolation:
+
+    python benchmarks/run_benchmarks.py --rows 100000 --personas 9 --output bench.json
+    python benchmarks/run_benchmarks.py --rows 100000 --personas 9 --compare bench.json
+
+Generation goes through the fake backend, so no GPU is needed; its
+`--fake-*-latency` options add simulated model time. Results are written as
+JSON (with the current git commit) for comparison across commits.
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HELLASWAG_DIR = os.path.join(REPO, "evaluation_scripts", "hellaswag")
+CNN_DM_DIR = os.path.join(REPO, "evaluation_scripts", "cnn_dm")
+
+STAGES = [
+    "hellaswag_prompts",
+    "cnn_dm_prompts",
+    "extract",
+    "generate",
+    "hellaswag_evaluation",
+    "cnn_dm_evaluation",
+]
+
+
+def make_words(rng: random.Random, vocabulary: list[str], n_words: int) -> str:
+    return " ".join(rng.choices(vocabulary, k=n_words))
+
+
+def synthesize(workdir: str, config: dict):
+    """Write `config["rows"]` HellaSwag rows and CNN/DM stories under `workdir`."""
+    rng = random.Random(config["seed"])
+    vocabulary = ["".join(rng.choices("abcdefghijklmnopqrstuvwxyz", k=rng.randint(2, 9))) for _ in range(5000)]
+
+    os.makedirs(os.path.join(workdir, "hellaswag"), exist_ok=True)
+    with open(os.path.join(workdir, "hellaswag", "hellaswag_synthetic.jsonl"), "w") as file:
+        for ind in range(config["rows"]):
+            row = {
+                "ind": ind,
+                "activity_label": make_words(rng, vocabulary, 2),
+                "ctx": make_words(rng, vocabulary, config["context_words"]),
+                "endings": [make_words(rng, vocabulary, config["ending_words"]) for _ in range(4)],
+                "label": rng.randrange(4),
+                "split_type": "indomain",
+            }
+            file.write(json.dumps(row) + "\n")
+
+    # Stories are spread over subfolders, like the CNN and Daily Mail splits
+    stories = os.path.join(workdir, "stories")
+    for i in range(config["rows"]):
+        folder = os.path.join(stories, f"{i // 10000:03d}")
+        if i % 10000 == 0:
+            os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f"{i:08x}.txt"), "w") as file:
+            for _ in range(max(config["article_words"] // 25, 1)):
+                file.write(make_words(rng, vocabulary, 25) + "\n\n")
+            for _ in range(3):
+                file.write("@highlight\n\n" + make_words(rng, vocabulary, 12) + "\n\n")
+
+
+def personas(config: dict) -> list:
+    return [(None, None)] + [(f"Persona {i}", None) for i in range(1, config["personas"])]
+
+
+def prompt_folders(workdir: str) -> list[str]:
+    return [os.path.join(workdir, "prompts", "hellaswag_v1"), os.path.join(workdir, "prompts", "cnn_dm_v0")]
+
+
+def created_prompt_folders(workdir: str) -> list[str]:
+    # Stages after the creators only use the datasets whose prompts were created
+    return [folder for folder in prompt_folders(workdir) if os.path.isdir(folder)]
+
+
+def count_rows(folder: str) -> int:
+    """Rows of the JSONL files of `folder` (of any compression), without compact files' header lines."""
+    from persona_impact.jsonl_io import jsonl_files, open_jsonl
+    from persona_impact.prompt_store import parse_header
+
+    n_rows = 0
+    for path in jsonl_files(folder):
+        with open_jsonl(path, "rb") as file:
+            for n, line in enumerate(file):
+                if line.strip() and not (n == 0 and parse_header(json.loads(line)) is not None):
+                    n_rows += 1
+    return n_rows
+
+
+def stage_hellaswag_prompts(workdir: str, config: dict) -> dict:
+    sys.path.insert(0, HELLASWAG_DIR)
+    import hellaswag_prompt_creator
+
+    os.chdir(workdir)
+    os.makedirs(os.path.join("prompts", "hellaswag_v1"), exist_ok=True)
+    hellaswag_prompt_creator.main(
+        [os.path.join("hellaswag", "hellaswag_synthetic.jsonl")],
+        personas(config),
+        compact=config["compact"],
+        workers=config["workers"],
+    )
+    return {"rows": count_rows(prompt_folders(workdir)[0])}
+
+
+def stage_cnn_dm_prompts(workdir: str, config: dict) -> dict:
+    sys.path.insert(0, CNN_DM_DIR)
+    import cnn_dm_prompt_creator
+
+    # The creator writes to ../../prompts relative to where it runs
+    run_dir = os.path.join(workdir, "run", "cnn_dm")
+    os.makedirs(run_dir, exist_ok=True)
+    os.makedirs(prompt_folders(workdir)[1], exist_ok=True)
+    os.chdir(run_dir)
+    cnn_dm_prompt_creator.main(
+        os.path.join(workdir, "stories"),
+        personas(config),
+        compact=config["compact"],
+        workers=config["workers"],
+    )
+    return {"rows": count_rows(prompt_folders(workdir)[1])}
+
+
+def stage_extract(workdir: str, config: dict) -> dict:
+    from persona_impact.pipeline import filenames_in_a_folder
+    from persona_impact.reader import IndexedJsonl
+
+    n_rows = n_chars = 0
+    for folder in created_prompt_folders(workdir):
+        for file in filenames_in_a_folder(folder):
+            with IndexedJsonl(file) as reader:
+                for entry in reader:
+                    n_chars += len(reader.prompt(entry))
+                    n_rows += 1
+    return {"rows": n_rows, "prompt_chars": n_chars}
+
+
+def stage_generate(workdir: str, config: dict) -> dict:
+    from persona_impact.backends import FakeBackend
+    from persona_impact.pipeline import process_folder
+    from persona_impact.profiles import DecodeStats, ProfileSet
+
+    backend = FakeBackend(
+        seconds_per_prompt_token=config["fake_prompt_latency"],
+        seconds_per_output_token=config["fake_output_latency"],
+        seed=config["seed"],
+    )
+    profiles = ProfileSet()
+    decode_stats = DecodeStats()
+    outputs = os.path.join(workdir, "outputs")
+    shutil.rmtree(outputs, ignore_errors=True)
+    os.makedirs(outputs)
+
+    start = time.perf_counter()
+    for folder in created_prompt_folders(workdir):
+        sampling = profiles[profiles.profile_name(folder)]
+        process_folder(backend, sampling, folder, decode_stats=decode_stats, output_root=outputs)
+    total_seconds = time.perf_counter() - start
+    return {
+        "rows": decode_stats.n_prompts,
+        "output_tokens": decode_stats.output_tokens,
+        "model_seconds": round(backend.generate_seconds, 4),
+        "host_seconds": round(total_seconds - backend.generate_seconds, 4),
+    }
+
+
+def stage_hellaswag_evaluation(workdir: str, config: dict) -> dict:
+    sys.path.insert(0, HELLASWAG_DIR)
+    import hellaswag_evaluation
+
+    scores = os.path.join(workdir, "scores")
+    shutil.rmtree(scores, ignore_errors=True)
+    hellaswag_evaluation.main(os.path.join(workdir, "outputs", "hellaswag_v1-output"), scores)
+    return {"rows": count_rows(os.path.join(workdir, "outputs", "hellaswag_v1-output"))}
+
+
+def stage_cnn_dm_evaluation(workdir: str, config: dict) -> dict:
+    sys.path.insert(0, CNN_DM_DIR)
+    import evaluation
+
+    scores = os.path.join(workdir, "scores_cnn_dm")
+    shutil.rmtree(scores, ignore_errors=True)
+    os.makedirs(scores)
+    evaluation.main(os.path.join(workdir, "outputs", "cnn_dm_v0-output"), scores, workers=config["workers"])
+    return {"rows": count_rows(os.path.join(workdir, "outputs", "cnn_dm_v0-output"))}
+
+
+def run_stage(name: str, workdir: str, config: dict):
+    """Run one stage in this process and print its measurements as JSON."""
+    start = time.perf_counter()
+    result = globals()[f"stage_{name}"](workdir, config)
+    seconds = time.perf_counter() - start
+    # ru_maxrss is in KiB on Linux; pools report through RUSAGE_CHILDREN
+    peak_kib = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    result.update({"stage": name, "seconds": round(seconds, 4), "peak_rss_mb": round(peak_kib / 1024, 1)})
+    if result.get("rows"):
+        result["rows_per_second"] = round(result["rows"] / seconds, 1)
+    print("BENCHMARK " + json.dumps(result))
+
+
+def spawn_stage(name: str, workdir: str, config: dict) -> dict:
+    process = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--stage", name, "--workdir", workdir, "--config", json.dumps(config)],
+        capture_output=True,
+        text=True,
+    )
+    for line in process.stdout.splitlines():
+        if line.startswith("BENCHMARK "):
+            return json.loads(line[len("BENCHMARK ") :])
+    error = (process.stderr.strip().splitlines() or ["no output"])[-1]
+    return {"stage": name, "error": error}
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list[dict], baseline_file: str):
+    with open(baseline_file, "r") as file:
+        baseline = {stage["stage"]: stage for stage in json.load(file)["stages"]}
+    print(f"\n{'stage':24} {'seconds':>10} {'baseline':>10} {'ratio':>7}")
+    for stage in results:
+        old = baseline.get(stage["stage"], {})
+        if "seconds" in stage and "seconds" in old:
+            ratio = stage["seconds"] / old["seconds"] if old["seconds"] else float("inf")
+            print(f"{stage['stage']:24} {stage['seconds']:10.3f} {old['seconds']:10.3f} {ratio:7.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the persona-impact pipeline on synthetic data.")
+    parser.add_argument("--rows", type=int, default=1000, help="HellaSwag rows and CNN/DM stories to synthesize")
+    parser.add_argument("--personas", type=int, default=3, help="Persona files per dataset (including no persona)")
+    parser.add_argument("--context-words", type=int, default=40, help="Words per HellaSwag context")
+    parser.add_argument("--ending-words", type=int, default=12, help="Words per HellaSwag ending")
+    parser.add_argument("--article-words", type=int, default=600, help="Words per CNN/DM article")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes for creators and evaluators")
+    parser.add_argument("--no-compact", dest="compact", action="store_false", help="Write fully rendered prompts")
+    parser.add_argument("--fake-prompt-latency", type=float, default=0.0)
+    parser.add_argument("--fake-output-latency", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="Stages to run, in order")
+    parser.add_argument("--workdir", default=None, help="Work directory (default: a temporary directory)")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary work directory")
+    parser.add_argument("--output", default=None, help="Write the results to this JSON file")
+    parser.add_argument("--compare", default=None, help="Compare stage times with an earlier results file")
+    parser.add_argument("--stage", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--config", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage is not None:
+        sys.path.insert(0, REPO)
+        run_stage(args.stage, args.workdir, json.loads(args.config))
+        return
+
+    config = {
+        key: getattr(args, key)
+        for key in (
+            "rows",
+            "personas",
+            "context_words",
+            "ending_words",
+            "article_words",
+            "workers",
+            "compact",
+            "fake_prompt_latency",
+            "fake_output_latency",
+            "seed",
+        )
+    }
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="persona-bench-"))
+    os.makedirs(workdir, exist_ok=True)
+
+    start = time.perf_counter()
+    synthesize(workdir, config)
+    print(f"Synthesized {args.rows} rows per dataset in {time.perf_counter() - start:.2f}s ({workdir})")
+
+    results = []
+    for name in args.stages:
+        result = spawn_stage(name, workdir, config)
+        results.append(result)
+        if "error" in result:
+            print(f"{name:24} failed: {result['error']}")
+        else:
+            print(
+                f"{name:24} {result['seconds']:10.3f}s {result['peak_rss_mb']:9.1f} MB "
+                f"{result.get('rows_per_second', 0):12.1f} rows/s"
+            )
+
+    report = {
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": config,
+        "stages": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+    if args.workdir is None and not args.keep:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,11 @@
 import os
 import utils
 import ujson
-import glob
+from concurrent.futures import ProcessPoolExecutor
 
-from langchain.prompts import PromptTemplate
+from corpus import Corpus, ingest
+from persona_impact.jsonl_io import open_jsonl, with_compression
+from persona_impact.prompt_store import compile_template, make_header
 
 
 TEMPLATE = """{persona}
@@ -17,7 +19,19 @@ Article:
 Summary:
 """
 
-prompt_template = PromptTemplate.from_template(TEMPLATE)
+prompt_template = compile_template(TEMPLATE)
+
+PERSONAS = [
+    (None, None),
+    ('Virtual Assistant', 'tasked with providing concise summaries of articles'),
+    ('Human', 'tasked with summarizing articles'),
+    ('Professor', 'specializing in literature and critical analysis. You have a keen eye for detail and a deep understanding of various literary forms and techniques. You excel in synthesizing complex information into concise summaries'),
+    ('Teacher', 'tasked with guiding students in understanding complex topics and improving their comprehension skills'),
+    ('Student', 'tasked with summarizing the article provided below'),
+    ('Contestant', 'tasked with summarizing the following article accurately and succinctly'),
+    ('Writer', 'tasked with summarizing articles accurately and concisely'),
+    ('Journalist', 'specializing in technology and innovation. You have a keen eye for detail and a knack for distilling complex information into concise and engaging summaries')
+]
 
 
 def get_persona(persona):
@@ -38,68 +52,98 @@ def get_example_template(examples):
     return out
 
 
-def generate_instruction(filename, persona, examples):
+def generate_compact_row(filename, article, abstract):
+
+    return {
+        'filename': utils.get_file_name(filename),
+        'article': ' '.join(article.split(' ')[:250]),
+        'abstract': ' '.join(abstract.split(' ')[:100]),
+        # The prompt renders the whole article
+        'article_text': article
+    }
+
+
+def generate_instruction(filename, article, abstract, persona, examples):
 
-    article, abstract = utils.read_txt(filename)
     output_line = {
         'filename': utils.get_file_name(filename),
         'article': ' '.join(article.split(' ')[:250]),
         'abstract': ' '.join(abstract.split(' ')[:100])
     }
 
-    llm_instruction = prompt_template.invoke({
-        'persona': get_persona(persona),
-        'examples': examples,
-        'article': article,
-    })
-
-    output_line['llm_instruction'] = llm_instruction.to_string()
+    output_line['llm_instruction'] = prompt_template.render(
+        persona=get_persona(persona),
+        examples=examples,
+        article=article
+    )
 
     return output_line
 
 
-def main(folderpath, persona_list, ten_shot=False):
+def write_prompt_file(name, corpus_path, persona, example_template, compact):
+
+    corpus = Corpus(corpus_path)
+
+    with open_jsonl(name, 'w') as writer:
+        # Compact files store the shared template blocks once and render rows at inference time
+        if compact:
+            header = make_header('cnn_dm', TEMPLATE, get_persona(persona), example_template)
+            writer.write(f'{ujson.dumps(header)}\n')
+
+        for (filename, article, abstract) in corpus:
+            if compact:
+                output_line = generate_compact_row(filename, article, abstract)
+            else:
+                output_line = generate_instruction(filename, article, abstract, persona, example_template)
+            json_line = ujson.dumps(output_line)
+            writer.write(f'{json_line}\n')
+
+
+def main(folderpath, persona_list, ten_shot=False, compact=True, workers=1, compression=None,
+         output_folder=None, examples_folder=utils.TRAIN_FOLDER):
 
     if ten_shot:
-        examples = utils.get_examples(num_examples=1)
+        examples = utils.get_examples(num_examples=1, folderpath=examples_folder)
         example_template = get_example_template(examples)
         version = 1
     else:
         example_template = ""
         version = 0
 
+    # Parse the stories once (or reuse the parsed store) instead of once per persona
+    corpus_path = ingest(folderpath).store_path
+
+    jobs = []
     for (persona, description) in persona_list:
 
         if description and description != "":
             version = 2
             persona += ', ' + description
 
+        # Default: one folder per prompt version
+        folder = output_folder or f'../../prompts/cnn_dm_v{version}'
+        os.makedirs(folder, exist_ok=True)
         if persona:
-            name = f'../../prompts/cnn_dm_v{version}/{persona}_v{version}.jsonl'
+            name = os.path.join(folder, f'{persona}_v{version}.jsonl')
         else:
-            name = f'../../prompts/cnn_dm_v{version}/nopersona_v{version}.jsonl'
+            name = os.path.join(folder, f'nopersona_v{version}.jsonl')
 
-        with open(name, 'w') as writer:
-            for filename in glob.glob(os.path.join(folderpath, '**/*.txt'), recursive=True):
-                output_line = generate_instruction(filename, persona, example_template)
-                json_line = ujson.dumps(output_line)
-                writer.write(f'{json_line}\n')
+        # compression='gz' or 'zst' writes .jsonl.gz or .jsonl.zst files
+        name = with_compression(name, compression)
+        jobs.append((name, corpus_path, persona, example_template, compact))
+
+    # Each persona file is independent, so they can be written by separate processes
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for future in [pool.submit(write_prompt_file, *job) for job in jobs]:
+                future.result()
+    else:
+        for job in jobs:
+            write_prompt_file(*job)
 
 
 if __name__ == '__main__':
 
     folder = '/Users/giovanni/Desktop/r3s_cnn_dm/test'
 
-    personas = [
-        (None, None),
-        ('Virtual Assistant', 'tasked with providing concise summaries of articles'),
-        ('Human', 'tasked with summarizing articles'),
-        ('Professor', 'specializing in literature and critical analysis. You have a keen eye for detail and a deep understanding of various literary forms and techniques. You excel in synthesizing complex information into concise summaries'),
-        ('Teacher', 'tasked with guiding students in understanding complex topics and improving their comprehension skills'),
-        ('Student', 'tasked with summarizing the article provided below'),
-        ('Contestant', 'tasked with summarizing the following article accurately and succinctly'),
-        ('Writer', 'tasked with summarizing articles accurately and concisely'),
-        ('Journalist', 'specializing in technology and innovation. You have a keen eye for detail and a knack for distilling complex information into concise and engaging summaries')
-    ]
-
-    main(folder, personas, False)
\ No newline at end of file
+    main(folder, PERSONAS, False, workers=len(PERSONAS))
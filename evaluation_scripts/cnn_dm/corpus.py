@@ -0,0 +1,140 @@
+"""Parsed CNN/DM corpus store.
+
+`ingest(folder)` parses every story under `folder` once and writes a single
+binary store: the UTF-8 article and abstract of every file back to back,
+followed by a JSON manifest (relative path, size, mtime and offsets of each
+file) and an 8-byte pointer to it. Later ingests only stat the tree and reuse
+the stored text of files whose size and mtime are unchanged, so prompt creation
+and example selection never reopen the hundreds of thousands of small files.
+"""
+
+import mmap
+import os
+import struct
+
+import ujson
+
+import utils
+
+MAGIC = b'CNNDMCORPUS1\n'
+TRAILER = struct.Struct('<Q')
+
+
+def default_store_path(folderpath):
+
+    return folderpath.rstrip('/') + '.corpus'
+
+
+def scan(folderpath):
+    """Return sorted (relative path, size, mtime_ns) of every .txt under folderpath."""
+
+    files = []
+    stack = [folderpath]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    stack.append(entry.path)
+                elif entry.name.endswith('.txt'):
+                    stat = entry.stat()
+                    files.append((os.path.relpath(entry.path, folderpath), stat.st_size, stat.st_mtime_ns))
+
+    return sorted(files)
+
+
+class Corpus:
+
+    def __init__(self, store_path):
+
+        self.store_path = store_path
+        self._file = open(store_path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{store_path} is not a corpus store')
+
+        (index_offset,) = TRAILER.unpack(self._map[-TRAILER.size:])
+        index = ujson.loads(self._map[index_offset:-TRAILER.size])
+        self.root = index['root']
+        # [relative path, size, mtime_ns, offset, article length, abstract length]
+        self.entries = index['entries']
+
+    def __len__(self):
+        return len(self.entries)
+
+    def path(self, i):
+        return os.path.join(self.root, self.entries[i][0])
+
+    def read_bytes(self, i):
+
+        _, _, _, offset, article_len, abstract_len = self.entries[i]
+        middle = offset + article_len
+        return self._map[offset:middle], self._map[middle:middle + abstract_len]
+
+    def read(self, i):
+
+        article, abstract = self.read_bytes(i)
+        return article.decode('utf-8'), abstract.decode('utf-8')
+
+    def __iter__(self):
+
+        for i in range(len(self.entries)):
+            yield (self.path(i), *self.read(i))
+
+    def close(self):
+
+        self._map.close()
+        self._file.close()
+
+
+def ingest(folderpath, store_path=None, verify=True):
+    """Return the parsed corpus of folderpath, (re)building its store if needed.
+
+    With verify=False an existing store is trusted without stat'ing the tree.
+    """
+
+    store_path = store_path or default_store_path(folderpath)
+    old = Corpus(store_path) if os.path.exists(store_path) else None
+    if old is not None and old.root != folderpath:
+        old.close()
+        old = None
+    if old is not None and not verify:
+        return old
+
+    files = scan(folderpath)
+
+    cached = {}
+    if old is not None:
+        if [tuple(entry[:3]) for entry in old.entries] == files:
+            return old
+        cached = {tuple(entry[:3]): i for i, entry in enumerate(old.entries)}
+
+    tmp_path = store_path + '.tmp'
+    entries = []
+    n_parsed = 0
+    with open(tmp_path, 'wb') as writer:
+        writer.write(MAGIC)
+        offset = len(MAGIC)
+
+        for relpath, size, mtime_ns in files:
+            if (relpath, size, mtime_ns) in cached:
+                article, abstract = old.read_bytes(cached[(relpath, size, mtime_ns)])
+            else:
+                article, abstract = utils.read_txt(os.path.join(folderpath, relpath))
+                article, abstract = article.encode('utf-8'), abstract.encode('utf-8')
+                n_parsed += 1
+
+            writer.write(article)
+            writer.write(abstract)
+            entries.append([relpath, size, mtime_ns, offset, len(article), len(abstract)])
+            offset += len(article) + len(abstract)
+
+        writer.write(ujson.dumps({'root': folderpath, 'entries': entries}).encode('utf-8'))
+        writer.write(TRAILER.pack(offset))
+
+    if old is not None:
+        old.close()
+    os.replace(tmp_path, store_path)
+    print(f'Corpus {folderpath}: {len(files)} files, {n_parsed} parsed, stored in {store_path}')
+
+    return Corpus(store_path)
@@ -1,8 +1,15 @@
-import glob
 import os
 import ujson
 import jsbeautifier
-from utils import read_json, compute_rouge, get_file_name
+import rouge_engine
+from pathlib import Path
+from utils import get_file_name, read_json
+
+from persona_impact.jsonl_io import jsonl_files
+from persona_impact.score_cache import ScoreCache
+
+# Bump whenever the ROUGE computation changes, to invalidate cached scores
+METRIC_VERSION = 'rouge-1'
 
 
 def get_name_and_version(filename):
@@ -12,42 +19,102 @@ def get_name_and_version(filename):
 
 def compute_scores(filename):
 
-    n_elems = 0.
-    rouge1 = 0.
-    rouge2 = 0.
-    rougeL = 0.
+    return rouge_engine.mean_scores(rouge_engine.score_file(filename))
+
 
-    for data in read_json(filename):
-        target = data['abstract'].strip()
-        reference = data['llm_response'].strip()
-        r1, r2, rl = compute_rouge(target, reference)
-        rouge1 += r1
-        rouge2 += r2
-        rougeL += rl
-        n_elems += 1
+def main(main_folder, output_folder, workers=None):
 
-    return (rouge1 / n_elems), (rouge2 / n_elems), (rougeL / n_elems)
+    # Only new or modified output files are rescored
+    cache = ScoreCache(os.path.join(output_folder, 'cnn_dm_cache.json'), METRIC_VERSION)
 
+    filenames = jsonl_files(main_folder, recursive=True)
+    means = {filename: cache.get(filename) for filename in filenames}
+    stale = [filename for filename in filenames if means[filename] is None]
 
-def main(main_folder, output_folder):
+    # Persona files are scored in parallel; references are tokenized once per worker
+    for filename, scores in zip(stale, rouge_engine.score_files(stale, workers)):
+        means[filename] = rouge_engine.mean_scores(scores)
+        cache.put(filename, means[filename])
+
+    print(cache.summary())
+    cache.save()
 
     outputs = {}
-    for filename in glob.glob(os.path.join(main_folder, '**/*.jsonl'), recursive=True):
+    for filename in filenames:
         persona, version = get_name_and_version(filename)
         outputs.setdefault(persona, {})
         outputs[persona].setdefault(version, {})
 
-        r1, r2, rl = compute_scores(filename)
+        r1, r2, rl = means[filename]
         outputs[persona][version]['r1'] = r1
         outputs[persona][version]['r2'] = r2
         outputs[persona][version]['rl'] = rl
 
+    write_scores(outputs, output_folder)
+
+
+def write_scores(outputs, output_folder):
+
     opts = jsbeautifier.default_options()
     opts.indent_size = 2
     with open(os.path.join(output_folder, 'cnn_dm.json'), 'w') as writer:
         writer.write(jsbeautifier.beautify(ujson.dumps(outputs), opts))
 
 
+def export(main_folder, store_path, model=None, workers=None):
+    """Add the per-row ROUGE scores of every output file under main_folder to the results store at store_path.
+
+    The model defaults to the name of the folder holding main_folder (e.g. results/<model>/cnn_dm_v1-output).
+    """
+
+    # numpy (the analysis extra) is only needed for the results store
+    import numpy as np
+    from persona_impact.results_store import ResultsStore
+
+    model = model or Path(os.path.abspath(main_folder)).parent.name
+    folder = Path(os.path.abspath(main_folder)).name
+    store = ResultsStore(store_path)
+
+    stale = {}
+    for filename in jsonl_files(main_folder, recursive=True):
+        persona, version = get_name_and_version(filename)
+        meta = {'model': model, 'dataset': 'cnn_dm', 'folder': folder, 'persona': persona, 'version': version}
+        if not store.is_current(filename, METRIC_VERSION, **meta):
+            stale[filename] = meta
+
+    for filename, scores in zip(stale, rouge_engine.score_files(list(stale), workers)):
+        rows = list(read_json(filename))
+        scores = np.array(scores, dtype=np.float64).reshape(len(rows), 3)
+        store.write_segment(
+            filename,
+            stale[filename],
+            [data.get('filename', n) for n, data in enumerate(rows)],
+            [data['llm_response'] for data in rows],
+            {'r1': scores[:, 0], 'r2': scores[:, 1], 'rl': scores[:, 2]},
+            METRIC_VERSION,
+        )
+
+    store.save()
+    print(f'{len(stale)} files exported to {store_path}')
+
+
+def main_from_store(store_path, output_folder, model, folder=None):
+    """Like main, reading the ROUGE columns of an exported model from the results store."""
+
+    from persona_impact.results_store import ResultsStore
+
+    store = ResultsStore(store_path)
+    outputs = {}
+    for metric in ('r1', 'r2', 'rl'):
+        # Segments scored by an older METRIC_VERSION are left out until exported again
+        means = store.means(metric, model=model, folder=folder, metric_version=METRIC_VERSION)
+        for (_, _, _, persona, version), (_, mean) in means.items():
+            outputs.setdefault(persona, {}).setdefault(version, {})[metric] = mean
+
+    if not os.path.exists(output_folder): os.makedirs(output_folder)
+    write_scores(outputs, output_folder)
+
+
 if __name__ == '__main__':
 
     main('/Users/giovanni/Downloads/Persona/results/gemma/cnn_dm_v2-output', '/Users/giovanni/Downloads/Persona/results/gemma/scores')
@@ -0,0 +1,151 @@
+"""Batch ROUGE-1/2/L scoring that matches `rouge_score` numerically.
+
+References are identical across persona files, so each one is tokenized and
+stemmed once per process and cached (keyed by its `filename`) together with its
+n-gram counts and the position bitmasks used for a bit-parallel LCS. Predictions
+are tokenized with the same rules as `rouge_score`'s default tokenizer, with
+stems memoized per word. `score_files` spreads persona files over a process
+pool; each worker keeps its own reference cache across the files it scores.
+"""
+
+import functools
+import os
+import re
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import read_json
+
+# Same tokenization rules as rouge_score.tokenize
+NON_ALPHANUM_RE = re.compile(r'[^a-z0-9]+')
+SPACES_RE = re.compile(r'\s+')
+VALID_TOKEN_RE = re.compile(r'^[a-z0-9]+$')
+
+
+@functools.lru_cache(maxsize=None)
+def get_stemmer():
+
+    # nltk takes over a second to import, so it is only loaded once something is scored
+    from nltk.stem import porter
+    return porter.PorterStemmer()
+
+
+@functools.lru_cache(maxsize=1 << 20)
+def stem(word):
+
+    # rouge_score only stems words longer than 3 characters
+    return get_stemmer().stem(word) if len(word) > 3 else word
+
+
+def tokenize(text):
+
+    text = NON_ALPHANUM_RE.sub(' ', text.lower())
+    return [token for token in map(stem, SPACES_RE.split(text)) if VALID_TOKEN_RE.match(token)]
+
+
+def fmeasure(precision, recall):
+
+    if precision + recall > 0:
+        return 2 * precision * recall / (precision + recall)
+    return 0.0
+
+
+class Reference:
+
+    def __init__(self, text):
+
+        self.text = text
+        self.tokens = tokenize(text)
+        self.unigrams = Counter(self.tokens)
+        self.bigrams = Counter(zip(self.tokens, self.tokens[1:]))
+        # Bitmask of the positions of every token, for the bit-parallel LCS
+        self.positions = {}
+        for i, token in enumerate(self.tokens):
+            self.positions[token] = self.positions.get(token, 0) | (1 << i)
+
+
+def ngram_fmeasure(target_ngrams, prediction_ngrams):
+
+    intersection = sum(min(count, prediction_ngrams[ngram]) for ngram, count in target_ngrams.items())
+    precision = intersection / max(sum(prediction_ngrams.values()), 1)
+    recall = intersection / max(sum(target_ngrams.values()), 1)
+    return fmeasure(precision, recall)
+
+
+def lcs_length(reference, prediction_tokens):
+
+    # Bit-parallel LCS (Crochemore et al.): zero bits of `row` count the LCS
+    n = len(reference.tokens)
+    mask = (1 << n) - 1
+    row = mask
+    for token in prediction_tokens:
+        matches = row & reference.positions.get(token, 0)
+        row = ((row + matches) | (row - matches)) & mask
+    return n - row.bit_count()
+
+
+def lcs_fmeasure(reference, prediction_tokens):
+
+    if not reference.tokens or not prediction_tokens:
+        return 0.0
+
+    lcs = lcs_length(reference, prediction_tokens)
+    return fmeasure(lcs / len(prediction_tokens), lcs / len(reference.tokens))
+
+
+def score(reference, prediction):
+    """Return the ROUGE-1, ROUGE-2 and ROUGE-L f-measures of prediction against reference."""
+
+    tokens = tokenize(prediction)
+    r1 = ngram_fmeasure(reference.unigrams, Counter(tokens))
+    r2 = ngram_fmeasure(reference.bigrams, Counter(zip(tokens, tokens[1:])))
+    rl = lcs_fmeasure(reference, tokens)
+    return r1, r2, rl
+
+
+references = {}
+
+
+def get_reference(key, text):
+
+    reference = references.get(key)
+    if reference is None or reference.text != text:
+        reference = references[key] = Reference(text)
+    return reference
+
+
+def score_file(filename):
+    """Return the per-row (r1, r2, rl) of an output file, in file order."""
+
+    scores = []
+    for data in read_json(filename):
+        target = data['abstract'].strip()
+        prediction = data['llm_response'].strip()
+        scores.append(score(get_reference(data.get('filename', target), target), prediction))
+
+    return scores
+
+
+def mean_scores(scores):
+
+    # Accumulate in row order, like evaluation.compute_scores used to
+    rouge1 = rouge2 = rougeL = 0.
+    for r1, r2, rl in scores:
+        rouge1 += r1
+        rouge2 += r2
+        rougeL += rl
+    n_elems = float(len(scores))
+
+    return (rouge1 / n_elems), (rouge2 / n_elems), (rougeL / n_elems)
+
+
+def score_files(filenames, workers=None):
+    """Yield the per-row scores of every file, in the order of filenames."""
+
+    workers = workers or os.cpu_count()
+    if workers <= 1 or len(filenames) <= 1:
+        yield from map(score_file, filenames)
+        return
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(filenames))) as pool:
+        yield from pool.map(score_file, filenames)
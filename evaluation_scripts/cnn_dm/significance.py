@@ -0,0 +1,89 @@
+import argparse
+import os
+import ujson
+import jsbeautifier
+import rouge_engine
+from evaluation import METRIC_VERSION, get_name_and_version
+from utils import read_json
+
+from persona_impact.jsonl_io import jsonl_files
+from persona_impact.results_store import ResultsStore
+from persona_impact.significance import DEFAULT_RESAMPLES, compare_personas, format_report
+
+METRICS = ('r1', 'r2', 'rl')
+
+
+def load_scores(main_folder, workers=None):
+    """Return {version: {metric: {persona: {filename: score}}}} for every output file under main_folder."""
+
+    filenames = jsonl_files(main_folder, recursive=True)
+
+    scores = {}
+    for filename, rows in zip(filenames, rouge_engine.score_files(filenames, workers)):
+        persona, version = get_name_and_version(filename)
+        keys = [data.get('filename', n) for n, data in enumerate(read_json(filename))]
+        for i, metric in enumerate(METRICS):
+            by_persona = scores.setdefault(version, {}).setdefault(metric, {})
+            by_persona[persona] = {key: row[i] for key, row in zip(keys, rows)}
+
+    return scores
+
+
+def load_store_scores(store_path, model, folder):
+    """Like load_scores, reading only the ROUGE columns of an exported folder from the results store."""
+
+    store = ResultsStore(store_path)
+    scores = {}
+    for metric in METRICS:
+        for version, by_persona in store.scores(metric, model=model, folder=folder, metric_version=METRIC_VERSION).get(model, {}).items():
+            scores.setdefault(version, {})[metric] = by_persona
+
+    return scores
+
+
+def main(main_folder, output_folder, baseline='nopersona', n_resamples=DEFAULT_RESAMPLES, seed=0, workers=None, store_path=None, model=None):
+
+    if store_path is None:
+        scores = load_scores(main_folder, workers)
+    else:
+        # main_folder names an exported output folder
+        scores = load_store_scores(store_path, model, os.path.basename(main_folder.rstrip('/')))
+    # The baseline is usually only generated as v0; compare every version against it
+    baselines = [metrics for _, metrics in sorted(scores.items()) if baseline in metrics['r1']]
+
+    reports = {}
+    for version, metrics in sorted(scores.items()):
+        reports[version] = {}
+        for metric in METRICS:
+            personas = metrics[metric]
+            if baseline not in personas and baselines:
+                personas = {**personas, baseline: baselines[0][metric][baseline]}
+
+            report = compare_personas(personas, baseline, n_resamples, seed=seed)
+            print(format_report(f'{metric} {version}', report))
+            reports[version][metric] = report
+
+    opts = jsbeautifier.default_options()
+    opts.indent_size = 2
+
+    if not os.path.exists(output_folder): os.makedirs(output_folder)
+    with open(os.path.join(output_folder, 'cnn_dm_significance.json'), 'w') as writer:
+        writer.write(jsbeautifier.beautify(ujson.dumps(reports), opts))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Significance of ROUGE differences between personas')
+    parser.add_argument('main_folder', help='Folder with the CNN/DM output files (with --store, the name of an exported folder)')
+    parser.add_argument('output_folder', help='Folder for cnn_dm_significance.json')
+    parser.add_argument('--baseline', default='nopersona')
+    parser.add_argument('--resamples', type=int, default=DEFAULT_RESAMPLES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--store', default=None, help='Read the scores from this results store')
+    parser.add_argument('--model', default=None, help='Model of the results store to compare')
+    args = parser.parse_args()
+    if args.store and not args.model:
+        parser.error('--store requires --model')
+
+    main(args.main_folder, args.output_folder, args.baseline, args.resamples, args.seed, args.workers, args.store, args.model)
@@ -1,11 +1,20 @@
 import os
 import ujson
 import random
-import glob
+import functools
 from pathlib import Path
-from rouge_score import rouge_scorer
 
-scorer = rouge_scorer.RougeScorer(['rouge1', 'rouge2', 'rougeL'], use_stemmer=True)
+from persona_impact.jsonl_io import open_jsonl
+
+TRAIN_FOLDER = '/Users/giovanni/Desktop/r3s_cnn_dm/train'
+
+
+@functools.lru_cache(maxsize=None)
+def get_scorer():
+
+    # rouge_score pulls in nltk; the prompt creator only needs the readers
+    from rouge_score import rouge_scorer
+    return rouge_scorer.RougeScorer(['rouge1', 'rouge2', 'rougeL'], use_stemmer=True)
 
 
 def read_txt(filename):
@@ -33,7 +42,7 @@ def read_txt(filename):
 
 def read_json(filename):
 
-    with open(filename, 'r') as reader:
+    with open_jsonl(filename, 'r') as reader:
         for row in reader:
             data = ujson.loads(row.strip())
             yield data
@@ -43,12 +52,14 @@ def get_file_name(filename):
     return str(Path(filename).stem)
 
 
-def get_examples(num_examples=10):
+def get_examples(num_examples=10, folderpath=TRAIN_FOLDER):
+    from corpus import ingest
+
     article_abstract_pairs = []
-    list_of_files = [f for f in glob.glob(os.path.join('/Users/giovanni/Desktop/r3s_cnn_dm/train', '**/*.txt'), recursive=True)]
-    selected_files = random.choices(list_of_files, k=num_examples)
-    for filename in selected_files:
-        article, abstract = read_txt(filename)
+    corpus = ingest(folderpath)
+    selected_files = random.choices(range(len(corpus)), k=num_examples)
+    for i in selected_files:
+        article, abstract = corpus.read(i)
         article = ' '.join(article.split(' ')[:250])
         abstract = ' '.join(abstract.split(' ')[:100])
         article_abstract_pairs.append((article, abstract))
@@ -57,5 +68,5 @@ def get_examples(num_examples=10):
 
 
 def compute_rouge(target, prediction):
-    scores = scorer.score(target, prediction)
+    scores = get_scorer().score(target, prediction)
     return scores['rouge1'].fmeasure, scores['rouge2'].fmeasure, scores['rougeL'].fmeasure
@@ -1,12 +1,15 @@
 import ujson
-import glob
 import os
 import jsbeautifier
 import regex as re
 
 from pathlib import Path
-from bokeh.plotting import figure, show
-from bokeh.models import ColumnDataSource, FactorRange
+
+from persona_impact.jsonl_io import jsonl_files, open_jsonl
+from persona_impact.score_cache import ScoreCache
+
+# Bump whenever extract_label or compute_accuracy change, to invalidate cached scores
+METRIC_VERSION = 'accuracy-3'
 
 
 def get_file_name(filename):
@@ -29,31 +32,97 @@ def extract_label(text):
 
 def read_json(filename):
 
-    with open(filename, 'r') as reader:
+    with open_jsonl(filename, 'r') as reader:
         for row in reader:
             data = ujson.loads(row.strip())
             yield data
 
 
+def selected_label(data):
+    """Return (label selected by the model or None, whether it is the correct label) for one row."""
+
+    correct_label = int(data['correct_label'])
+
+    # Rows from log-likelihood scoring carry the selected label directly
+    if 'llm_label' in data:
+        label = int(data['llm_label'])
+        return label, label == correct_label
+
+    label = extract_label(data['llm_response'])
+    return label, label is not None and label == correct_label
+
+
+def example_correctness(filename):
+    """Return (ind, 1. if the row was answered correctly else 0.) for every row, in file order."""
+
+    examples = []
+    for n, data in enumerate(read_json(filename)):
+        _, correct = selected_label(data)
+        examples.append((data.get('ind', n), 1. if correct else 0.))
+
+    return examples
+
+
 def compute_accuracy(filename):
 
     n_elems = 0.
     accuracy = 0.
 
-    for data in read_json(filename):
-        correct_label = int(data['correct_label'])
-        selected_label = extract_label(data['llm_response'])
+    for _, correct in example_correctness(filename):
         n_elems += 1
-
-        if selected_label:
-            if selected_label == correct_label:
-                accuracy += 1
+        accuracy += correct
 
     return accuracy / n_elems
 
 
+def export(main_folder, store_path, model=None):
+    """Add every output file under main_folder to the results store at store_path.
+
+    The model defaults to the name of the folder holding main_folder (e.g. results/<model>/hellaswag_v1-output).
+    """
+
+    # numpy (the analysis extra) is only needed for the results store
+    import numpy as np
+    from persona_impact.results_store import ResultsStore
+
+    model = model or Path(os.path.abspath(main_folder)).parent.name
+    folder = Path(os.path.abspath(main_folder)).name
+    store = ResultsStore(store_path)
+
+    exported = 0
+    for filename in jsonl_files(main_folder, recursive=True):
+        persona, version = get_file_name(filename)
+        meta = {'model': model, 'dataset': 'hellaswag', 'folder': folder, 'persona': persona, 'version': version}
+        if store.is_current(filename, METRIC_VERSION, **meta):
+            continue
+
+        keys, responses, labels, correct_labels, accuracy = [], [], [], [], []
+        for n, data in enumerate(read_json(filename)):
+            label, correct = selected_label(data)
+            keys.append(data.get('ind', n))
+            responses.append(data['llm_response'])
+            # Numbers too large to be a label are stored as no label
+            labels.append(label if label is not None and 0 <= label < 2 ** 31 else -1)
+            correct_labels.append(int(data['correct_label']))
+            accuracy.append(1. if correct else 0.)
+
+        store.write_segment(filename, meta, keys, responses, {
+            'label': np.array(labels, dtype=np.int32),
+            'correct_label': np.array(correct_labels, dtype=np.int16),
+            'accuracy': np.array(accuracy),
+        }, METRIC_VERSION)
+        exported += 1
+
+    store.save()
+    print(f'{exported} files exported to {store_path}')
+
+
 def plot_scores(filename):
 
+    # bokeh takes most of a second to import and is only needed here
+    from bokeh.plotting import figure, show
+    from bokeh.models import ColumnDataSource, FactorRange
+
     with open(filename, 'r') as reader:
         json_dict = ujson.load(reader)
 
@@ -94,14 +163,41 @@ def plot_scores(filename):
 
 def main(main_folder, output_path):
 
+    # Only new or modified output files are rescored
+    cache = ScoreCache(os.path.join(output_path, 'hellaswag_cache.json'), METRIC_VERSION)
+
     outputs = {}
-    for filename in glob.glob(os.path.join(main_folder, '**/*.jsonl'), recursive=True):
+    for filename in jsonl_files(main_folder, recursive=True):
         persona, version = get_file_name(filename)
         outputs.setdefault(persona, {})
 
-        accuracy = compute_accuracy(filename)
+        accuracy = cache.get(filename)
+        if accuracy is None:
+            accuracy = compute_accuracy(filename)
+            cache.put(filename, accuracy)
         outputs[persona][version] = accuracy
 
+    print(cache.summary())
+
+    opts = jsbeautifier.default_options()
+    opts.indent_size = 2
+
+    if not os.path.exists(output_path): os.makedirs(output_path)
+    cache.save()
+    with open(os.path.join(output_path, 'hellaswag.json'), 'w') as writer:
+        writer.write(jsbeautifier.beautify(ujson.dumps(outputs), opts))
+
+
+def main_from_store(store_path, output_path, model, folder=None):
+    """Like main, reading the accuracy column of an exported model from the results store."""
+
+    from persona_impact.results_store import ResultsStore
+
+    outputs = {}
+    # Segments scored by an older METRIC_VERSION are left out until exported again
+    means = ResultsStore(store_path).means('accuracy', model=model, folder=folder, metric_version=METRIC_VERSION)
+    for (_, _, _, persona, version), (_, accuracy) in means.items():
+        outputs.setdefault(persona, {})[version] = accuracy
 
     opts = jsbeautifier.default_options()
     opts.indent_size = 2
@@ -1,5 +1,9 @@
+import os
 import ujson
-from langchain.prompts import PromptTemplate
+from concurrent.futures import ProcessPoolExecutor
+
+from persona_impact.jsonl_io import open_jsonl, with_compression
+from persona_impact.prompt_store import compile_template, get_endings, make_header
 
 
 TEMPLATE = """{persona}
@@ -13,11 +17,58 @@ Endings:
 ### Response:
 Answer:
 """
-prompt_template = PromptTemplate.from_template(TEMPLATE)
+prompt_template = compile_template(TEMPLATE)
+
+EXAMPLES_FILE = '../../hellaswag/selected_val_examples.jsonl'
+HELLASWAG_FILES = ['./hellaswag/hellaswag_train.jsonl', './hellaswag/hellaswag_val.jsonl']
+OUTPUT_FOLDER = './prompts/hellaswag_v1'
+
+PERSONAS = [(None, None),
+            ('Virtual Assistant', 'specialized in narrative coherence and text completion. You are a meticulous '
+                                  'editor with a flair for storytelling, possessing an extensive knowledge '
+                                  'of narrative structure and a keen eye for detail. '
+                                  'Your skill set includes a profound understanding of language nuances '
+                                  'and the ability to seamlessly weave together incomplete sections of '
+                                  'text to create a cohesive and engaging narrative.'),
+            ('Human', 'specialized in narrative coherence and text completion. You are a Human, specialised in '
+                      'narrative coherence and text completion. As a seasoned editor and creative writer, '
+                      'you possess a keen eye for storytelling flow and the ability to seamlessly weave '
+                      'disparate elements into a cohesive whole, ensuring that narrative threads align '
+                      'with character development and plot progression.'),
+            ('Professor', 'specialized in narrative coherence and text completion. You are known for your sharp '
+                          'analytical skills, able to dissect complex narratives and identify the underlying '
+                          'structures that make them compelling. Your extensive knowledge in linguistics and a '
+                          'keen eye for detail allow you to guide students to mastery in crafting '
+                          'coherent and engaging texts.'),
+            ('Teacher', 'specialized in narrative coherence and text completion. As a meticulous and engaging '
+                        'educator with a passion for literature and language, '
+                        'you possess an extensive understanding of storytelling techniques and narrative structures.'
+                        ' Your skill lies in guiding students to develop their writing prowess by recognizing '
+                        'and crafting cohesive and compelling stories.'),
+            ('Student', 'specialized in narrative coherence and text completion. You are a dedicated and insightful'
+                        ' Creative Writing Tutor, well-versed in literary devices and story structuring. '
+                        'With a talent for guiding students to enhance their writing, you possess a keen '
+                        'understanding of how to craft compelling narratives and an ability to '
+                        'provide constructive, tailored feedback.'),
+            ('Contestant', 'specialized in narrative coherence and text completion. As an avid storyteller and '
+                           'linguistic enthusiast, you excel at weaving complex narratives into seamless '
+                           'tales that captivate and engage. With a vast knowledge of literature and '
+                           'a sharp eye for detail, you possess the unique skill of filling in gaps in stories, '
+                           'ensuring they flow logically and maintain their stylistic integrity.'),
+            ('Writer', 'specialized in narrative coherence and text completion. You are a meticulous Editor, '
+                       'known for your eagle-eye attention to detail and deep understanding of grammar, '
+                       'style, and clarity. Your skill set includes a comprehensive knowledge of publishing '
+                       'standards and an uncanny ability to enhance the readability of any text while '
+                       'preserving the author\'s voice.'),
+            ('Journalist', 'specialized in narrative coherence and text completion. You are a meticulous Editor '
+                           'with a keen eye for detail and a deep appreciation for storytelling. '
+                           'Your expertise lies in refining prose to enhance clarity, flow, and engagement, '
+                           'ensuring each story is presented at its highest quality.')
+            ]
 
 
 def read_file(filename):
-    with open(filename, 'r') as reader:
+    with open_jsonl(filename, 'r') as reader:
         for line in reader:
             data = ujson.loads(line.strip())
             yield data
@@ -34,16 +85,12 @@ def get_persona(persona):
     return ""
 
 
-def get_endings(endings):
-    return "\n".join([f"{str(i)}) {s.lower()}" for i, s in enumerate(endings)])
-
-
-def get_examples():
+def get_examples(examples_file=EXAMPLES_FILE):
 
     examples_ind = []
     examples_str = []
 
-    with open('../../hellaswag/selected_val_examples.jsonl', 'r') as reader:
+    with open(examples_file, 'r') as reader:
         for example in reader:
             example = ujson.loads(example)
             examples_ind.append(example['ind'])
@@ -53,6 +100,18 @@ def get_examples():
     return examples_ind, examples_str
 
 
+def generate_compact_row(data):
+
+    return {
+        'ind': data['ind'],
+        'activity': data['activity_label'],
+        'correct_label': data['label'],
+        'split_type': data['split_type'],
+        'ctx': data['ctx'],
+        'endings': data['endings']
+    }
+
+
 def generate_instruction(data, persona, examples):
 
     output_line = {
@@ -62,22 +121,41 @@ def generate_instruction(data, persona, examples):
         'split_type': data['split_type']
     }
 
-    llm_instruction = prompt_template.invoke({
-        'persona': get_persona(persona),
-        'examples': examples,
-        'sentence': data['ctx'].lower(),
-        'endings': get_endings(data['endings'])
-    })
-
-    output_line['llm_instruction'] = llm_instruction.to_string()
+    output_line['llm_instruction'] = prompt_template.render(
+        persona=get_persona(persona),
+        examples=examples,
+        sentence=data['ctx'].lower(),
+        endings=get_endings(data['endings'])
+    )
 
     return output_line
 
 
-def main(input_files, persona_list, ten_shot=False):
+def write_prompt_file(name, input_files, persona, example_template, examples_ind, compact):
+
+    examples_ind = set(examples_ind)
+
+    with open_jsonl(name, 'w') as writer:
+        # Compact files store the shared template blocks once and render rows at inference time
+        if compact:
+            header = make_header('hellaswag', TEMPLATE, get_persona(persona), example_template)
+            writer.write(f'{ujson.dumps(header)}\n')
+
+        for file in input_files:
+            for example in read_file(file):
+                if example['ind'] in examples_ind: continue
+                if compact:
+                    instruction = generate_compact_row(example)
+                else:
+                    instruction = generate_instruction(example, persona, example_template)
+                writer.write(f'{ujson.dumps(instruction)}\n')
+
+
+def main(input_files, persona_list, ten_shot=False, compact=True, workers=1, compression=None,
+         output_folder=OUTPUT_FOLDER, examples_file=EXAMPLES_FILE):
 
     if ten_shot:
-        examples_ind, examples_str = get_examples()
+        examples_ind, examples_str = get_examples(examples_file)
         examples_str = '\n\n'.join(examples_str)
         example_template = f"## Examples:\n{examples_str}"
         version = 1
@@ -86,6 +164,7 @@ def main(input_files, persona_list, ten_shot=False):
         example_template = ""
         version = 0
 
+    jobs = []
     for (persona, description) in persona_list:
 
         if description and description != "":
@@ -93,63 +172,26 @@ def main(input_files, persona_list, ten_shot=False):
             persona += ' ' + description
 
         if persona:
-            name = f'./prompts/hellaswag_v1/{persona}_v{version}.jsonl'
+            name = os.path.join(output_folder, f'{persona}_v{version}.jsonl')
         else:
-            name = f'./prompts/hellaswag_v1/no_persona_v{version}.jsonl'
+            name = os.path.join(output_folder, f'no_persona_v{version}.jsonl')
 
-        with open(name, 'w') as writer:
-            for file in input_files:
-                for example in read_file(file):
-                    if ten_shot and (example['ind'] in examples_ind): continue
-                    instruction = generate_instruction(example, persona, example_template)
-                    writer.write(f'{ujson.dumps(instruction)}\n')
+        # compression='gz' or 'zst' writes .jsonl.gz or .jsonl.zst files
+        name = with_compression(name, compression)
+        jobs.append((name, input_files, persona, example_template, examples_ind, compact))
 
+    os.makedirs(output_folder, exist_ok=True)
 
-if __name__ == '__main__':
+    # Each persona file is independent, so they can be written by separate processes
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for future in [pool.submit(write_prompt_file, *job) for job in jobs]:
+                future.result()
+    else:
+        for job in jobs:
+            write_prompt_file(*job)
 
-    personas = [(None, None),
-                ('Virtual Assistant', 'specialized in narrative coherence and text completion. You are a meticulous '
-                                      'editor with a flair for storytelling, possessing an extensive knowledge '
-                                      'of narrative structure and a keen eye for detail. '
-                                      'Your skill set includes a profound understanding of language nuances '
-                                      'and the ability to seamlessly weave together incomplete sections of '
-                                      'text to create a cohesive and engaging narrative.'),
-                ('Human', 'specialized in narrative coherence and text completion. You are a Human, specialised in '
-                          'narrative coherence and text completion. As a seasoned editor and creative writer, '
-                          'you possess a keen eye for storytelling flow and the ability to seamlessly weave '
-                          'disparate elements into a cohesive whole, ensuring that narrative threads align '
-                          'with character development and plot progression.'),
-                ('Professor', 'specialized in narrative coherence and text completion. You are known for your sharp '
-                              'analytical skills, able to dissect complex narratives and identify the underlying '
-                              'structures that make them compelling. Your extensive knowledge in linguistics and a '
-                              'keen eye for detail allow you to guide students to mastery in crafting '
-                              'coherent and engaging texts.'),
-                ('Teacher', 'specialized in narrative coherence and text completion. As a meticulous and engaging '
-                            'educator with a passion for literature and language, '
-                            'you possess an extensive understanding of storytelling techniques and narrative structures.'
-                            ' Your skill lies in guiding students to develop their writing prowess by recognizing '
-                            'and crafting cohesive and compelling stories.'),
-                ('Student', 'specialized in narrative coherence and text completion. You are a dedicated and insightful'
-                            ' Creative Writing Tutor, well-versed in literary devices and story structuring. '
-                            'With a talent for guiding students to enhance their writing, you possess a keen '
-                            'understanding of how to craft compelling narratives and an ability to '
-                            'provide constructive, tailored feedback.'),
-                ('Contestant', 'specialized in narrative coherence and text completion. As an avid storyteller and '
-                               'linguistic enthusiast, you excel at weaving complex narratives into seamless '
-                               'tales that captivate and engage. With a vast knowledge of literature and '
-                               'a sharp eye for detail, you possess the unique skill of filling in gaps in stories, '
-                               'ensuring they flow logically and maintain their stylistic integrity.'),
-                ('Writer', 'specialized in narrative coherence and text completion. You are a meticulous Editor, '
-                           'known for your eagle-eye attention to detail and deep understanding of grammar, '
-                           'style, and clarity. Your skill set includes a comprehensive knowledge of publishing '
-                           'standards and an uncanny ability to enhance the readability of any text while '
-                           'preserving the author\'s voice.'),
-                ('Journalist', 'specialized in narrative coherence and text completion. You are a meticulous Editor '
-                               'with a keen eye for detail and a deep appreciation for storytelling. '
-                               'Your expertise lies in refining prose to enhance clarity, flow, and engagement, '
-                               'ensuring each story is presented at its highest quality.')
-                ]
-    hellaswag_files = ['./hellaswag/hellaswag_train.jsonl', './hellaswag/hellaswag_val.jsonl']
-
-    main(hellaswag_files, personas, ten_shot=True)
 
+if __name__ == '__main__':
+
+    main(HELLASWAG_FILES, PERSONAS, ten_shot=True, workers=len(PERSONAS))
@@ -0,0 +1,66 @@
+import argparse
+import os
+import ujson
+import jsbeautifier
+
+from hellaswag_evaluation import METRIC_VERSION, example_correctness, get_file_name
+
+from persona_impact.jsonl_io import jsonl_files
+from persona_impact.results_store import ResultsStore
+from persona_impact.significance import DEFAULT_RESAMPLES, compare_personas, format_report
+
+
+def load_correctness(main_folder):
+    """Return {version: {persona: {ind: correct}}} for every output file under main_folder."""
+
+    scores = {}
+    for filename in jsonl_files(main_folder, recursive=True):
+        persona, version = get_file_name(filename)
+        scores.setdefault(version, {})[persona] = dict(example_correctness(filename))
+
+    return scores
+
+
+def main(main_folder, output_path, baseline='no persona', n_resamples=DEFAULT_RESAMPLES, seed=0, store_path=None, model=None):
+
+    if store_path is None:
+        scores = load_correctness(main_folder)
+    else:
+        # main_folder names an exported output folder; only its accuracy column is read
+        folder = os.path.basename(main_folder.rstrip('/'))
+        scores = ResultsStore(store_path).scores('accuracy', model=model, folder=folder, metric_version=METRIC_VERSION).get(model, {})
+    # The baseline is usually only generated as v0; compare every version against it
+    baselines = [personas[baseline] for _, personas in sorted(scores.items()) if baseline in personas]
+
+    reports = {}
+    for version, personas in sorted(scores.items()):
+        if baseline not in personas and baselines:
+            personas = {**personas, baseline: baselines[0]}
+
+        report = compare_personas(personas, baseline, n_resamples, seed=seed)
+        print(format_report(f'accuracy {version}', report))
+        reports[version] = {'accuracy': report}
+
+    opts = jsbeautifier.default_options()
+    opts.indent_size = 2
+
+    if not os.path.exists(output_path): os.makedirs(output_path)
+    with open(os.path.join(output_path, 'hellaswag_significance.json'), 'w') as writer:
+        writer.write(jsbeautifier.beautify(ujson.dumps(reports), opts))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Significance of accuracy differences between personas')
+    parser.add_argument('main_folder', help='Folder with the HellaSwag output files (with --store, the name of an exported folder)')
+    parser.add_argument('output_path', help='Folder for hellaswag_significance.json')
+    parser.add_argument('--baseline', default='no persona')
+    parser.add_argument('--resamples', type=int, default=DEFAULT_RESAMPLES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--store', default=None, help='Read the scores from this results store')
+    parser.add_argument('--model', default=None, help='Model of the results store to compare')
+    args = parser.parse_args()
+    if args.store and not args.model:
+        parser.error('--store requires --model')
+
+    main(args.main_folder, args.output_path, args.baseline, args.resamples, args.seed, args.store, args.model)
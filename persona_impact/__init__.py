@@ -0,0 +1 @@
+"""Shared building blocks for the persona inference and evaluation scripts."""
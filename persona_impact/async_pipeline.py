@@ -0,0 +1,222 @@
+"""Pipelined generation: reading, generation and writing overlap.
+
+A reader stage indexes pending files and renders their prompts into a bounded
+queue, `max_in_flight` workers keep that many requests submitted to the
+backend's `generate_async` (vLLM's async engine batches them continuously),
+and a writer stage appends completions to each file's checkpoint, in key
+order, as soon as a contiguous run of rows is complete. The bounded queues
+give back-pressure: the reader never runs more than `queue_size` prompts ahead
+of the engine, and workers wait when the writer falls behind.
+"""
+
+import asyncio
+import time
+
+from tqdm import tqdm
+
+from persona_impact.backends import Backend, SamplingConfig
+from persona_impact.metrics import MetricsRecorder
+from persona_impact.pipeline import _FileJob, pending_files
+from persona_impact.profiles import DecodeStats
+
+# Rows indexed and rendered per reader step, off the event loop
+READ_BATCH = 64
+
+
+class _Utilization:
+    """Wall-clock seconds during which at least one request was in flight."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.busy_seconds = 0.0
+        self._since = 0.0
+
+    def start(self):
+        if self.in_flight == 0:
+            self._since = time.perf_counter()
+        self.in_flight += 1
+
+    def finish(self):
+        self.in_flight -= 1
+        if self.in_flight == 0:
+            self.busy_seconds += time.perf_counter() - self._since
+
+
+def _render(job: _FileJob, rows: list[int]):
+    entries = [job.reader.entry(i) for i in rows]
+    return [(entry, job.reader.prompt(entry)) for entry in entries]
+
+
+def _append_all(appends):
+    # Requests overlap, so no model time can be attributed to a file
+    for job, entries, results, completions in appends:
+        job.append(entries, results, completions, model_seconds=None)
+
+
+async def _read(
+    input_folders, output_root, output_compression, shard, duplicates, metrics, requests, n_workers, jobs
+):
+    for file, output_file in pending_files(input_folders, output_root, output_compression, shard):
+        job = await asyncio.to_thread(_FileJob, file, output_file, duplicates, metrics)
+        jobs.append(job)
+        if job.remaining == 0:
+            job.commit()
+            continue
+
+        for start in range(0, len(job.pending), READ_BATCH):
+            items = await asyncio.to_thread(_render, job, job.pending[start : start + READ_BATCH])
+            for position, (entry, prompt) in enumerate(items, start):
+                await requests.put((job, position, entry, prompt))
+
+    for _ in range(n_workers):
+        await requests.put(None)
+
+
+async def _generate(backend, sampling, requests, results, utilization):
+    while (item := await requests.get()) is not None:
+        job, position, entry, prompt = item
+        utilization.start()
+        try:
+            completion = await backend.generate_async(prompt, sampling)
+        finally:
+            utilization.finish()
+        await results.put((job, position, entry, completion))
+    await results.put(None)
+
+
+async def _write(sampling, results, n_workers, decode_stats, progress):
+    # Per file: the next row position to append, and completions that arrived early
+    state = {}
+    finished = 0
+    while finished < n_workers:
+        batch = [await results.get()]
+        while not results.empty():
+            batch.append(results.get_nowait())
+
+        for item in batch:
+            if item is None:
+                finished += 1
+                continue
+            job, position, entry, completion = item
+            state.setdefault(job, [0, {}])[1][position] = (entry, completion)
+
+        appends, output_tokens, n_rows = [], [], 0
+        for job, (position, ready) in state.items():
+            entries, responses, completions = [], [], []
+            while position in ready:
+                entry, completion = ready.pop(position)
+                entries.append(entry)
+                responses.append({"llm_response": completion.text})
+                completions.append(completion)
+                n_rows += 1
+                if not completion.cached:
+                    output_tokens.append(completion.output_tokens)
+                position += 1
+            state[job][0] = position
+            if entries:
+                appends.append((job, entries, responses, completions))
+
+        if appends:
+            await asyncio.to_thread(_append_all, appends)
+            progress.update(n_rows)
+            if decode_stats is not None:
+                decode_stats.add(sampling, output_tokens)
+
+
+async def _run(
+    backend,
+    sampling,
+    input_folders,
+    max_in_flight,
+    queue_size,
+    duplicates,
+    decode_stats,
+    output_root,
+    output_compression,
+    shard,
+    metrics,
+    jobs,
+):
+    requests = asyncio.Queue(maxsize=queue_size)
+    results = asyncio.Queue(maxsize=queue_size)
+    utilization = _Utilization()
+
+    with tqdm(unit="prompts") as progress:
+        tasks = [
+            asyncio.ensure_future(
+                _read(
+                    input_folders,
+                    output_root,
+                    output_compression,
+                    shard,
+                    duplicates,
+                    metrics,
+                    requests,
+                    max_in_flight,
+                    jobs,
+                )
+            ),
+            asyncio.ensure_future(_write(sampling, results, max_in_flight, decode_stats, progress)),
+        ]
+        tasks.extend(
+            asyncio.ensure_future(_generate(backend, sampling, requests, results, utilization))
+            for _ in range(max_in_flight)
+        )
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Whatever was appended stays in the checkpoints for the next run
+            for task in tasks:
+                task.cancel()
+            raise
+
+    return utilization
+
+
+def process_folders_pipelined(
+    backend: Backend,
+    sampling: SamplingConfig,
+    input_folders: list[str],
+    max_in_flight: int = 256,
+    queue_size: int | None = None,
+    duplicates: str = "keep",
+    decode_stats: DecodeStats | None = None,
+    output_root: str | None = None,
+    metrics: MetricsRecorder | None = None,
+    output_compression: str | None = None,
+    shard: tuple[int, int] | None = None,
+):
+    """Generate every pending file of `input_folders` with overlapped read, generate and write.
+
+    Outputs, checkpoints and resume behave as in `process_folder`; files are
+    committed once all of their rows are written. `queue_size` bounds both
+    the prompt and the completion queue (default: twice `max_in_flight`).
+    `output_compression` and `shard` are as in `process_folder`.
+    """
+    print(f"Processing files in {', '.join(input_folders)} with pipelined generation")
+
+    start = time.perf_counter()
+    jobs = []
+    utilization = asyncio.run(
+        _run(
+            backend,
+            sampling,
+            input_folders,
+            max_in_flight,
+            queue_size or 2 * max_in_flight,
+            duplicates,
+            decode_stats,
+            output_root,
+            output_compression,
+            shard,
+            metrics,
+            jobs,
+        )
+    )
+
+    total_seconds = time.perf_counter() - start
+    backend.generate_seconds += utilization.busy_seconds
+    print(
+        f"Finished {len(jobs)} files in {total_seconds:.2f}s (model busy {utilization.busy_seconds:.2f}s, "
+        f"{100 * utilization.busy_seconds / max(total_seconds, 1e-9):.0f}% of the run)"
+    )
@@ -0,0 +1,460 @@
+"""Generation backends used by the inference pipeline.
+
+`process_folder` only talks to the `Backend` interface, so the same pipeline can
+run on vLLM or on the deterministic CPU stand-in (`FakeBackend`) used to profile
+host-side overhead without a GPU.
+"""
+
+import asyncio
+import functools
+import hashlib
+import itertools
+import random
+import re
+import time
+from dataclasses import dataclass
+
+DEFAULT_MODEL = "yunconglong/Truthful_DPO_TomGrc_FusionNet_7Bx2_MoE_13B"
+# vLLM engine arguments that do not change what is generated
+OUTPUT_NEUTRAL_ENGINE_ARGS = {
+    "enable_prefix_caching",
+    "gpu_memory_utilization",
+    "max_num_seqs",
+    "max_num_batched_tokens",
+    "swap_space",
+    "disable_log_stats",
+}
+
+
+@dataclass(frozen=True)
+class SamplingConfig:
+    max_tokens: int = 128
+    top_k: int = 10
+    top_p: float = 0.95
+    temperature: float = 0.69
+    seed: int | None = None
+    # Generation stops at the first of these strings (not included in the text)
+    stop: tuple[str, ...] = ()
+    # Restrict the first generated token to one of these single-token strings
+    guided_choice: tuple[str, ...] | None = None
+
+
+@dataclass
+class Completion:
+    text: str
+    prompt_tokens: int
+    output_tokens: int
+    prompt_token_ids: list[int] | None = None
+    # Request timings in seconds from arrival, when the backend reports them
+    queue_seconds: float | None = None
+    first_token_seconds: float | None = None
+    latency_seconds: float | None = None
+    # Served without decoding: from the generation cache, or a repeat of a prompt decoded once
+    cached: bool = False
+
+
+class Backend:
+    name = "base"
+
+    def __init__(self, model: str):
+        self.model = model
+        # Wall-clock seconds spent inside generate(), used to separate model
+        # time from host-side I/O and batching overhead.
+        self.generate_seconds = 0.0
+
+    def generate(
+        self,
+        prompts: list[str],
+        sampling: SamplingConfig,
+        prompt_token_ids: list[list[int] | None] | None = None,
+    ) -> list[Completion]:
+        """Complete `prompts`.
+
+        `prompt_token_ids` (see `persona_impact.pretokenize`) gives, per
+        prompt, its token ids or None; prompts with ids are not tokenized again.
+        """
+        start = time.perf_counter()
+        try:
+            return self._generate(prompts, sampling, prompt_token_ids)
+        finally:
+            self.generate_seconds += time.perf_counter() - start
+
+    def _generate(
+        self, prompts: list[str], sampling: SamplingConfig, prompt_token_ids: list[list[int] | None] | None = None
+    ) -> list[Completion]:
+        raise NotImplementedError
+
+    def score_continuations(self, prompts: list[str], continuations: list[str]) -> list[list[float]]:
+        """Log-likelihood of each continuation given each prompt, without decoding."""
+        start = time.perf_counter()
+        try:
+            return self._score_continuations(prompts, continuations)
+        finally:
+            self.generate_seconds += time.perf_counter() - start
+
+    def _score_continuations(self, prompts: list[str], continuations: list[str]) -> list[list[float]]:
+        raise NotImplementedError
+
+    async def generate_async(self, prompt: str, sampling: SamplingConfig) -> Completion:
+        """Generate one prompt without blocking the event loop.
+
+        Backends with a continuously batching engine override this; the
+        default runs a single-prompt `generate` in a worker thread.
+        """
+        return (await asyncio.to_thread(self.generate, [prompt], sampling))[0]
+
+    def cache_identity(self) -> dict:
+        """What, besides the prompt and sampling config, determines this backend's completions."""
+        return {"backend": self.name, "model": self.model}
+
+    def encode(self, text: str) -> list[int]:
+        raise NotImplementedError
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.encode(text))
+
+    def count_tokens_batch(self, texts: list[str]) -> list[int]:
+        return [self.count_tokens(text) for text in texts]
+
+    def close(self):
+        pass
+
+
+class VLLMBackend(Backend):
+    name = "vllm"
+
+    def __init__(self, model: str = DEFAULT_MODEL, tensor_parallel_size: int | None = None, **engine_kwargs):
+        import torch
+        from vllm import LLM
+
+        super().__init__(model)
+        if tensor_parallel_size is None:
+            tensor_parallel_size = torch.cuda.device_count()
+        self.engine_kwargs = engine_kwargs
+        self.llm = LLM(model=model, tensor_parallel_size=tensor_parallel_size, **engine_kwargs)
+
+    def get_tokenizer(self):
+        return self.llm.get_tokenizer()
+
+    def cache_identity(self):
+        # The sync and async engines produce the same completions; options such
+        # as dtype or quantization change them, scheduling and caching do not
+        options = {key: value for key, value in self.engine_kwargs.items() if key not in OUTPUT_NEUTRAL_ENGINE_ARGS}
+        return {"backend": "vllm", "model": self.model, "engine": options}
+
+    def close(self):
+        """Release the engine and its GPU memory so another model can be loaded."""
+        del self.llm
+        _release_gpu_memory()
+
+    def sampling_params(self, sampling: SamplingConfig):
+        from vllm import SamplingParams
+
+        logits_processors = None
+        if sampling.guided_choice:
+            logits_processors = [self._choice_processor(sampling.guided_choice)]
+
+        return SamplingParams(
+            max_tokens=sampling.max_tokens,
+            top_k=sampling.top_k,
+            top_p=sampling.top_p,
+            temperature=sampling.temperature,
+            seed=sampling.seed,
+            stop=list(sampling.stop) or None,
+            logits_processors=logits_processors,
+        )
+
+    def _choice_processor(self, choices: tuple[str, ...]):
+        import torch
+
+        from persona_impact.prefix import common_prefix_length
+
+        # Token ids of each choice as it follows a newline (as after "Answer:\n"),
+        # avoiding the leading-space variants a bare encode() would produce.
+        tokenizer = self.get_tokenizer()
+        anchor = tokenizer.encode("\n")
+        allowed = []
+        for choice in choices:
+            token_ids = tokenizer.encode("\n" + choice)
+            token_ids = token_ids[common_prefix_length(anchor, token_ids) :]
+            if len(token_ids) != 1:
+                raise ValueError(f"Guided choice {choice!r} is not a single token for {self.model}")
+            allowed.append(token_ids[0])
+
+        def process(generated_ids, logits):
+            if generated_ids:
+                return logits
+            mask = torch.full_like(logits, float("-inf"))
+            mask[allowed] = 0
+            return logits + mask
+
+        return process
+
+    def _generate(self, prompts, sampling, prompt_token_ids=None):
+        # vLLM tokenizes the prompts whose token ids are None
+        responses = self.llm.generate(prompts, self.sampling_params(sampling), prompt_token_ids=prompt_token_ids)
+        return [_completion(response) for response in responses]
+
+    def _score_continuations(self, prompts, continuations):
+        from vllm import SamplingParams
+
+        from persona_impact.prefix import common_prefix_length
+
+        # Every continuation of a prompt is submitted as prompt + continuation
+        # token ids; with prefix caching the shared prompt is prefilled once.
+        tokenizer = self.llm.get_tokenizer()
+        requests, starts = [], []
+        for prompt in prompts:
+            context = tokenizer.encode(prompt)
+            for continuation in continuations:
+                token_ids = tokenizer.encode(prompt + continuation)
+                # Continuation tokens start where the ids diverge from the
+                # prompt alone, which handles merges across the boundary.
+                starts.append(min(common_prefix_length(context, token_ids), len(token_ids) - 1))
+                requests.append(token_ids)
+
+        outputs = self.llm.generate(
+            prompt_token_ids=requests,
+            sampling_params=SamplingParams(max_tokens=1, prompt_logprobs=0),
+        )
+
+        scores = [
+            sum(
+                logprobs[token_id].logprob
+                for logprobs, token_id in zip(output.prompt_logprobs[start:], token_ids[start:])
+            )
+            for output, token_ids, start in zip(outputs, requests, starts)
+        ]
+        n = len(continuations)
+        return [scores[i : i + n] for i in range(0, len(scores), n)]
+
+    def encode(self, text):
+        return self.llm.get_tokenizer().encode(text)
+
+
+class FakeTokenizer:
+    """Splits on words and punctuation, roughly one token per ~4 characters of prose."""
+
+    token_regex = re.compile(r"\w+|[^\w\s]")
+
+    def __init__(self, vocab_size: int = 32000):
+        self.vocab_size = vocab_size
+
+    def tokenize(self, text: str) -> list[str]:
+        return self.token_regex.findall(text)
+
+    def encode(self, text: str) -> list[int]:
+        return [_fake_token_id(token, self.vocab_size) for token in self.tokenize(text)]
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _fake_token_id(token: str, vocab_size: int) -> int:
+    return int.from_bytes(hashlib.blake2b(token.encode(), digest_size=4).digest(), "little") % vocab_size
+
+
+def load_tokenizer(name: str):
+    """Return the stand-in tokenizer for 'fake', otherwise a Hugging Face tokenizer."""
+    if name == "fake":
+        return FakeTokenizer()
+
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(name)
+
+
+FAKE_WORDS = (
+    "the a of and to in is was for on that with as by he she it they said "
+    "summary article answer ending 0 1 2 3 . , ###"
+).split()
+
+
+class FakeBackend(Backend):
+    """Deterministic CPU stand-in: same prompt, seed and sampling config give the same text."""
+
+    name = "fake"
+
+    def __init__(
+        self,
+        model: str = "fake",
+        seconds_per_prompt_token: float = 0.0,
+        seconds_per_output_token: float = 0.0,
+        seed: int = 0,
+        enable_prefix_caching: bool = False,
+    ):
+        super().__init__(model)
+        self.seconds_per_prompt_token = seconds_per_prompt_token
+        self.seconds_per_output_token = seconds_per_output_token
+        self.seed = seed
+        self.enable_prefix_caching = enable_prefix_caching
+        self.tokenizer = FakeTokenizer()
+
+    def cache_identity(self):
+        return {"backend": self.name, "model": self.model, "seed": self.seed}
+
+    def _rng(self, *parts) -> random.Random:
+        key = "\0".join(str(part) for part in (self.model, self.seed, *parts)).encode()
+        return random.Random(hashlib.sha256(key).digest())
+
+    def complete(self, prompt: str, sampling: SamplingConfig, token_ids: list[int] | None = None) -> Completion:
+        rng = self._rng(sampling, prompt)
+        if sampling.guided_choice:
+            n_tokens, text = 1, rng.choice(sampling.guided_choice)
+        else:
+            n_tokens = rng.randint(1, sampling.max_tokens)
+            words = rng.choices(FAKE_WORDS, k=n_tokens)
+            # Emulate stop strings: decoding stops at the first word matching one
+            stops = {stop.strip() for stop in sampling.stop} - {""}
+            for i, word in enumerate(words):
+                if word in stops:
+                    n_tokens, words = i + 1, words[:i]
+                    break
+            text = " ".join(words)
+        if token_ids is None:
+            token_ids = self.encode(prompt)
+        return Completion(
+            text=text, prompt_tokens=len(token_ids), output_tokens=n_tokens, prompt_token_ids=token_ids
+        )
+
+    def _generate(self, prompts, sampling, prompt_token_ids=None):
+        from persona_impact.prefix import analyze_prefixes
+
+        token_lists = prompt_token_ids or [None] * len(prompts)
+        completions = [self.complete(prompt, sampling, token_ids) for prompt, token_ids in zip(prompts, token_lists)]
+        prefill_tokens = sum(c.prompt_tokens for c in completions)
+        if self.enable_prefix_caching:
+            # Only blocks missing from the cache are charged as prefill.
+            prefill_tokens -= analyze_prefixes([c.prompt_token_ids for c in completions]).cached_tokens
+        prefill_seconds = prefill_tokens * self.seconds_per_prompt_token
+        latency = prefill_seconds + sum(c.output_tokens * self.seconds_per_output_token for c in completions)
+        # The whole batch is prefilled first, then decoded together
+        for c in completions:
+            c.queue_seconds = 0.0
+            c.first_token_seconds = prefill_seconds + self.seconds_per_output_token
+            c.latency_seconds = latency
+        if latency > 0:
+            time.sleep(latency)
+        return completions
+
+    async def generate_async(self, prompt, sampling):
+        # Requests in flight overlap, like sequences of a continuously batched engine
+        completion = self.complete(prompt, sampling)
+        prefill_seconds = completion.prompt_tokens * self.seconds_per_prompt_token
+        latency = prefill_seconds + completion.output_tokens * self.seconds_per_output_token
+        completion.queue_seconds = 0.0
+        completion.first_token_seconds = prefill_seconds + self.seconds_per_output_token
+        completion.latency_seconds = latency
+        if latency > 0:
+            await asyncio.sleep(latency)
+        return completion
+
+    def _score_continuations(self, prompts, continuations):
+        scores = []
+        for prompt in prompts:
+            row = []
+            for continuation in continuations:
+                rng = self._rng(prompt, continuation)
+                n_tokens = max(self.count_tokens(continuation), 1)
+                row.append(sum(-rng.expovariate(1.0) for _ in range(n_tokens)))
+            scores.append(row)
+        # One prefill per prompt; continuations reuse the cached prompt prefix
+        latency = sum(self.count_tokens(p) for p in prompts) * self.seconds_per_prompt_token
+        if latency > 0:
+            time.sleep(latency)
+        return scores
+
+    def encode(self, text):
+        return self.tokenizer.encode(text)
+
+    def count_tokens(self, text):
+        return len(self.tokenizer.tokenize(text))
+
+
+class VLLMAsyncBackend(VLLMBackend):
+    """vLLM's async engine: requests are submitted one by one and batched continuously.
+
+    Only `generate_async` is supported, for the pipelined runner.
+    """
+
+    name = "vllm-async"
+
+    def __init__(self, model: str = DEFAULT_MODEL, tensor_parallel_size: int | None = None, **engine_kwargs):
+        import torch
+        from vllm import AsyncEngineArgs, AsyncLLMEngine
+
+        Backend.__init__(self, model)
+        if tensor_parallel_size is None:
+            tensor_parallel_size = torch.cuda.device_count()
+        self.engine_kwargs = engine_kwargs
+        self.engine = AsyncLLMEngine.from_engine_args(
+            AsyncEngineArgs(model=model, tensor_parallel_size=tensor_parallel_size, **engine_kwargs)
+        )
+        self._request_ids = itertools.count()
+
+    def get_tokenizer(self):
+        return self.engine.engine.get_tokenizer()
+
+    def _generate(self, prompts, sampling, prompt_token_ids=None):
+        raise NotImplementedError(f"{self.name} only supports generate_async (use the pipelined runner)")
+
+    def _score_continuations(self, prompts, continuations):
+        raise NotImplementedError(f"{self.name} does not support scoring")
+
+    async def generate_async(self, prompt, sampling):
+        final = None
+        async for output in self.engine.generate(prompt, self.sampling_params(sampling), str(next(self._request_ids))):
+            final = output
+        return _completion(final)
+
+    def close(self):
+        del self.engine
+        _release_gpu_memory()
+
+
+def _completion(response) -> Completion:
+    """Completion of a vLLM `RequestOutput`, with its timings when vLLM records them."""
+    completion = Completion(
+        text=response.outputs[0].text,
+        prompt_tokens=len(response.prompt_token_ids),
+        output_tokens=len(response.outputs[0].token_ids),
+        prompt_token_ids=response.prompt_token_ids,
+    )
+    metrics = getattr(response, "metrics", None)
+    if metrics is not None:
+        if metrics.time_in_queue is not None:
+            completion.queue_seconds = metrics.time_in_queue
+        if metrics.first_token_time is not None:
+            completion.first_token_seconds = metrics.first_token_time - metrics.arrival_time
+        if metrics.finished_time is not None:
+            completion.latency_seconds = metrics.finished_time - metrics.arrival_time
+    return completion
+
+
+def _release_gpu_memory():
+    import gc
+
+    import torch
+
+    try:
+        from vllm.distributed.parallel_state import destroy_model_parallel
+    except ImportError:  # vLLM < 0.4.1
+        from vllm.model_executor.parallel_utils.parallel_state import destroy_model_parallel
+
+    destroy_model_parallel()
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+BACKENDS = {
+    VLLMBackend.name: VLLMBackend,
+    VLLMAsyncBackend.name: VLLMAsyncBackend,
+    FakeBackend.name: FakeBackend,
+}
+
+
+def load_backend(name: str, model: str | None = None, **kwargs) -> Backend:
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend {name!r}, expected one of {sorted(BACKENDS)}")
+    if model is not None:
+        kwargs["model"] = model
+    return BACKENDS[name](**kwargs)
@@ -0,0 +1,76 @@
+"""Append-only, resumable output files.
+
+Rows are appended to `<output>.partial` as each chunk of prompts is generated
+and the file is renamed to `<output>` only once every prompt has a response,
+so an existing output file is always complete. After a crash the partial file
+tells which keys are already done. Compressed outputs (`.jsonl.gz`,
+`.jsonl.zst`) get a compressed partial file with one member per appended chunk.
+"""
+
+import os
+from collections import Counter
+
+import ujson as json
+
+from persona_impact.jsonl_io import complete_lines, compression_of, open_jsonl
+
+PARTIAL_SUFFIX = ".partial"
+
+
+def partial_path(output_file: str) -> str:
+    return output_file + PARTIAL_SUFFIX
+
+
+def load_completed_keys(output_file: str) -> Counter:
+    """Count the rows per sort key already written to the partial output, if any.
+
+    A row torn by a crash mid-write is cut off so that appends resume on a
+    clean line boundary.
+    """
+    path = partial_path(output_file)
+    if not os.path.exists(path):
+        return Counter()
+
+    completed = Counter()
+    if compression_of(output_file) is not None:
+        end = 0
+        for end, lines in complete_lines(path, output_file):
+            for line in lines:
+                if line.strip():
+                    completed[json.loads(line)["sort_key"]] += 1
+        if end < os.path.getsize(path):
+            os.truncate(path, end)
+        return completed
+
+    with open(path, "rb+") as file:
+        end = 0
+        for line in file:
+            if not line.endswith(b"\n"):
+                file.truncate(end)
+                break
+            end += len(line)
+            if line.strip():
+                completed[json.loads(line)["sort_key"]] += 1
+
+    return completed
+
+
+class CheckpointWriter:
+    def __init__(self, output_file: str):
+        self.output_file = output_file
+        self.file = open_jsonl(partial_path(output_file), "a", output_file)
+
+    def append(self, rows):
+        for row in rows:
+            self.file.write(json.dumps(row) + "\n")
+        # Make the chunk durable (and end its compressed member) before more
+        # work is started on top of it
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def commit(self):
+        self.file.close()
+        os.replace(partial_path(self.output_file), self.output_file)
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,197 @@
+"""The `persona-impact` command.
+
+    persona-impact create-prompts hellaswag --ten-shot
+    persona-impact infer prompts/hellaswag_v1 --global-batch
+    persona-impact evaluate hellaswag outputs/hellaswag_v1-output scores
+
+Each subcommand is a module (or a function below) that is only imported once
+the subcommand is chosen, so `--help`, `--dry-run` and quick queries do not
+pay for vLLM, NumPy, NLTK or Bokeh. The task commands (create-prompts,
+evaluate, export, significance, plot) run the scripts of `evaluation_scripts`
+and need a source checkout installed with `pip install -e .`.
+"""
+
+import argparse
+import importlib
+import os
+import runpy
+import sys
+
+EVALUATION_SCRIPTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "evaluation_scripts")
+TASKS = ("hellaswag", "cnn_dm")
+# Per task: prompt creator, evaluator and significance script of evaluation_scripts/<task>
+TASK_MODULES = {
+    "hellaswag": ("hellaswag_prompt_creator", "hellaswag_evaluation", "hellaswag_significance"),
+    "cnn_dm": ("cnn_dm_prompt_creator", "evaluation", "significance"),
+}
+
+
+def _task_folder(task: str) -> str:
+    folder = os.path.join(EVALUATION_SCRIPTS, task)
+    if not os.path.isdir(folder):
+        sys.exit(f"{folder} not found: the {task} commands need a source checkout installed with pip install -e .")
+    return folder
+
+
+def _task_module(task: str, name: str):
+    # The task scripts import their siblings by name
+    folder = _task_folder(task)
+    if folder not in sys.path:
+        sys.path.insert(0, folder)
+    return importlib.import_module(name)
+
+
+def create_prompts():
+    parser = argparse.ArgumentParser(description="Write one prompt file per persona for a task.")
+    parser.add_argument("task", choices=TASKS)
+    parser.add_argument(
+        "inputs",
+        nargs="*",
+        help="hellaswag: the dataset JSONL files (default: ./hellaswag/hellaswag_train.jsonl and "
+        "./hellaswag/hellaswag_val.jsonl); cnn_dm: the folder of CNN/DM stories",
+    )
+    parser.add_argument("--output-folder", default=None, help="Folder for the prompt files (default: the task's)")
+    parser.add_argument("--ten-shot", action="store_true", help="Add the few-shot examples block")
+    parser.add_argument(
+        "--examples",
+        default=None,
+        help="hellaswag: JSONL file of the few-shot examples; cnn_dm: folder of training stories to sample them from",
+    )
+    parser.add_argument(
+        "--personas",
+        default=None,
+        help="JSON file with a list of [persona, description] pairs, [null, null] for no persona (default: the task's)",
+    )
+    parser.add_argument(
+        "--compact",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Store the shared template blocks once in a header row (--no-compact renders every row)",
+    )
+    parser.add_argument("--workers", type=int, default=None, help="Processes writing persona files (default: one each)")
+    parser.add_argument(
+        "--compression", choices=("gz", "zst"), default=None, help="Write .jsonl.gz or .jsonl.zst prompt files"
+    )
+    args = parser.parse_args()
+
+    creator = _task_module(args.task, TASK_MODULES[args.task][0])
+    personas = creator.PERSONAS
+    if args.personas is not None:
+        import ujson as json
+
+        with open(args.personas, "r") as file:
+            personas = [tuple(pair) for pair in json.load(file)]
+    options = {"workers": args.workers or len(personas), "compression": args.compression}
+
+    if args.task == "hellaswag":
+        if args.output_folder is not None:
+            options["output_folder"] = args.output_folder
+        if args.examples is not None:
+            options["examples_file"] = args.examples
+        creator.main(args.inputs or creator.HELLASWAG_FILES, personas, args.ten_shot, args.compact, **options)
+    else:
+        if len(args.inputs) != 1:
+            parser.error("cnn_dm takes the folder of CNN/DM stories")
+        if args.examples is not None:
+            options["examples_folder"] = args.examples
+        creator.main(args.inputs[0], personas, args.ten_shot, args.compact, output_folder=args.output_folder, **options)
+
+
+def evaluate():
+    parser = argparse.ArgumentParser(description="Score the output files of a task, one score per persona and version.")
+    parser.add_argument("task", choices=TASKS)
+    parser.add_argument("outputs", help="Folder with the output files (with --store, the name of an exported folder)")
+    parser.add_argument("results", help="Folder for the score file (hellaswag.json or cnn_dm.json)")
+    parser.add_argument("--store", default=None, help="Read the scores from this results store")
+    parser.add_argument("--model", default=None, help="Model of the results store")
+    parser.add_argument("--workers", type=int, default=None, help="cnn_dm: processes scoring ROUGE")
+    args = parser.parse_args()
+    if args.store and not args.model:
+        parser.error("--store requires --model")
+
+    evaluation = _task_module(args.task, TASK_MODULES[args.task][1])
+    if args.store is not None:
+        folder = os.path.basename(args.outputs.rstrip("/"))
+        evaluation.main_from_store(args.store, args.results, args.model, folder)
+    elif args.task == "cnn_dm":
+        evaluation.main(args.outputs, args.results, args.workers)
+    else:
+        evaluation.main(args.outputs, args.results)
+
+
+def export():
+    parser = argparse.ArgumentParser(description="Export the output files of a task to a columnar results store.")
+    parser.add_argument("task", choices=TASKS)
+    parser.add_argument("outputs", help="Folder with the output files")
+    parser.add_argument("store", help="Results store directory")
+    parser.add_argument("--model", default=None, help="Model name (default: the folder holding the outputs folder)")
+    parser.add_argument("--workers", type=int, default=None, help="cnn_dm: processes scoring ROUGE")
+    args = parser.parse_args()
+
+    evaluation = _task_module(args.task, TASK_MODULES[args.task][1])
+    if args.task == "cnn_dm":
+        evaluation.export(args.outputs, args.store, args.model, args.workers)
+    else:
+        evaluation.export(args.outputs, args.store, args.model)
+
+
+def significance():
+    if len(sys.argv) < 2 or sys.argv[1] not in TASKS:
+        sys.exit(f"usage: {sys.argv[0]} {{{','.join(TASKS)}}} ... (see {sys.argv[0]} TASK --help)")
+    task = sys.argv[1]
+    # The significance scripts parse their own arguments
+    script = os.path.join(_task_folder(task), f"{TASK_MODULES[task][2]}.py")
+    sys.path.insert(0, os.path.dirname(script))
+    sys.argv = [f"{sys.argv[0]} {task}", *sys.argv[2:]]
+    runpy.run_path(script, run_name="__main__")
+
+
+def plot():
+    parser = argparse.ArgumentParser(description="Plot per-persona HellaSwag accuracy against the no-persona baseline.")
+    parser.add_argument("task", choices=("hellaswag",))
+    parser.add_argument("scores", help="hellaswag.json written by the evaluate command")
+    args = parser.parse_args()
+
+    _task_module(args.task, TASK_MODULES[args.task][1]).plot_scores(args.scores)
+
+
+# Subcommand -> (module:function, description)
+COMMANDS = {
+    "create-prompts": ("persona_impact.cli:create_prompts", "Write one prompt file per persona for a task"),
+    "pretokenize": ("persona_impact.pretokenize:main", "Store the prompt token ids of input folders next to them"),
+    "infer": ("persona_impact.infer:main", "Generate responses for the prompt files of input folders"),
+    "plan": ("persona_impact.planner:main", "Estimate the tokens, memory, layout and runtime of a sweep"),
+    "sweep": ("persona_impact.sweep:main", "Run every model x folder x profile of a sweep plan"),
+    "evaluate": ("persona_impact.cli:evaluate", "Score output files per persona and version"),
+    "export": ("persona_impact.cli:export", "Export output files to a columnar results store"),
+    "significance": ("persona_impact.cli:significance", "Test persona differences against the baseline"),
+    "plot": ("persona_impact.cli:plot", "Plot HellaSwag scores"),
+    "results": ("persona_impact.results_store:main", "Compare per-persona means across the models of a results store"),
+    "prefix": ("persona_impact.prefix:main", "Measure the prompt prefixes shared by input folders"),
+}
+
+
+def usage() -> str:
+    lines = ["usage: persona-impact <command> [options]", "", "commands:"]
+    lines += [f"  {name:16}{description}" for name, (_, description) in COMMANDS.items()]
+    lines += ["", "Run persona-impact <command> --help for the options of a command."]
+    return "\n".join(lines)
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help"):
+        print(usage())
+        return
+    command = sys.argv[1]
+    if command not in COMMANDS:
+        print(usage(), file=sys.stderr)
+        sys.exit(f"persona-impact: unknown command {command!r}")
+
+    # Commands parse sys.argv themselves, and only the chosen one's module is imported
+    module_name, function = COMMANDS[command][0].split(":")
+    sys.argv = [f"persona-impact {command}", *sys.argv[2:]]
+    getattr(importlib.import_module(module_name), function)()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+"""Data-parallel inference over several independent model replicas.
+
+A 7B or 13B model fits on one or two GPUs, so running one tensor-parallel
+engine across a whole 8-GPU node spends most of the hardware on communication.
+`DataParallelBackend` instead starts one worker process per replica, each
+owning its own backend on its own slice of the visible GPUs, and looks like a
+single backend to the runners:
+
+- `generate` and `score_continuations` split the prompts of a call into
+  contiguous ranges, one per replica, and return the results in input order,
+  so outputs are written exactly as with one engine;
+- `generate_async` sends each request to the replica with the fewest
+  requests outstanding; a replica batches whatever requests are waiting.
+
+Workers are spawned processes, so the stand-in `fake` backend can exercise the
+whole mode on CPU with several local workers.
+"""
+
+import asyncio
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import threading
+import traceback
+from concurrent.futures import Future
+
+from persona_impact.backends import Backend, Completion, SamplingConfig, load_backend
+
+# Requests a replica merges into one generate call when they queue up
+MAX_MERGED_REQUESTS = 256
+
+
+def visible_devices() -> list[str] | None:
+    devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+    return [device for device in devices.split(",") if device] if devices else None
+
+
+def replica_devices(replicas: int, devices_per_replica: int, devices: list[str] | None = None) -> list[str]:
+    """CUDA_VISIBLE_DEVICES of each replica: consecutive, disjoint slices of `devices`."""
+    devices = devices or visible_devices() or [str(i) for i in range(replicas * devices_per_replica)]
+    if replicas * devices_per_replica > len(devices):
+        raise ValueError(
+            f"{replicas} replicas x {devices_per_replica} devices need {replicas * devices_per_replica} devices, "
+            f"only {len(devices)} are visible"
+        )
+    return [",".join(devices[i * devices_per_replica : (i + 1) * devices_per_replica]) for i in range(replicas)]
+
+
+def _serve(backend: Backend, requests, responses):
+    while True:
+        batch = [requests.get()]
+        while len(batch) < MAX_MERGED_REQUESTS:
+            try:
+                batch.append(requests.get_nowait())
+            except queue.Empty:
+                break
+        if None in batch:
+            return
+
+        # Generate requests sharing a sampling config run as one call
+        groups = {}
+        for request_id, method, args in batch:
+            group = ("generate", args[1]) if method == "generate" else (request_id,)
+            groups.setdefault(group, []).append((request_id, method, args))
+
+        for group in groups.values():
+            try:
+                if group[0][1] == "generate":
+                    prompts, token_ids = [], []
+                    for _, _, (group_prompts, _, group_token_ids) in group:
+                        prompts.extend(group_prompts)
+                        token_ids.extend(group_token_ids or [None] * len(group_prompts))
+                    if all(ids is None for ids in token_ids):
+                        token_ids = None
+                    results = iter(backend.generate(prompts, group[0][2][1], token_ids))
+                    for request_id, _, (group_prompts, _, _) in group:
+                        responses.send((request_id, True, [next(results) for _ in group_prompts]))
+                else:
+                    request_id, method, args = group[0]
+                    responses.send((request_id, True, getattr(backend, method)(*args)))
+            except Exception:
+                error = traceback.format_exc()
+                for request_id, _, _ in group:
+                    responses.send((request_id, False, error))
+
+
+def _worker(devices: str | None, backend_name: str, backend_kwargs: dict, requests, responses):
+    # Set before the backend imports torch, so the replica only sees its own GPUs
+    if devices is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = devices
+    try:
+        backend = load_backend(backend_name, **backend_kwargs)
+    except Exception:
+        responses.send((None, False, traceback.format_exc()))
+        return
+    responses.send((None, True, backend.cache_identity()))
+    try:
+        _serve(backend, requests, responses)
+    finally:
+        backend.close()
+
+
+class DataParallelBackend(Backend):
+    def __init__(
+        self,
+        backend_name: str,
+        replicas: int,
+        devices_per_replica: int | None = None,
+        model: str | None = None,
+        **backend_kwargs,
+    ):
+        """Start `replicas` workers, each running `load_backend(backend_name, model, **backend_kwargs)`.
+
+        With `devices_per_replica`, each worker gets its own slice of the
+        visible GPUs (pass the same number as the backend's tensor parallel
+        size); without it, workers inherit the parent's devices.
+        """
+        if model is not None:
+            backend_kwargs["model"] = model
+        super().__init__(model)
+        self.name = f"{backend_name}-dp{replicas}"
+        self.replicas = replicas
+        self._request_ids = itertools.count()
+        self._futures = {}
+        self._outstanding = [0] * replicas
+        self._exited = set()
+        self._lock = threading.Lock()
+        self._receiver = None
+
+        devices = replica_devices(replicas, devices_per_replica) if devices_per_replica else [None] * replicas
+        context = multiprocessing.get_context("spawn")
+        self._requests = [context.Queue() for _ in range(replicas)]
+        # One pipe per worker: a worker killed while writing to a shared queue would hold its lock forever
+        pipes = [context.Pipe(duplex=False) for _ in range(replicas)]
+        self._responses = [reader for reader, _ in pipes]
+        self._workers = [
+            context.Process(
+                target=_worker,
+                args=(devices[replica], backend_name, backend_kwargs, self._requests[replica], pipes[replica][1]),
+                daemon=True,
+            )
+            for replica in range(replicas)
+        ]
+        for worker in self._workers:
+            worker.start()
+        for _, writer in pipes:
+            writer.close()
+
+        identities = {}
+        while len(identities) < replicas:
+            replica, _, ok, result = self._get_response()
+            if not ok:
+                self.close()
+                raise RuntimeError(f"Replica {replica} failed to load:\n{result}")
+            identities[replica] = result
+        self.identity = identities[0]
+        self.model = self.identity["model"]
+
+        self._receiver = threading.Thread(target=self._receive, daemon=True)
+        self._receiver.start()
+
+    def _get_response(self):
+        """(replica, request id, ok, result) of the next response; a request id of None reports an exit."""
+        handles = {}
+        for replica in range(self.replicas):
+            if replica not in self._exited:
+                handles[self._responses[replica]] = replica
+                handles[self._workers[replica].sentinel] = replica
+        if not handles:
+            return None
+        ready = multiprocessing.connection.wait(list(handles))
+        # Read what an exited worker sent before reporting its exit
+        for handle in sorted(ready, key=lambda handle: handle not in self._responses):
+            replica = handles[handle]
+            if handle in self._responses:
+                try:
+                    return (replica, *handle.recv())
+                except EOFError:
+                    pass
+            elif self._responses[replica].poll():
+                continue
+            self._workers[replica].join()
+            self._exited.add(replica)
+            return replica, None, False, f"exited with code {self._workers[replica].exitcode}"
+
+    def _receive(self):
+        while (response := self._get_response()) is not None:
+            replica, request_id, ok, result = response
+            if request_id is None:
+                # Fail everything the worker still owed; _submit refuses new requests for it
+                with self._lock:
+                    failed = [rid for rid, (owner, _) in self._futures.items() if owner == replica]
+                    futures = [self._futures.pop(rid)[1] for rid in failed]
+                # Nothing reads the worker's queue any more; do not wait for it at exit
+                self._requests[replica].cancel_join_thread()
+                for future in futures:
+                    future.set_exception(RuntimeError(f"Replica {replica} {result}"))
+                continue
+            with self._lock:
+                _, future = self._futures.pop(request_id)
+                self._outstanding[replica] -= 1
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(f"Replica {replica} failed:\n{result}"))
+
+    def _submit(self, replica: int, method: str, *args) -> Future:
+        future = Future()
+        request_id = next(self._request_ids)
+        with self._lock:
+            if replica in self._exited:
+                raise RuntimeError(f"Replica {replica} exited with code {self._workers[replica].exitcode}")
+            self._futures[request_id] = (replica, future)
+            self._outstanding[replica] += 1
+        self._requests[replica].put((request_id, method, args))
+        return future
+
+    def _shards(self, items: list) -> list[tuple[int, list]]:
+        # Contiguous ranges keep prefix-grouped orders intact within each replica
+        size, extra = divmod(len(items), self.replicas)
+        shards, start = [], 0
+        for replica in range(self.replicas):
+            end = start + size + (replica < extra)
+            if end > start:
+                shards.append((replica, items[start:end]))
+            start = end
+        return shards
+
+    def _generate(
+        self, prompts: list[str], sampling: SamplingConfig, prompt_token_ids: list[list[int] | None] | None = None
+    ) -> list[Completion]:
+        token_shards = [shard for _, shard in self._shards(prompt_token_ids)] if prompt_token_ids else None
+        futures = [
+            self._submit(replica, "generate", shard, sampling, token_shards[n] if token_shards else None)
+            for n, (replica, shard) in enumerate(self._shards(prompts))
+        ]
+        return [completion for future in futures for completion in future.result()]
+
+    def _score_continuations(self, prompts: list[str], continuations: list[str]) -> list[list[float]]:
+        futures = [
+            self._submit(replica, "score_continuations", shard, continuations)
+            for replica, shard in self._shards(prompts)
+        ]
+        return [scores for future in futures for scores in future.result()]
+
+    async def generate_async(self, prompt: str, sampling: SamplingConfig) -> Completion:
+        with self._lock:
+            live = [replica for replica in range(self.replicas) if replica not in self._exited] or [0]
+            replica = min(live, key=self._outstanding.__getitem__)
+        completions = await asyncio.wrap_future(self._submit(replica, "generate", [prompt], sampling, None))
+        return completions[0]
+
+    def cache_identity(self) -> dict:
+        # Replicas are interchangeable: a completion does not depend on which one produced it
+        return self.identity
+
+    def encode(self, text: str) -> list[int]:
+        return self._submit(0, "encode", text).result()
+
+    def count_tokens(self, text: str) -> int:
+        return self._submit(0, "count_tokens", text).result()
+
+    def count_tokens_batch(self, texts: list[str]) -> list[int]:
+        # One request per replica rather than a round trip per text
+        futures = [self._submit(replica, "count_tokens_batch", shard) for replica, shard in self._shards(texts)]
+        return [count for future in futures for count in future.result()]
+
+    def close(self):
+        for requests in self._requests:
+            requests.put(None)
+        for worker in self._workers:
+            worker.join(timeout=60)
+            if worker.is_alive():
+                worker.terminate()
+        # The receiver returns once it has seen every worker exit
+        if self._receiver is not None:
+            self._receiver.join()
+
+
+def load_data_parallel(backend_name: str, replicas: int, model: str | None = None, **kwargs) -> Backend:
+    """`load_backend`, or with several `replicas` a `DataParallelBackend` over them.
+
+    vLLM replicas each get `tensor_parallel_size` GPUs (default: an equal
+    share of the visible ones).
+    """
+    if replicas == 1:
+        return load_backend(backend_name, model=model, **kwargs)
+    devices_per_replica = None
+    if backend_name != "fake":
+        if kwargs.get("tensor_parallel_size") is None:
+            import torch
+
+            kwargs["tensor_parallel_size"] = max(torch.cuda.device_count() // replicas, 1)
+        devices_per_replica = kwargs["tensor_parallel_size"]
+    return DataParallelBackend(backend_name, replicas, devices_per_replica, model=model, **kwargs)
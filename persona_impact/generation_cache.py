@@ -0,0 +1,219 @@
+"""Content-addressed cache of generated completions.
+
+Completions are stored in an SQLite file under a key hashed from the backend's
+identity (engine, model and output-affecting engine options, see
+`Backend.cache_identity`), the sampling config (including its seed) and the
+prompt. `CachedBackend` wraps any backend: identical prompts of a batch are
+submitted once, cached prompts are not submitted at all, and only the misses
+reach the engine. Re-running an interrupted sweep, or a persona file that was
+regenerated, then only pays for prompts that were never answered.
+
+The cache is bounded: once it holds more than `max_bytes` of completions, the
+least recently used ones are evicted. Cached completions carry their token
+counts but no prompt token ids or request timings, since nothing was prefilled
+or decoded for them.
+"""
+
+import asyncio
+import dataclasses
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import ujson as json
+
+from persona_impact.backends import Backend, Completion, SamplingConfig
+
+DEFAULT_CACHE_DIR = "generation_cache"
+DEFAULT_MAX_BYTES = 10 * 1024**3
+CACHE_FILE = "generations.sqlite"
+
+
+def cache_key(identity: dict, sampling: SamplingConfig, prompt: str) -> str:
+    payload = json.dumps([identity, dataclasses.asdict(sampling), prompt], sort_keys=True)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=20).hexdigest()
+
+
+class GenerationCache:
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.path = os.path.join(cache_dir, CACHE_FILE)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.duplicates = 0
+        self.evicted = 0
+        # The pipelined runner reaches the cache from the event loop thread
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        # Commits do not fsync in WAL mode; a crash can lose the last few entries, never corrupt the file
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS completions "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)")
+        self._db.commit()
+        self.total_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+
+    def get_many(self, keys: list[str]) -> dict[str, Completion]:
+        """Cached completions of `keys`, marked as recently used."""
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                batch = keys[start : start + 500]
+                rows = self._db.execute(
+                    f"SELECT key, value FROM completions WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                for key, value in rows:
+                    text, prompt_tokens, output_tokens = json.loads(value)
+                    found[key] = Completion(text=text, prompt_tokens=prompt_tokens, output_tokens=output_tokens)
+            now = time.time()
+            self._db.executemany("UPDATE completions SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+            self._db.commit()
+        return found
+
+    def put_many(self, items: list[tuple[str, Completion]]):
+        with self._lock:
+            now = time.time()
+            for key, completion in items:
+                value = json.dumps([completion.text, completion.prompt_tokens, completion.output_tokens])
+                previous = self._db.execute("SELECT size FROM completions WHERE key = ?", (key,)).fetchone()
+                self._db.execute(
+                    "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)", (key, value, len(value), now)
+                )
+                self.total_bytes += len(value) - (previous[0] if previous else 0)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        # Down to 90% of the bound, so that eviction does not run on every put
+        target = 0.9 * self.max_bytes
+        rows = self._db.execute("SELECT key, size FROM completions ORDER BY last_used").fetchall()
+        evict = []
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            evict.append((key,))
+            self.total_bytes -= size
+        self._db.executemany("DELETE FROM completions WHERE key = ?", evict)
+        self.evicted += len(evict)
+
+    def summary(self) -> str:
+        requests = self.hits + self.misses
+        hit_rate = self.hits / requests if requests else 0.0
+        return (
+            f"{self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate), "
+            f"{self.duplicates} duplicate prompts merged, {self.evicted} evicted, "
+            f"{self.total_bytes / 1024**2:.1f} MiB cached"
+        )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class CachedBackend(Backend):
+    """Serves generations from a `GenerationCache` and sends only the misses to `backend`.
+
+    Scoring is passed through uncached.
+    """
+
+    def __init__(self, backend: Backend, cache: GenerationCache):
+        self.backend = backend
+        self.cache = cache
+        self.name = backend.name
+        self.model = backend.model
+        self.identity = backend.cache_identity()
+        # Concurrent async requests for the same key share one engine request
+        self._in_flight = {}
+
+    # Model time is the wrapped engine's; cache hits cost none
+    @property
+    def generate_seconds(self) -> float:
+        return self.backend.generate_seconds
+
+    @generate_seconds.setter
+    def generate_seconds(self, value: float):
+        self.backend.generate_seconds = value
+
+    def generate(
+        self,
+        prompts: list[str],
+        sampling: SamplingConfig,
+        prompt_token_ids: list[list[int] | None] | None = None,
+    ) -> list[Completion]:
+        keys = [cache_key(self.identity, sampling, prompt) for prompt in prompts]
+        found = self.cache.get_many(list(set(keys)))
+
+        # Unique uncached prompts (and their token ids), in first-seen order
+        missing = {}
+        for key, prompt, token_ids in zip(keys, prompts, prompt_token_ids or [None] * len(prompts)):
+            if key in found:
+                self.cache.hits += 1
+            elif key in missing:
+                self.cache.duplicates += 1
+            else:
+                self.cache.misses += 1
+                missing[key] = (prompt, token_ids)
+
+        if missing:
+            missing_prompts, missing_token_ids = zip(*missing.values())
+            completions = self.backend.generate(
+                list(missing_prompts), sampling, list(missing_token_ids) if prompt_token_ids else None
+            )
+            self.cache.put_many(list(zip(missing, completions)))
+            found.update(zip(missing, completions))
+
+        # Each row gets its own object; duplicates must not share mutable completions.
+        # Only the first row of each missing prompt was decoded
+        decoded = set(missing)
+        completions = []
+        for key in keys:
+            completions.append(dataclasses.replace(found[key], cached=key not in decoded))
+            decoded.discard(key)
+        return completions
+
+    async def generate_async(self, prompt: str, sampling: SamplingConfig) -> Completion:
+        key = cache_key(self.identity, sampling, prompt)
+        if key in self._in_flight:
+            self.cache.duplicates += 1
+            return dataclasses.replace(await asyncio.shield(self._in_flight[key]), cached=True)
+
+        found = self.cache.get_many([key])
+        if key in found:
+            self.cache.hits += 1
+            return dataclasses.replace(found[key], cached=True)
+
+        self.cache.misses += 1
+        self._in_flight[key] = asyncio.ensure_future(self.backend.generate_async(prompt, sampling))
+        try:
+            completion = await self._in_flight[key]
+        finally:
+            del self._in_flight[key]
+        self.cache.put_many([(key, completion)])
+        return completion
+
+    def score_continuations(self, prompts: list[str], continuations: list[str]) -> list[list[float]]:
+        return self.backend.score_continuations(prompts, continuations)
+
+    def cache_identity(self) -> dict:
+        return self.identity
+
+    def encode(self, text: str) -> list[int]:
+        return self.backend.encode(text)
+
+    def count_tokens(self, text: str) -> int:
+        return self.backend.count_tokens(text)
+
+    def count_tokens_batch(self, texts: list[str]) -> list[int]:
+        return self.backend.count_tokens_batch(texts)
+
+    def close(self):
+        # The cache outlives the backend: a sweep shares it across models
+        self.backend.close()
@@ -0,0 +1,356 @@
+"""Generate responses for the prompt files of one or more input folders.
+
+Run as `persona-impact infer` (or `python vllm-inference-v2.py`); see
+`persona-impact infer --help` for the options.
+"""
+
+import argparse
+import os
+
+from persona_impact.async_pipeline import process_folders_pipelined
+from persona_impact.backends import BACKENDS, DEFAULT_MODEL
+from persona_impact.data_parallel import load_data_parallel
+from persona_impact.generation_cache import DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES, CachedBackend, GenerationCache
+from persona_impact.jsonl_io import COMPRESSIONS
+from persona_impact.metrics import MetricsRecorder, recorded_model
+from persona_impact.pipeline import (
+    assigned_files,
+    output_file_for,
+    output_folder_for,
+    process_folder,
+    process_folders_batched,
+)
+from persona_impact.profiles import DecodeStats, ProfileSet
+from persona_impact.reader import DUPLICATE_POLICIES
+from persona_impact.scheduler import OVERFLOW_POLICIES, LengthScheduler
+
+
+def build_backend(args):
+    if args.backend == "fake":
+        return load_data_parallel(
+            "fake",
+            args.replicas,
+            seconds_per_prompt_token=args.fake_prompt_latency,
+            seconds_per_output_token=args.fake_output_latency,
+            seed=args.seed,
+            enable_prefix_caching=args.prefix_caching or bool(args.score_choices),
+        )
+    engine_kwargs = {}
+    # Scoring submits every choice with the same prompt; caching prefills it once
+    if args.prefix_caching or args.score_choices:
+        engine_kwargs["enable_prefix_caching"] = True
+    # The pipelined runner submits requests one by one to vLLM's async engine;
+    # replicas batch the requests queued for them with the sync engine
+    name = "vllm-async" if args.pipelined and args.backend == "vllm" and args.replicas == 1 else args.backend
+    return load_data_parallel(
+        name, args.replicas, model=args.model, tensor_parallel_size=args.tensor_parallel_size, **engine_kwargs
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Process JSONL files in input folders and generate outputs."
+    )
+    parser.add_argument(
+        "input_folders",
+        nargs="+",
+        help="One or more input folders containing .jsonl files",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=sorted(BACKENDS),
+        default="vllm",
+        help="Generation backend; 'fake' is a deterministic CPU stand-in",
+    )
+    parser.add_argument("--model", default=DEFAULT_MODEL, help="Model name or path")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the fake backend")
+    parser.add_argument(
+        "--fake-prompt-latency",
+        type=float,
+        default=0.0,
+        help="Seconds per prompt token simulated by the fake backend",
+    )
+    parser.add_argument(
+        "--fake-output-latency",
+        type=float,
+        default=0.0,
+        help="Seconds per generated token simulated by the fake backend",
+    )
+    parser.add_argument(
+        "--replicas",
+        type=int,
+        default=1,
+        help="Run this many independent model replicas in worker processes and split every batch between them",
+    )
+    parser.add_argument(
+        "--tensor-parallel-size",
+        type=int,
+        default=None,
+        help="GPUs per replica (default: all visible GPUs, divided equally between --replicas)",
+    )
+    parser.add_argument(
+        "--num-nodes",
+        type=int,
+        default=1,
+        help="Number of nodes sharing the input and output folders; each processes every num-nodes-th file",
+    )
+    parser.add_argument("--node-rank", type=int, default=0, help="This node's rank, 0 to --num-nodes - 1")
+    parser.add_argument(
+        "--global-batch",
+        action="store_true",
+        help="Pool prompts from all files of all folders into shared generate calls",
+    )
+    parser.add_argument(
+        "--max-batch-prompts",
+        type=int,
+        default=None,
+        help="With --global-batch, cap the number of prompts per generate call",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        help="Generate and checkpoint each file this many prompts at a time",
+    )
+    parser.add_argument(
+        "--length-bucketed",
+        action="store_true",
+        help="Tokenize prompts up front and generate them in batches of similar length, longest first",
+    )
+    parser.add_argument(
+        "--max-batch-tokens",
+        type=int,
+        default=None,
+        help="Split generate calls into length-bucketed batches of at most this many prompt plus max_tokens tokens",
+    )
+    parser.add_argument(
+        "--max-prompt-tokens",
+        type=int,
+        default=None,
+        help="Truncate or reject prompts longer than this many tokens (see --prompt-overflow)",
+    )
+    parser.add_argument(
+        "--prompt-overflow",
+        choices=OVERFLOW_POLICIES,
+        default="truncate",
+        help="Cut over-long prompts in the middle, or skip them with an empty response",
+    )
+    parser.add_argument(
+        "--pretokenized",
+        action="store_true",
+        help="Send prompts as the token ids stored by `persona-impact pretokenize` for the model's tokenizer, "
+        "for files that have them",
+    )
+    parser.add_argument(
+        "--duplicates",
+        choices=DUPLICATE_POLICIES,
+        default="keep",
+        help="How to handle rows sharing the same key: keep all, keep first/last, or fail",
+    )
+    parser.add_argument(
+        "--output-compression",
+        choices=("none",) + COMPRESSIONS,
+        default=None,
+        help="Write outputs as .jsonl, .jsonl.gz or .jsonl.zst (default: like each input file)",
+    )
+    parser.add_argument(
+        "--pipelined",
+        action="store_true",
+        help="Overlap reading, generation and writing across all files, keeping "
+        "--max-in-flight requests submitted to the engine",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=256,
+        help="With --pipelined, the number of requests kept submitted to the engine",
+    )
+    parser.add_argument(
+        "--prefix-caching",
+        action="store_true",
+        help="Enable the engine's automatic prefix caching",
+    )
+    parser.add_argument(
+        "--prefix-grouped",
+        action="store_true",
+        help="Dispatch prompts grouped by shared prefix and report prefill savings",
+    )
+    parser.add_argument(
+        "--score-choices",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Instead of generating, score the answer labels 0..N-1 by log-likelihood "
+        "(multiple-choice prompts such as HellaSwag)",
+    )
+    parser.add_argument(
+        "--metrics",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Append per-file throughput and latency metrics to <output folder>-metrics.ndjson",
+    )
+    parser.add_argument(
+        "--prometheus-file",
+        default=None,
+        help="Also write the run's metrics to this file in Prometheus text format",
+    )
+    parser.add_argument(
+        "--prometheus-port",
+        type=int,
+        default=None,
+        help="Serve live metrics in Prometheus text format on this port while running",
+    )
+    parser.add_argument(
+        "--cache",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Reuse completions cached by earlier runs for the same model, sampling profile and prompt "
+        "(--no-cache for fresh samples)",
+    )
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Directory of the generation cache")
+    parser.add_argument(
+        "--cache-size-gb",
+        type=float,
+        default=DEFAULT_MAX_BYTES / 1024**3,
+        help="Evict the least recently used completions beyond this size",
+    )
+    parser.add_argument(
+        "--profiles",
+        default=None,
+        metavar="CONFIG",
+        help="JSON file with extra sampling profiles and a folder -> profile mapping",
+    )
+    parser.add_argument(
+        "--profile",
+        default="auto",
+        help="Sampling profile for every folder, or 'auto' to pick one per folder from its task",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only print each folder's sampling profile and pending files, without loading the model",
+    )
+
+    args = parser.parse_args()
+    choices = [str(i) for i in range(args.score_choices)] if args.score_choices else None
+    scheduler = None
+    if args.length_bucketed or args.max_batch_tokens or args.max_prompt_tokens:
+        scheduler = LengthScheduler(args.max_batch_tokens, args.max_prompt_tokens, args.prompt_overflow)
+    if args.pipelined and (args.global_batch or args.prefix_grouped or choices or scheduler is not None):
+        parser.error(
+            "--pipelined cannot be combined with --global-batch, --prefix-grouped, --score-choices "
+            "or length-bucketed batching"
+        )
+    if choices and scheduler is not None:
+        parser.error("--score-choices cannot be combined with length-bucketed batching")
+    if args.pretokenized and (args.pipelined or choices):
+        parser.error("--pretokenized cannot be combined with --pipelined or --score-choices")
+    if args.chunk_size is not None and (args.global_batch or args.pipelined):
+        parser.error("--chunk-size cannot be combined with --global-batch or --pipelined")
+    if args.max_batch_prompts is not None and not args.global_batch:
+        parser.error("--max-batch-prompts requires --global-batch")
+    # Token files record the tokenizer they were written with: the model's, or the stand-in's
+    pretokenized = ("fake" if args.backend == "fake" else args.model) if args.pretokenized else None
+    if args.backend == "vllm-async" and not args.pipelined:
+        parser.error("the vllm-async backend requires --pipelined")
+    if args.backend == "vllm-async" and args.replicas > 1:
+        parser.error("--replicas needs --backend vllm (replicas batch the requests of --pipelined themselves)")
+    if args.replicas < 1 or not 0 <= args.node_rank < args.num_nodes:
+        parser.error("--replicas must be positive and --node-rank between 0 and --num-nodes - 1")
+    shard = (args.node_rank, args.num_nodes) if args.num_nodes > 1 else None
+
+    profiles = ProfileSet(args.profiles)
+    # Folder -> profile name, grouped so each profile is batched on its own
+    folders_by_profile = {}
+    for input_folder in args.input_folders:
+        name = args.profile if args.profile != "auto" else profiles.profile_name(input_folder)
+        if name not in profiles.profiles:
+            parser.error(f"unknown sampling profile {name!r} for {input_folder}")
+        folders_by_profile.setdefault(name, []).append(input_folder)
+        print(f"{input_folder}: sampling profile {name!r}")
+
+    if args.dry_run:
+        for input_folder in args.input_folders:
+            files = assigned_files(input_folder, shard)
+            output_folder = output_folder_for(input_folder)
+            done = sum(os.path.exists(output_file_for(file, output_folder, args.output_compression)) for file in files)
+            print(f"{input_folder}: {len(files) - done} of {len(files)} files pending")
+        return
+
+    backend = build_backend(args)
+    cache = None
+    if args.cache and not choices:
+        cache = GenerationCache(args.cache_dir, int(args.cache_size_gb * 1024**3))
+        backend = CachedBackend(backend, cache)
+    decode_stats = DecodeStats()
+    metrics = None
+    if args.metrics or args.prometheus_file or args.prometheus_port:
+        metrics = MetricsRecorder(recorded_model(args.backend, args.model), backend.name)
+        if args.prometheus_port:
+            metrics.serve(args.prometheus_port)
+
+    for name, input_folders in folders_by_profile.items():
+        sampling = profiles[name]
+        if args.pipelined:
+            process_folders_pipelined(
+                backend,
+                sampling,
+                input_folders,
+                args.max_in_flight,
+                duplicates=args.duplicates,
+                decode_stats=decode_stats,
+                metrics=metrics,
+                output_compression=args.output_compression,
+                shard=shard,
+            )
+            continue
+
+        if args.global_batch:
+            process_folders_batched(
+                backend,
+                sampling,
+                input_folders,
+                args.max_batch_prompts,
+                prefix_grouped=args.prefix_grouped,
+                duplicates=args.duplicates,
+                choices=choices,
+                decode_stats=decode_stats,
+                metrics=metrics,
+                output_compression=args.output_compression,
+                shard=shard,
+                scheduler=scheduler,
+                pretokenized=pretokenized,
+            )
+            continue
+
+        for input_folder in input_folders:
+            process_folder(
+                backend,
+                sampling,
+                input_folder,
+                prefix_grouped=args.prefix_grouped,
+                chunk_size=args.chunk_size,
+                duplicates=args.duplicates,
+                choices=choices,
+                decode_stats=decode_stats,
+                metrics=metrics,
+                output_compression=args.output_compression,
+                shard=shard,
+                scheduler=scheduler,
+                pretokenized=pretokenized,
+            )
+
+    if scheduler is not None and scheduler.stats.n_prompts:
+        print(f"Length scheduling: {scheduler.stats.summary()}")
+    if decode_stats.n_prompts:
+        print(f"Decoding: {decode_stats.summary()}")
+    if cache is not None:
+        print(f"Generation cache: {cache.summary()}")
+        cache.close()
+    backend.close()
+    if metrics is not None and metrics.files:
+        run = metrics.close(args.prometheus_file)
+        print(
+            f"Throughput: {run['prompt_tokens_per_second']} prompt tokens/s, "
+            f"{run['output_tokens_per_second']} output tokens/s over {run['wall_seconds']:.2f}s"
+        )
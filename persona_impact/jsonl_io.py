@@ -0,0 +1,218 @@
+"""Transparent compressed JSONL files.
+
+Prompt and output files may be plain `.jsonl`, gzip `.jsonl.gz` or Zstandard
+`.jsonl.zst` (which needs the `zstandard` package); the format is chosen by the
+extension everywhere, for reading and writing alike.
+
+Writers compress on background threads so they do not hold up generation:
+gzip output is cut into blocks compressed in parallel as independent gzip
+members (like pigz), and Zstandard uses its own multi-threaded compressor.
+Every `flush()` ends the current member or frame, so an appended checkpoint
+file is a sequence of complete members and `complete_lines` can find the
+last one a crash did not tear.
+"""
+
+import gzip
+import io
+import os
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+SUFFIXES = {".jsonl": None, ".jsonl.gz": "gz", ".jsonl.zst": "zst"}
+COMPRESSIONS = ("gz", "zst")
+COMPRESS_THREADS = min(4, os.cpu_count() or 1)
+# Uncompressed bytes per parallel gzip member
+GZIP_BLOCK_SIZE = 1 << 20
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def jsonl_suffix(file_name: str) -> str | None:
+    """The JSONL suffix of `file_name` (".jsonl", ".jsonl.gz" or ".jsonl.zst"), or None."""
+    for suffix in SUFFIXES:
+        if file_name.endswith(suffix):
+            return suffix
+    return None
+
+
+def is_jsonl(file_name: str) -> bool:
+    return jsonl_suffix(file_name) is not None
+
+
+def compression_of(file_name: str) -> str | None:
+    """"gz", "zst" or None, by extension."""
+    return SUFFIXES.get(jsonl_suffix(file_name))
+
+
+def with_compression(file_name: str, compression: str | None) -> str:
+    """`file_name` with its JSONL suffix replaced by the one of `compression`."""
+    suffix = jsonl_suffix(file_name)
+    if suffix is None:
+        raise ValueError(f"{file_name} is not a .jsonl file")
+    return file_name[: -len(suffix)] + ".jsonl" + (f".{compression}" if compression else "")
+
+
+def jsonl_files(folder: str, recursive: bool = False) -> list[str]:
+    """Paths of the JSONL files (of any compression) in `folder`."""
+    if not recursive:
+        return [os.path.join(folder, file) for file in os.listdir(folder) if is_jsonl(file)]
+    return [
+        os.path.join(root, file) for root, _, files in os.walk(folder) for file in files if is_jsonl(file)
+    ]
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError as error:
+        raise ImportError("Reading or writing .jsonl.zst files needs the zstandard package") from error
+    return zstandard
+
+
+class _ParallelGzipWriter(io.RawIOBase):
+    """Binary writer that compresses GZIP_BLOCK_SIZE blocks as gzip members on a thread pool."""
+
+    def __init__(self, file):
+        self.file = file
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.pool = ThreadPoolExecutor(COMPRESS_THREADS)
+
+    def writable(self):
+        return True
+
+    def write(self, data) -> int:
+        self.buffer += data
+        while len(self.buffer) >= GZIP_BLOCK_SIZE:
+            self._submit(bytes(self.buffer[:GZIP_BLOCK_SIZE]))
+            del self.buffer[:GZIP_BLOCK_SIZE]
+        return len(data)
+
+    def _submit(self, block: bytes):
+        # zlib releases the GIL, so blocks are compressed in parallel
+        self.pending.append(self.pool.submit(gzip.compress, block, GZIP_LEVEL, mtime=0))
+        while len(self.pending) > 2 * COMPRESS_THREADS:
+            self.file.write(self.pending.popleft().result())
+
+    def flush(self):
+        if self.closed:
+            return
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self.file.write(self.pending.popleft().result())
+        self.file.flush()
+
+    def fileno(self) -> int:
+        return self.file.fileno()
+
+    def close(self):
+        if not self.closed:
+            super().close()  # Flushes
+            self.pool.shutdown()
+            self.file.close()
+
+
+class _ZstdWriter(io.RawIOBase):
+    """Binary writer over a multi-threaded Zstandard compressor; flush() ends the frame."""
+
+    def __init__(self, file):
+        zstandard = _zstandard()
+        self.file = file
+        self.flush_frame = zstandard.FLUSH_FRAME
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=COMPRESS_THREADS)
+        self.writer = compressor.stream_writer(file, closefd=False)
+
+    def writable(self):
+        return True
+
+    def write(self, data) -> int:
+        self.writer.write(data)
+        return len(data)
+
+    def flush(self):
+        if self.closed:
+            return
+        self.writer.flush(self.flush_frame)
+        self.file.flush()
+
+    def fileno(self) -> int:
+        return self.file.fileno()
+
+    def close(self):
+        if not self.closed:
+            super().close()  # Flushes
+            self.writer.close()
+            self.file.close()
+
+
+def open_jsonl(file_name: str, mode: str = "r", format_name: str | None = None):
+    """Open a (possibly compressed) JSONL file like `open`.
+
+    `mode` is one of "r", "w" and "a", optionally with "b" for bytes; text is
+    UTF-8. The compression follows the extension of `format_name` (default:
+    `file_name`), e.g. the final name of a `.partial` checkpoint.
+    """
+    binary = "b" in mode
+    mode = mode.replace("b", "").replace("t", "")
+    if mode not in ("r", "w", "a"):
+        raise ValueError(f"Unsupported mode {mode!r}")
+
+    compression = compression_of(format_name or file_name)
+    if compression is None:
+        return open(file_name, mode + "b") if binary else open(file_name, mode, encoding="utf-8")
+
+    if mode == "r" and compression == "gz":
+        stream = gzip.open(file_name, "rb")
+    elif mode == "r":
+        raw = open(file_name, "rb")
+        stream = io.BufferedReader(_zstandard().ZstdDecompressor().stream_reader(raw, read_across_frames=True))
+    else:
+        raw = open(file_name, mode + "b")
+        stream = _ParallelGzipWriter(raw) if compression == "gz" else _ZstdWriter(raw)
+
+    if binary:
+        return stream
+    # Line buffering would end a member per row; flush() is left to the caller
+    return io.TextIOWrapper(stream, encoding="utf-8", write_through=True)
+
+
+def _decompressor(compression: str):
+    if compression == "gz":
+        return zlib.decompressobj(wbits=31)
+    return _zstandard().ZstdDecompressor().decompressobj()
+
+
+def complete_lines(file_name: str, format_name: str | None = None, block_size: int = 1 << 20):
+    """Yield (end offset, lines) for every complete run of members of a compressed file.
+
+    A run ends at the first member boundary that is also a line boundary, and
+    its end offset is where the file can be truncated to drop a torn tail.
+    """
+    compression = compression_of(format_name or file_name)
+    decompressor = _decompressor(compression)
+    offset = 0  # compressed bytes fed to the decompressor
+    data = bytearray()  # decompressed bytes since the last yielded run
+
+    with open(file_name, "rb") as file:
+        tail = b""
+        while True:
+            block = tail or file.read(block_size)
+            tail = b""
+            if not block:
+                return
+            data += decompressor.decompress(block)
+            if not decompressor.eof:
+                offset += len(block)
+                continue
+
+            # A member ended inside this block; the rest starts the next member
+            tail = decompressor.unused_data
+            offset += len(block) - len(tail)
+            decompressor = _decompressor(compression)
+            # Empty members (e.g. the last frame Zstandard writes on close) are complete too
+            if not data or data.endswith(b"\n"):
+                yield offset, bytes(data).splitlines()
+                data.clear()
@@ -0,0 +1,266 @@
+"""Per-request, per-file and per-run throughput and latency metrics.
+
+Every generated file gets a row with its prompt and output token counts,
+model time, wall time, token throughput and queueing, time-to-first-token and
+latency percentiles (from vLLM's `RequestOutput.metrics`; the fake backend
+reports simulated timings). Rows are appended as JSON lines to
+`<output folder>-metrics.ndjson`, next to the output folder and not named
+`.jsonl` so the evaluators' `**/*.jsonl` globs never pick it up, followed at
+the end of the run by one row per folder and one for the whole run. The same
+totals can be written in Prometheus text format to a file (for node_exporter's
+textfile collector) or served live over HTTP.
+
+Prompts answered from the generation cache are counted in `n_cached` and left
+out of the token counts, so throughput only reflects what the model decoded.
+
+When several files share a generate call, its model time is split between them
+by their number of prompts. Pipelined runs overlap requests, so they report no
+per-file model time.
+"""
+
+import math
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import ujson as json
+
+from persona_impact.backends import Completion
+
+METRICS_SUFFIX = "-metrics.ndjson"
+
+
+def metrics_path(output_folder: str) -> str:
+    return output_folder.rstrip("/") + METRICS_SUFFIX
+
+
+def recorded_model(backend: str, model: str) -> str:
+    """The model name a run's rows are recorded under; fake runs are kept apart from the model they stand in for."""
+    return f"fake:{model}" if backend == "fake" else model
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    """Nearest-rank percentile, or None without values."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(math.ceil(q / 100 * len(values)), 1) - 1]
+
+
+def _percentile(values: list[float], q: float) -> float | None:
+    value = percentile(values, q)
+    return None if value is None else round(value, 4)
+
+
+def _rate(count: float, seconds: float | None) -> float | None:
+    return round(count / seconds, 2) if seconds else None
+
+
+@dataclass
+class FileMetrics:
+    file: str
+    output_folder: str
+    n_prompts: int = 0
+    # Prompts answered without decoding, whose tokens are not counted (see `Completion.cached`)
+    n_cached: int = 0
+    prompt_tokens: int = 0
+    output_tokens: int = 0
+    model_seconds: float | None = 0.0
+    started: float = field(default_factory=time.perf_counter)
+    wall_seconds: float | None = None
+    queue_seconds: list[float] = field(default_factory=list)
+    first_token_seconds: list[float] = field(default_factory=list)
+    latency_seconds: list[float] = field(default_factory=list)
+
+    def record(self, n_prompts: int, completions: list[Completion] | None = None, model_seconds: float | None = None):
+        """Add `n_prompts` answered prompts, their completions (None when scoring) and model time."""
+        self.n_prompts += n_prompts
+        if model_seconds is None:
+            self.model_seconds = None
+        elif self.model_seconds is not None:
+            self.model_seconds += model_seconds
+        for completion in completions or ():
+            if completion.cached:
+                self.n_cached += 1
+                continue
+            self.prompt_tokens += completion.prompt_tokens
+            self.output_tokens += completion.output_tokens
+            if completion.queue_seconds is not None:
+                self.queue_seconds.append(completion.queue_seconds)
+            if completion.first_token_seconds is not None:
+                self.first_token_seconds.append(completion.first_token_seconds)
+            if completion.latency_seconds is not None:
+                self.latency_seconds.append(completion.latency_seconds)
+
+    def finish(self):
+        self.wall_seconds = time.perf_counter() - self.started
+
+    def elapsed(self) -> float:
+        return self.wall_seconds if self.wall_seconds is not None else time.perf_counter() - self.started
+
+    def row(self) -> dict:
+        wall_seconds = self.elapsed()
+        return {
+            "level": "file",
+            "file": self.file,
+            "n_prompts": self.n_prompts,
+            "n_cached": self.n_cached,
+            "prompt_tokens": self.prompt_tokens,
+            "output_tokens": self.output_tokens,
+            "wall_seconds": round(wall_seconds, 4),
+            "model_seconds": None if self.model_seconds is None else round(self.model_seconds, 4),
+            "host_seconds": None if self.model_seconds is None else round(wall_seconds - self.model_seconds, 4),
+            "prompt_tokens_per_second": _rate(self.prompt_tokens, wall_seconds),
+            "output_tokens_per_second": _rate(self.output_tokens, wall_seconds),
+            "queue_seconds_p50": _percentile(self.queue_seconds, 50),
+            "first_token_seconds_p50": _percentile(self.first_token_seconds, 50),
+            "first_token_seconds_p95": _percentile(self.first_token_seconds, 95),
+            "latency_seconds_p50": _percentile(self.latency_seconds, 50),
+            "latency_seconds_p95": _percentile(self.latency_seconds, 95),
+        }
+
+
+def _summary(level: str, name: str, files: list[FileMetrics], wall_seconds: float | None = None) -> dict:
+    if wall_seconds is None:
+        # From the first file started to the last one finished
+        wall_seconds = max(f.started + f.elapsed() for f in files) - min(f.started for f in files)
+    prompt_tokens = sum(f.prompt_tokens for f in files)
+    output_tokens = sum(f.output_tokens for f in files)
+    model_seconds = [f.model_seconds for f in files]
+    return {
+        "level": level,
+        level: name,
+        "n_files": len(files),
+        "n_prompts": sum(f.n_prompts for f in files),
+        "n_cached": sum(f.n_cached for f in files),
+        "prompt_tokens": prompt_tokens,
+        "output_tokens": output_tokens,
+        "wall_seconds": round(wall_seconds, 4),
+        "model_seconds": None if None in model_seconds else round(sum(model_seconds), 4),
+        "prompt_tokens_per_second": _rate(prompt_tokens, wall_seconds),
+        "output_tokens_per_second": _rate(output_tokens, wall_seconds),
+        "first_token_seconds_p50": _percentile([s for f in files for s in f.first_token_seconds], 50),
+        "latency_seconds_p95": _percentile([s for f in files for s in f.latency_seconds], 95),
+    }
+
+
+class MetricsRecorder:
+    """Collects the file metrics of one run of one model."""
+
+    def __init__(self, model: str, backend: str):
+        self.model = model
+        self.backend = backend
+        self.run_id = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.started = time.perf_counter()
+        self.files: list[FileMetrics] = []
+        self._lock = threading.Lock()
+
+    def file(self, input_file: str, output_folder: str) -> FileMetrics:
+        metrics = FileMetrics(os.path.basename(input_file), output_folder)
+        with self._lock:
+            self.files.append(metrics)
+        return metrics
+
+    def _context(self) -> dict:
+        return {"run_id": self.run_id, "model": self.model, "backend": self.backend}
+
+    def commit_file(self, metrics: FileMetrics):
+        metrics.finish()
+        with open(metrics_path(metrics.output_folder), "a") as file:
+            file.write(json.dumps({**self._context(), "output_folder": metrics.output_folder, **metrics.row()}) + "\n")
+
+    def close(self, prometheus_file: str | None = None) -> dict:
+        """Append the per-folder and per-run summaries and return the run summary."""
+        wall_seconds = time.perf_counter() - self.started
+        by_folder = {}
+        for metrics in self.files:
+            by_folder.setdefault(metrics.output_folder, []).append(metrics)
+
+        run = {**self._context(), **_summary("run", self.run_id, self.files, wall_seconds)}
+        for output_folder, files in by_folder.items():
+            with open(metrics_path(output_folder), "a") as file:
+                file.write(json.dumps({**self._context(), **_summary("folder", output_folder, files)}) + "\n")
+                file.write(json.dumps(run) + "\n")
+
+        if prometheus_file is not None:
+            tmp_path = prometheus_file + ".tmp"
+            with open(tmp_path, "w") as file:
+                file.write(self.prometheus())
+            os.replace(tmp_path, prometheus_file)
+        return run
+
+    def prometheus(self) -> str:
+        """Totals per output folder in the Prometheus text exposition format."""
+        return merge_prometheus([self])
+
+    def serve(self, port: int) -> ThreadingHTTPServer:
+        """Serve `prometheus()` on http://0.0.0.0:port/metrics from a daemon thread."""
+        recorder = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = recorder.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+# (name, type, help, value of a list of FileMetrics)
+PROMETHEUS_SERIES = [
+    ("persona_impact_files_total", "counter", "Generated files", lambda fs: sum(f.wall_seconds is not None for f in fs)),
+    ("persona_impact_prompts_total", "counter", "Answered prompts", lambda fs: sum(f.n_prompts for f in fs)),
+    ("persona_impact_cached_prompts_total", "counter", "Prompts answered without decoding", lambda fs: sum(f.n_cached for f in fs)),
+    ("persona_impact_prompt_tokens_total", "counter", "Prefilled prompt tokens", lambda fs: sum(f.prompt_tokens for f in fs)),
+    ("persona_impact_output_tokens_total", "counter", "Generated tokens", lambda fs: sum(f.output_tokens for f in fs)),
+    ("persona_impact_wall_seconds_total", "counter", "Wall time spent on files", lambda fs: sum(f.elapsed() for f in fs)),
+    ("persona_impact_model_seconds_total", "counter", "Model time spent on files", lambda fs: sum(f.model_seconds or 0.0 for f in fs)),
+    (
+        "persona_impact_first_token_seconds_p50",
+        "gauge",
+        "Median time to first token",
+        lambda fs: percentile([s for f in fs for s in f.first_token_seconds], 50),
+    ),
+    (
+        "persona_impact_latency_seconds_p95",
+        "gauge",
+        "95th percentile request latency",
+        lambda fs: percentile([s for f in fs for s in f.latency_seconds], 95),
+    ),
+]
+
+
+def merge_prometheus(recorders: list[MetricsRecorder]) -> str:
+    """Prometheus text exposition of several recorders, one sample per model and output folder."""
+    groups = []
+    for recorder in recorders:
+        with recorder._lock:
+            files = list(recorder.files)
+        by_folder = {}
+        for metrics in files:
+            by_folder.setdefault(metrics.output_folder, []).append(metrics)
+        groups.extend((recorder.model, output_folder, folder_files) for output_folder, folder_files in by_folder.items())
+
+    lines = []
+    for name, kind, help_text, value in PROMETHEUS_SERIES:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for model, output_folder, folder_files in groups:
+            sample = value(folder_files)
+            if sample is not None:
+                lines.append(f'{name}{{model="{_escape(model)}",folder="{_escape(output_folder)}"}} {sample}')
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,360 @@
+import os
+import time
+
+from tqdm import tqdm
+
+from persona_impact.backends import Backend, SamplingConfig
+from persona_impact.checkpoint import CheckpointWriter, load_completed_keys
+from persona_impact.jsonl_io import jsonl_files, with_compression
+from persona_impact.metrics import MetricsRecorder
+from persona_impact.prefix import PrefixStats, generate_prefix_grouped
+from persona_impact.profiles import DecodeStats
+from persona_impact.reader import IndexedJsonl
+from persona_impact.scheduler import LengthScheduler
+
+
+def filenames_in_a_folder(folder_path: str):
+    # Plain, gzip and Zstandard JSONL files
+    return jsonl_files(folder_path)
+
+
+def output_folder_for(input_folder: str, output_root: str | None = None):
+    return os.path.join(output_root or "", f"{input_folder.rstrip('/').split('/')[-1]}-output")
+
+
+def output_file_for(input_file: str, output_folder: str, output_compression: str | None = None) -> str:
+    """Outputs keep their input's compression unless `output_compression` ("none", "gz" or "zst") is given."""
+    name = os.path.basename(input_file)
+    if output_compression is not None:
+        name = with_compression(name, None if output_compression == "none" else output_compression)
+    return os.path.join(output_folder, name)
+
+
+def assigned_files(input_folder: str, shard: tuple[int, int] | None = None) -> list[str]:
+    """Input files of `input_folder` in name order.
+
+    With `shard=(rank, count)`, only every count-th file from the rank-th is
+    returned, so that `count` nodes sharing the input and output folders each
+    run a disjoint part of them.
+    """
+    files = sorted(filenames_in_a_folder(input_folder))
+    return files if shard is None else files[shard[0] :: shard[1]]
+
+
+def pending_files(
+    input_folders: list[str],
+    output_root: str | None = None,
+    output_compression: str | None = None,
+    shard: tuple[int, int] | None = None,
+):
+    """Yield (input_file, output_file) for every assigned file (see `assigned_files`) that has no output yet."""
+    for input_folder in input_folders:
+        output_folder = output_folder_for(input_folder, output_root)
+        if not os.path.exists(output_folder):
+            os.makedirs(output_folder)
+
+        for file in assigned_files(input_folder, shard):
+            output_file = output_file_for(file, output_folder, output_compression)
+            if os.path.exists(output_file):
+                print(f"Skipping {file} as the output file {output_file} already exists.")
+                continue
+            yield file, output_file
+
+
+class _FileJob:
+    """Prompts of one input file that still need a response, and their checkpoint."""
+
+    def __init__(
+        self,
+        input_file: str,
+        output_file: str,
+        duplicates: str = "keep",
+        metrics: MetricsRecorder | None = None,
+        pretokenized: str | None = None,
+    ):
+        self.recorder = metrics
+        self.metrics = metrics.file(input_file, os.path.dirname(output_file)) if metrics is not None else None
+        self.reader = IndexedJsonl(input_file, duplicates=duplicates)
+        if self.reader.n_duplicates:
+            print(f"{input_file}: {self.reader.n_duplicates} rows with a duplicate key ({duplicates})")
+
+        completed = load_completed_keys(output_file)
+        if completed:
+            print(
+                f"Resuming {input_file}: {sum(completed.values())} of {len(self.reader)} prompts already generated"
+            )
+        # Rows are generated in sorted order, so resuming only appends the
+        # remaining suffix and the final file stays sorted.
+        self.pending = [
+            i
+            for i in self.reader.order
+            if self.reader.occurrences[i] >= completed[self.reader.keys[i]]
+        ]
+        self.remaining = len(self.pending)
+        self.writer = CheckpointWriter(output_file)
+        self.token_ids = None
+        if pretokenized is not None:
+            from persona_impact.pretokenize import load_token_ids
+
+            self.token_ids = load_token_ids(input_file, pretokenized)
+
+    def prompt_token_ids(self, rows: list[int]) -> list[list[int] | None] | None:
+        """Stored token ids of index positions `rows`, or None without a token file."""
+        if self.token_ids is None:
+            return None
+        return [self.token_ids.get(self.reader.offsets[i]) for i in rows]
+
+    def append(self, entries: list, results: list, completions: list | None = None, model_seconds: float | None = None):
+        for entry, result in zip(entries, results):
+            entry.update(result)
+        self.writer.append(entries)
+        if self.metrics is not None:
+            self.metrics.record(len(entries), completions, model_seconds)
+        self.remaining -= len(entries)
+        if self.remaining == 0:
+            self.commit()
+
+    def commit(self):
+        self.writer.commit()
+        self.reader.close()
+        if self.metrics is not None:
+            self.recorder.commit_file(self.metrics)
+
+
+def _chunks(items: list, size: int | None):
+    size = size or len(items) or 1
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def process_folders_batched(
+    backend: Backend,
+    sampling: SamplingConfig,
+    input_folders: list[str],
+    max_batch_prompts: int | None = None,
+    prefix_grouped: bool = False,
+    duplicates: str = "keep",
+    choices: list[str] | None = None,
+    decode_stats: DecodeStats | None = None,
+    output_root: str | None = None,
+    metrics: MetricsRecorder | None = None,
+    output_compression: str | None = None,
+    shard: tuple[int, int] | None = None,
+    scheduler: LengthScheduler | None = None,
+    pretokenized: str | None = None,
+):
+    """Generate prompts from every file of every folder in shared batches.
+
+    Prompts are pooled across files so the engine always sees a full batch
+    instead of ramping up and draining once per persona file. Responses are
+    routed back to their file's checkpoint after every call, and a file is
+    committed as soon as all of its prompts are answered, in the same key order
+    as `process_folder`. `max_batch_prompts=None` submits the whole sweep in a
+    single call. With `prefix_grouped`, each call is dispatched in
+    prefix-grouped order. `choices` switches to log-likelihood scoring and
+    `decode_stats` accumulates decoded tokens (see `process_folder`).
+    Output folders are created under `output_root` (default: the working
+    directory). `metrics` records per-file throughput and latency.
+    `output_compression`, `shard`, `scheduler` and `pretokenized` are as in
+    `process_folder`.
+    """
+    print(f"Processing files in {', '.join(input_folders)} with cross-file batching")
+
+    start = time.perf_counter()
+    model_seconds = backend.generate_seconds
+    queue = []  # (job, row) pairs waiting for generation
+    n_files = 0
+    prefix_stats = PrefixStats()
+
+    def flush(limit):
+        batch, queue[:] = queue[:limit], queue[limit:]
+        entries = [job.reader.entry(i) for job, i in batch]
+        token_ids = [(job.prompt_token_ids([i]) or [None])[0] for job, i in batch]
+        completions = []
+        call_seconds = backend.generate_seconds
+        results = run_prompts(
+            backend,
+            [job.reader.prompt(entry) for (job, _), entry in zip(batch, entries)],
+            sampling,
+            prefix_stats if prefix_grouped else None,
+            choices,
+            decode_stats,
+            completions,
+            scheduler,
+            token_ids if any(ids is not None for ids in token_ids) else None,
+        )
+        call_seconds = backend.generate_seconds - call_seconds
+        # Batches hold contiguous runs of each file's rows; append run by run
+        per_job = {}
+        for n, ((job, _), entry, result) in enumerate(zip(batch, entries, results)):
+            job_entries, job_results, job_completions = per_job.setdefault(job, ([], [], []))
+            job_entries.append(entry)
+            job_results.append(result)
+            if completions:
+                job_completions.append(completions[n])
+        for job, (job_entries, job_results, job_completions) in per_job.items():
+            # The call's model time is split by each file's share of its prompts
+            job.append(job_entries, job_results, job_completions, call_seconds * len(job_entries) / len(batch))
+
+    for file, output_file in tqdm(list(pending_files(input_folders, output_root, output_compression, shard))):
+        job = _FileJob(file, output_file, duplicates, metrics, pretokenized)
+        n_files += 1
+        if job.remaining == 0:
+            job.commit()
+            continue
+
+        queue.extend((job, i) for i in job.pending)
+        while max_batch_prompts and len(queue) >= max_batch_prompts:
+            flush(max_batch_prompts)
+
+    if queue:
+        flush(len(queue))
+
+    total_seconds = time.perf_counter() - start
+    model_seconds = backend.generate_seconds - model_seconds
+    print(
+        f"Finished {n_files} files in {total_seconds:.2f}s "
+        f"(model {model_seconds:.2f}s, host overhead {total_seconds - model_seconds:.2f}s)"
+    )
+    if prefix_grouped:
+        print(f"Prefix sharing: {prefix_stats.summary()}")
+
+
+def run_prompts(
+    backend,
+    prompt_texts,
+    sampling,
+    prefix_stats=None,
+    choices=None,
+    decode_stats=None,
+    completions=None,
+    scheduler=None,
+    prompt_token_ids=None,
+):
+    """Return, per prompt, the fields to add to its output row.
+
+    The backend's `Completion`s are appended to the `completions` list, when
+    given (nothing is appended when scoring choices). With a `scheduler`,
+    prompts are generated in length-bucketed batches (see `LengthScheduler`).
+    `prompt_token_ids` holds the pre-tokenized ids of the prompts (or None
+    per prompt), which the backend uses instead of tokenizing them.
+    """
+    if choices is not None:
+        return [
+            {"llm_scores": scores, "llm_label": label, "llm_response": str(label)}
+            for scores, label in (
+                (scores, max(range(len(scores)), key=scores.__getitem__))
+                for scores in backend.score_continuations(prompt_texts, choices)
+            )
+        ]
+
+    overflows = None
+    if scheduler is not None:
+        responses, overflows = scheduler.generate(backend, prompt_texts, sampling, prefix_stats, prompt_token_ids)
+    elif prefix_stats is None:
+        responses = backend.generate(prompt_texts, sampling, prompt_token_ids)
+    else:
+        responses = generate_prefix_grouped(
+            backend, prompt_texts, sampling, prefix_stats, prompt_token_ids=prompt_token_ids
+        )
+    if decode_stats is not None:
+        decode_stats.add(sampling, [response.output_tokens for response in responses if not response.cached])
+    if completions is not None:
+        completions.extend(responses)
+    results = [{"llm_response": response.text} for response in responses]
+    # Truncated or rejected prompts say so in their row
+    for result, overflow in zip(results, overflows or ()):
+        if overflow is not None:
+            result.update(overflow)
+    return results
+
+
+def process_folder(
+    backend: Backend,
+    sampling: SamplingConfig,
+    input_folder: str,
+    prefix_grouped: bool = False,
+    chunk_size: int | None = None,
+    duplicates: str = "keep",
+    choices: list[str] | None = None,
+    decode_stats: DecodeStats | None = None,
+    output_root: str | None = None,
+    metrics: MetricsRecorder | None = None,
+    output_compression: str | None = None,
+    shard: tuple[int, int] | None = None,
+    scheduler: LengthScheduler | None = None,
+    pretokenized: str | None = None,
+):
+    """Generate every pending file of `input_folder`, `chunk_size` prompts at a time.
+
+    Each chunk is appended to the file's checkpoint as soon as it is generated,
+    so an interrupted run resumes from the last completed chunk.
+    `chunk_size=None` submits each file as a single chunk. `duplicates` is the
+    `IndexedJsonl` policy for rows sharing a key.
+
+    With `choices` (e.g. the HellaSwag labels "0".."3") nothing is decoded:
+    each choice is scored by its log-likelihood as a continuation of the
+    prompt, and rows get the per-choice `llm_scores`, the argmax `llm_label`
+    and that label as `llm_response`.
+
+    `decode_stats`, when given, accumulates the decoded tokens and the token
+    budget of `sampling` across calls. The output folder is created under
+    `output_root` (default: the working directory). `metrics` records the
+    throughput and latency of every file. Outputs are compressed like their
+    input file unless `output_compression` is "none", "gz" or "zst". With
+    `shard=(rank, count)`, only this node's share of the files is processed
+    (see `assigned_files`). A `scheduler` generates each chunk in
+    token-length-bucketed batches under its token budgets. With
+    `pretokenized` (a tokenizer name), files with a token file written for that
+    tokenizer (see `persona_impact.pretokenize`) send their prompts to the
+    backend as token ids.
+    """
+    output_folder = output_folder_for(input_folder, output_root)
+
+    print(
+        f"Processing files in {input_folder}. Output will be saved in {output_folder}"
+    )
+
+    start = time.perf_counter()
+    model_seconds = backend.generate_seconds
+    prefix_stats = PrefixStats()
+
+    # Iterate through the input files that have no complete output yet
+    for file, output_file in tqdm(list(pending_files([input_folder], output_root, output_compression, shard))):
+        # Index the prompts of the .jsonl file, minus those already checkpointed
+        job = _FileJob(file, output_file, duplicates, metrics, pretokenized)
+        if job.remaining == 0:
+            job.commit()
+            continue
+
+        for rows in _chunks(job.pending, chunk_size):
+            entries = [job.reader.entry(i) for i in rows]
+            prompt_texts = [job.reader.prompt(entry) for entry in entries]
+
+            # Generate (or score) the continuation
+            completions = []
+            call_seconds = backend.generate_seconds
+            results = run_prompts(
+                backend,
+                prompt_texts,
+                sampling,
+                prefix_stats if prefix_grouped else None,
+                choices,
+                decode_stats,
+                completions,
+                scheduler,
+                job.prompt_token_ids(rows),
+            )
+            call_seconds = backend.generate_seconds - call_seconds
+
+            # Add the continuation to the prompts and append them to the checkpoint
+            job.append(entries, results, completions, call_seconds)
+
+    total_seconds = time.perf_counter() - start
+    model_seconds = backend.generate_seconds - model_seconds
+    print(
+        f"Finished {input_folder} in {total_seconds:.2f}s "
+        f"(model {model_seconds:.2f}s, host overhead {total_seconds - model_seconds:.2f}s)"
+    )
+    if prefix_grouped:
+        print(f"Prefix sharing: {prefix_stats.summary()}")
@@ -0,0 +1,466 @@
+"""Sweep cost planning.
+
+Before any model is loaded, `persona-impact plan` estimates what a sweep will
+need, for every model x sampling profile x input folder:
+
+- prompts and prompt tokens per file, exact from a current token file (see
+  `persona_impact.pretokenize`) or from a sample of `sample_rows` prompts;
+- the decode budget (the profile's `max_tokens` per prompt) and the expected
+  decode tokens, from the output tokens per prompt earlier runs of the folder
+  recorded in their `-metrics.ndjson` files;
+- model time, from seconds per prompt and per output token fitted to the file
+  rows of earlier runs of the same model (by least squares, per replica);
+- model weights and KV-cache bytes per token, from the model's `config.json`,
+  and from these the replica / tensor-parallel layout: the one with the most
+  replicas whose KV pool per replica still holds the longest request and
+  `MIN_RESIDENT_REQUESTS` average ones. Runtime is assumed to scale with the
+  number of replicas.
+
+The result is written as a sweep plan (see `persona_impact.sweep`) with the
+recommended `replicas`, `tensor_parallel_size` and `max_batch_tokens` (the KV
+pool of a replica, so that a length-bucketed batch stays resident) and the
+estimates under `estimate`, so it can be reviewed and then run as is:
+
+    persona-impact plan prompts/hellaswag_v1 prompts/cnn_dm_v1 --models <model> --gpus 8 \\
+        --history sweep --output plan.json
+    persona-impact sweep plan.json
+"""
+
+import argparse
+import dataclasses
+import glob
+import os
+import random
+import re
+from dataclasses import dataclass
+
+import ujson as json
+
+from persona_impact.backends import load_tokenizer
+from persona_impact.data_parallel import visible_devices
+from persona_impact.jsonl_io import open_jsonl
+from persona_impact.metrics import METRICS_SUFFIX, recorded_model
+from persona_impact.pipeline import filenames_in_a_folder, output_folder_for
+from persona_impact.pretokenize import load_token_ids, token_file_for
+from persona_impact.profiles import ProfileSet
+from persona_impact.prompt_store import parse_header, render
+from persona_impact.sweep import SweepPlan, plan_jobs
+
+DEFAULT_SAMPLE_ROWS = 200
+DEFAULT_GPU_MEMORY_GB = 80.0
+# vLLM's default share of GPU memory for weights and KV cache
+DEFAULT_GPU_MEMORY_UTILIZATION = 0.9
+# Requests of average length a replica's KV pool must hold to keep decode batches full
+MIN_RESIDENT_REQUESTS = 32
+DTYPE_BYTES = {"float32": 4, "float16": 2, "bfloat16": 2}
+GB = 1024**3
+
+
+@dataclass
+class FileEstimate:
+    file: str
+    n_prompts: int
+    prompt_tokens: int
+    # Longest prompt counted; a lower bound when sampled
+    max_prompt_tokens: int
+    exact: bool
+
+
+def sample_prompts(file_name: str, sample_rows: int, seed: int = 0) -> tuple[int, list[str]]:
+    """The number of rows of a prompt file and the prompts of (at most) `sample_rows` of them, picked uniformly."""
+    rng = random.Random(seed)
+    header, lines, n_rows = None, [], 0
+    with open_jsonl(file_name, "r") as file:
+        for n, line in enumerate(file):
+            if not line.strip():
+                continue
+            if n == 0:
+                header = parse_header(json.loads(line))
+                if header is not None:
+                    continue
+            n_rows += 1
+            # Reservoir sampling: one pass, without parsing the rows left out
+            if len(lines) < sample_rows:
+                lines.append(line)
+            elif (j := rng.randrange(n_rows)) < sample_rows:
+                lines[j] = line
+
+    prompts = []
+    for line in lines:
+        entry = json.loads(line)
+        if header is not None:
+            prompts.append(render(header, entry))
+        else:
+            prompts.append(entry["prompt"] if "prompt" in entry else entry["llm_instruction"])
+    return n_rows, prompts
+
+
+def estimate_file(
+    file_name: str, tokenizer, tokenizer_name: str, sample_rows: int = DEFAULT_SAMPLE_ROWS
+) -> FileEstimate:
+    if os.path.exists(token_file_for(file_name)):
+        token_ids = load_token_ids(file_name, tokenizer_name)
+        if token_ids is not None:
+            lengths = token_ids.bounds[1:] - token_ids.bounds[:-1]
+            return FileEstimate(
+                file_name, len(lengths), int(lengths.sum()), int(lengths.max(initial=0)), exact=True
+            )
+
+    n_rows, prompts = sample_prompts(file_name, sample_rows)
+    lengths = [len(tokenizer.encode(prompt)) for prompt in prompts]
+    mean = sum(lengths) / len(lengths) if lengths else 0.0
+    return FileEstimate(file_name, n_rows, round(mean * n_rows), max(lengths, default=0), exact=len(lengths) == n_rows)
+
+
+def metrics_rows(paths: list[str]) -> list[dict]:
+    """File-level rows of the metrics files in `paths` (files, or folders searched recursively)."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "**", f"*{METRICS_SUFFIX}"), recursive=True)))
+        else:
+            files.append(path)
+    rows = []
+    for metrics_file in files:
+        with open(metrics_file, "r") as file:
+            rows.extend(row for row in map(json.loads, file) if row.get("level") == "file")
+    return rows
+
+
+def replicas_of(backend_name: str) -> int:
+    """Replicas of a recorded backend name ("vllm-dp4" ran 4)."""
+    match = re.search(r"-dp(\d+)$", backend_name)
+    return int(match.group(1)) if match else 1
+
+
+@dataclass
+class Throughput:
+    """Model seconds of one replica per prompt (prefill) token and per output (decode) token."""
+
+    seconds_per_prompt_token: float
+    seconds_per_output_token: float
+    n_files: int
+
+    @classmethod
+    def fit(cls, rows: list[dict]) -> "Throughput | None":
+        """Least-squares fit of model seconds = a * prompt tokens + b * output tokens, or None without data."""
+        samples = [
+            (row["prompt_tokens"], row["output_tokens"], row["model_seconds"] * replicas_of(row.get("backend", "")))
+            for row in rows
+            if row.get("model_seconds") and row["prompt_tokens"] + row["output_tokens"]
+        ]
+        if not samples:
+            return None
+        pp = sum(p * p for p, _, _ in samples)
+        po = sum(p * o for p, o, _ in samples)
+        oo = sum(o * o for _, o, _ in samples)
+        ps = sum(p * s for p, _, s in samples)
+        os_ = sum(o * s for _, o, s in samples)
+        seconds = sum(s for _, _, s in samples)
+        determinant = pp * oo - po * po
+        a = (ps * oo - os_ * po) / determinant if determinant else -1.0
+        b = (os_ * pp - ps * po) / determinant if determinant else -1.0
+        # Degenerate or negative fits fall back to charging all time to one kind of token
+        if a < 0 or b < 0:
+            output_tokens = sum(o for _, o, _ in samples)
+            if output_tokens:
+                a, b = 0.0, seconds / output_tokens
+            else:
+                a, b = seconds / sum(p for p, _, _ in samples), 0.0
+        return cls(a, b, len(samples))
+
+    def seconds(self, prompt_tokens: int, output_tokens: float) -> float:
+        return self.seconds_per_prompt_token * prompt_tokens + self.seconds_per_output_token * output_tokens
+
+
+def model_config(model: str) -> dict | None:
+    """The `config.json` of a local model directory or Hugging Face model, or None when unavailable."""
+    path = os.path.join(model, "config.json")
+    if os.path.exists(path):
+        with open(path, "r") as file:
+            return json.load(file)
+    try:
+        from transformers import AutoConfig
+
+        return AutoConfig.from_pretrained(model).to_dict()
+    except Exception:
+        return None
+
+
+@dataclass
+class ModelMemory:
+    weights_bytes: int
+    kv_bytes_per_token: int
+    # Tensor-parallel sizes must divide the attention heads
+    attention_heads: int | None = None
+
+    @classmethod
+    def from_config(cls, config: dict) -> "ModelMemory":
+        """Weights and KV-cache sizes of a decoder-only (optionally mixture-of-experts) transformer."""
+        hidden = config["hidden_size"]
+        layers = config["num_hidden_layers"]
+        heads = config["num_attention_heads"]
+        kv_heads = config.get("num_key_value_heads") or heads
+        head_dim = config.get("head_dim") or hidden // heads
+        experts = config.get("num_local_experts") or 1
+        dtype_bytes = DTYPE_BYTES.get(str(config.get("torch_dtype")), 2)
+        attention = 2 * hidden * heads * head_dim + 2 * hidden * kv_heads * head_dim
+        mlp = 3 * hidden * config["intermediate_size"] * experts
+        embeddings = (1 if config.get("tie_word_embeddings") else 2) * config["vocab_size"] * hidden
+        return cls(
+            weights_bytes=(layers * (attention + mlp) + embeddings) * dtype_bytes,
+            kv_bytes_per_token=2 * layers * kv_heads * head_dim * dtype_bytes,
+            attention_heads=heads,
+        )
+
+
+def choose_layout(
+    memory: ModelMemory,
+    gpus: int,
+    gpu_memory_bytes: float,
+    longest_request: int,
+    mean_request: float,
+    utilization: float = DEFAULT_GPU_MEMORY_UTILIZATION,
+) -> dict:
+    """The replicas x tensor-parallel layout with the most replicas whose KV pool fits the requests."""
+    candidates = []
+    tp = 1
+    while tp <= gpus:
+        if gpus % tp == 0 and (memory.attention_heads is None or memory.attention_heads % tp == 0):
+            pool_bytes = tp * gpu_memory_bytes * utilization - memory.weights_bytes
+            pool_tokens = max(int(pool_bytes // memory.kv_bytes_per_token), 0)
+            fits = pool_tokens >= max(longest_request, MIN_RESIDENT_REQUESTS * mean_request)
+            candidates.append(
+                {
+                    "replicas": gpus // tp,
+                    "tensor_parallel_size": tp,
+                    "kv_pool_tokens": pool_tokens,
+                    "kv_pool_gb": round(max(pool_bytes, 0) / GB, 2),
+                    "fits": fits,
+                }
+            )
+        tp *= 2
+    fitting = [candidate for candidate in candidates if candidate["fits"]]
+    # Data parallelism scales throughput without tensor-parallel communication
+    return fitting[0] if fitting else candidates[-1]
+
+
+def plan_costs(
+    plan: SweepPlan,
+    tokenizer_name: str | None = None,
+    sample_rows: int = DEFAULT_SAMPLE_ROWS,
+    history: list[str] = (),
+    gpus: int = 1,
+    gpu_memory_gb: float = DEFAULT_GPU_MEMORY_GB,
+    utilization: float = DEFAULT_GPU_MEMORY_UTILIZATION,
+) -> dict:
+    """Return `plan` as a dict with the recommended layout applied and the estimates under "estimate"."""
+    profiles = ProfileSet(plan.profile_config)
+    rows = metrics_rows(list(history))
+    files_by_tokenizer = {}
+    estimate = {"jobs": [], "models": {}}
+    layouts = []
+
+    for model in plan.models:
+        name = tokenizer_name or ("fake" if plan.backend == "fake" else model)
+        tokenizer = load_tokenizer(name)
+        model_rows = [row for row in rows if row.get("model") == recorded_model(plan.backend, model)]
+        throughput = Throughput.fit(model_rows)
+        jobs = [job for job in plan_jobs(plan, profiles) if job.model == model]
+        longest = prompts = request_tokens = largest_call = 0
+        seconds = 0.0 if throughput is not None else None
+
+        for job in jobs:
+            sampling = profiles[job.profile]
+            files = files_by_tokenizer.setdefault(name, {})
+            for file in sorted(filenames_in_a_folder(job.input_folder)):
+                if file not in files:
+                    files[file] = estimate_file(file, tokenizer, name, sample_rows)
+            folder_files = [files[file] for file in sorted(filenames_in_a_folder(job.input_folder))]
+            n_prompts = sum(f.n_prompts for f in folder_files)
+            prompt_tokens = sum(f.prompt_tokens for f in folder_files)
+            budget = n_prompts * sampling.max_tokens
+
+            # Output tokens per prompt of earlier runs of this folder, capped by the profile's budget
+            output_folder = os.path.basename(output_folder_for(job.input_folder))
+            recorded = [row for row in model_rows if os.path.basename(row.get("output_folder", "")) == output_folder]
+            recorded_prompts = sum(row["n_prompts"] - row.get("n_cached", 0) for row in recorded)
+            per_prompt = sum(row["output_tokens"] for row in recorded) / recorded_prompts if recorded_prompts else None
+            expected = n_prompts * min(per_prompt, sampling.max_tokens) if per_prompt is not None else budget
+
+            job_seconds = throughput.seconds(prompt_tokens, expected) if throughput is not None else None
+            estimate["jobs"].append(
+                {
+                    "model": model,
+                    "profile": job.profile,
+                    "input_folder": job.input_folder,
+                    "files": len(folder_files),
+                    "exact_files": sum(f.exact for f in folder_files),
+                    "prompts": n_prompts,
+                    "prompt_tokens": prompt_tokens,
+                    "max_prompt_tokens": max((f.max_prompt_tokens for f in folder_files), default=0),
+                    "output_budget_tokens": budget,
+                    "expected_output_tokens": round(expected),
+                    "replica_seconds": None if job_seconds is None else round(job_seconds, 1),
+                }
+            )
+            longest = max(longest, estimate["jobs"][-1]["max_prompt_tokens"] + sampling.max_tokens)
+            # Without chunking, each file is submitted as one generate call
+            for f in folder_files:
+                largest_call = max(largest_call, f.prompt_tokens + f.n_prompts * sampling.max_tokens)
+            prompts += n_prompts
+            request_tokens += prompt_tokens + budget
+            if job_seconds is not None:
+                seconds += job_seconds
+
+        model_estimate = {
+            "tokenizer": name,
+            "throughput": None if throughput is None else dataclasses.asdict(throughput),
+            "replica_seconds": None if seconds is None else round(seconds, 1),
+        }
+        config = model_config(model) if plan.backend != "fake" else None
+        if config is not None:
+            memory = ModelMemory.from_config(config)
+            layout = choose_layout(
+                memory, gpus, gpu_memory_gb * GB, longest, request_tokens / prompts if prompts else 0, utilization
+            )
+            layouts.append(layout)
+            model_estimate["weights_gb"] = round(memory.weights_bytes / GB, 2)
+            model_estimate["kv_bytes_per_token"] = memory.kv_bytes_per_token
+            model_estimate["layout"] = layout
+            # KV cache the largest file call needs to keep all of its requests resident
+            model_estimate["kv_gb_per_file_call"] = round(largest_call * memory.kv_bytes_per_token / GB, 2)
+            replicas = layout["replicas"]
+        else:
+            replicas = plan.replicas
+        model_estimate["seconds"] = None if seconds is None else round(seconds / replicas, 1)
+        estimate["models"][model] = model_estimate
+
+    planned = dataclasses.asdict(plan)
+    if layouts:
+        # One layout runs every model of the sweep: the one the largest model needs
+        layout = max(layouts, key=lambda candidate: candidate["tensor_parallel_size"])
+        planned["replicas"] = layout["replicas"]
+        planned["backend_options"] = {**plan.backend_options, "tensor_parallel_size": layout["tensor_parallel_size"]}
+        if not plan.score_choices and not plan.pipelined:
+            # Length-bucketed batches that fit the smallest KV pool stay resident
+            pool_tokens = min(candidate["kv_pool_tokens"] for candidate in layouts)
+            planned["max_batch_tokens"] = min(plan.max_batch_tokens or pool_tokens, pool_tokens) or None
+    model_seconds = [model["seconds"] for model in estimate["models"].values()]
+    estimate["seconds"] = None if None in model_seconds else round(sum(model_seconds), 1)
+    estimate["gpus"] = gpus
+    planned["estimate"] = estimate
+    return planned
+
+
+def _duration(seconds: float | None) -> str:
+    if seconds is None:
+        return "unknown (no metrics history for the model)"
+    return f"{seconds / 3600:.2f}h" if seconds >= 3600 else f"{seconds:.0f}s"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Estimate the tokens, memory, replica layout and runtime of a sweep, and write it as a sweep plan."
+    )
+    parser.add_argument("input_folders", nargs="*", help="Folders containing .jsonl prompt files")
+    parser.add_argument("--plan", default=None, help="Start from this sweep plan (its models, folders and options)")
+    parser.add_argument("--models", nargs="+", default=None, help="Models of the sweep")
+    parser.add_argument("--backend", default=None, help="Backend of the sweep (default: vllm)")
+    parser.add_argument("--profile", default=None, help="Sampling profile for every folder (default: auto)")
+    parser.add_argument("--profiles", default=None, metavar="CONFIG", help="JSON file of extra sampling profiles")
+    parser.add_argument(
+        "--tokenizer",
+        default=None,
+        help="Tokenizer for counting prompt tokens (default: each model's, 'fake' with the fake backend)",
+    )
+    parser.add_argument(
+        "--sample-rows",
+        type=int,
+        default=DEFAULT_SAMPLE_ROWS,
+        help="Prompts tokenized per file to estimate its tokens (files with a current token file are exact)",
+    )
+    parser.add_argument(
+        "--history",
+        nargs="+",
+        default=[],
+        help="Metrics files of earlier runs, or folders to search for *-metrics.ndjson, to estimate runtime",
+    )
+    parser.add_argument("--gpus", type=int, default=None, help="GPUs of the node (default: the visible ones)")
+    parser.add_argument("--gpu-memory-gb", type=float, default=DEFAULT_GPU_MEMORY_GB, help="Memory of each GPU")
+    parser.add_argument(
+        "--gpu-memory-utilization",
+        type=float,
+        default=DEFAULT_GPU_MEMORY_UTILIZATION,
+        help="Share of GPU memory the engine uses for weights and KV cache",
+    )
+    parser.add_argument("--output", default=None, help="Write the sweep plan with the estimates to this file")
+    args = parser.parse_args()
+
+    fields = {}
+    if args.plan is not None:
+        with open(args.plan, "r") as file:
+            fields = json.load(file)
+    fields.pop("estimate", None)
+    for key, value in (
+        ("input_folders", args.input_folders or None),
+        ("models", args.models),
+        ("backend", args.backend),
+        ("profiles", [args.profile] if args.profile else None),
+        ("profile_config", args.profiles),
+    ):
+        if value is not None:
+            fields[key] = value
+    if fields.get("backend") == "fake":
+        fields.setdefault("models", ["fake"])
+    if not fields.get("input_folders") or not fields.get("models"):
+        parser.error("give the input folders and --models, or a --plan that has them")
+
+    try:
+        plan = SweepPlan(**fields)
+    except ValueError as error:
+        parser.error(str(error))
+
+    gpus = args.gpus or len(visible_devices() or []) or 1
+    planned = plan_costs(
+        plan,
+        args.tokenizer,
+        args.sample_rows,
+        args.history,
+        gpus,
+        args.gpu_memory_gb,
+        args.gpu_memory_utilization,
+    )
+
+    estimate = planned["estimate"]
+    for job in estimate["jobs"]:
+        print(
+            f"{job['model']} {job['profile']} {job['input_folder']}: "
+            f"{job['files']} files ({job['exact_files']} exact), "
+            f"{job['prompts']} prompts, {job['prompt_tokens']} prompt tokens (longest {job['max_prompt_tokens']}), "
+            f"{job['expected_output_tokens']} expected of {job['output_budget_tokens']} budgeted output tokens"
+        )
+    for model, model_estimate in estimate["models"].items():
+        layout = model_estimate.get("layout")
+        if layout is not None:
+            print(
+                f"{model}: {model_estimate['weights_gb']} GB of weights, "
+                f"{model_estimate['kv_bytes_per_token'] / 1024:.0f} KiB of KV cache per token; "
+                f"{layout['replicas']} replicas x {layout['tensor_parallel_size']} GPUs "
+                f"({layout['kv_pool_tokens']} KV tokens per replica{'' if layout['fits'] else ', does not fit'})"
+            )
+        elif planned["backend"] != "fake":
+            print(f"{model}: config.json not found, no memory or layout estimate (pass a local model directory)")
+        print(f"{model}: estimated model time {_duration(model_estimate['seconds'])}")
+    print(f"Sweep: estimated model time {_duration(estimate['seconds'])} on {gpus} GPUs")
+
+    if args.output is not None:
+        tmp_path = args.output + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(planned, file, indent=2)
+        os.replace(tmp_path, args.output)
+        print(f"Plan written to {args.output}; run it with persona-impact sweep {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""Shared-prefix analysis and prefix-grouped dispatch for vLLM prefix caching.
+
+The analysis counts how many prompt tokens a token trie over a set of prompts
+would share. It does so without materialising the trie: for lexicographically
+sorted sequences, the trie nodes a sequence adds are exactly the tokens past its
+longest common prefix with the previous sequence.
+
+    python -m persona_impact.prefix prompts/hellaswag_v1 prompts/cnn_dm_v1
+"""
+
+import argparse
+import os
+from dataclasses import dataclass
+from itertools import islice, pairwise
+
+from persona_impact.backends import Backend, Completion, SamplingConfig, load_tokenizer
+from persona_impact.prompt_store import iter_prompts
+
+# vLLM caches the KV of whole blocks only; 16 tokens is its default block size.
+DEFAULT_BLOCK_SIZE = 16
+
+
+@dataclass
+class PrefixStats:
+    n_prompts: int = 0
+    total_tokens: int = 0
+    # Tokens covered by a prefix shared with another prompt, i.e. tokens that
+    # do not add a new node to the trie.
+    shared_tokens: int = 0
+    # Shared tokens rounded down to whole KV blocks: the prefill an engine with
+    # prefix caching can skip, assuming the cache holds the shared blocks.
+    cached_tokens: int = 0
+
+    @property
+    def shared_fraction(self) -> float:
+        return self.shared_tokens / self.total_tokens if self.total_tokens else 0.0
+
+    @property
+    def cached_fraction(self) -> float:
+        return self.cached_tokens / self.total_tokens if self.total_tokens else 0.0
+
+    def __iadd__(self, other: "PrefixStats"):
+        self.n_prompts += other.n_prompts
+        self.total_tokens += other.total_tokens
+        self.shared_tokens += other.shared_tokens
+        self.cached_tokens += other.cached_tokens
+        return self
+
+    def summary(self) -> str:
+        return (
+            f"{self.n_prompts} prompts, {self.total_tokens} prompt tokens, "
+            f"{self.shared_fraction:.1%} in shared prefixes, "
+            f"{self.cached_tokens} ({self.cached_fraction:.1%}) prefill tokens saved by prefix caching"
+        )
+
+
+def common_prefix_length(a, b) -> int:
+    # Binary search over slice comparisons keeps the per-token work in C.
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def analyze_prefixes(token_lists, block_size: int = DEFAULT_BLOCK_SIZE) -> PrefixStats:
+    sequences = sorted(token_lists)
+    stats = PrefixStats(n_prompts=len(sequences), total_tokens=sum(len(s) for s in sequences))
+
+    for previous, current in pairwise(sequences):
+        # The last prompt token is always recomputed to produce the first logits.
+        shared = min(common_prefix_length(previous, current), len(current) - 1)
+        if shared <= 0:
+            continue
+        stats.shared_tokens += shared
+        stats.cached_tokens += shared // block_size * block_size
+
+    return stats
+
+
+def prefix_grouped_order(prompts: list[str]) -> list[int]:
+    """Indices of `prompts` ordered so that prompts sharing a prefix are adjacent."""
+    return sorted(range(len(prompts)), key=prompts.__getitem__)
+
+
+def generate_prefix_grouped(
+    backend: Backend,
+    prompts: list[str],
+    sampling: SamplingConfig,
+    stats: PrefixStats | None = None,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+    prompt_token_ids: list[list[int] | None] | None = None,
+) -> list[Completion]:
+    """Generate in prefix-grouped order and return completions in input order.
+
+    When `stats` is given it is updated with the sharing measured on the token
+    ids the engine actually prefilled for this call. `prompt_token_ids` are
+    passed on to `backend.generate`.
+    """
+    order = prefix_grouped_order(prompts)
+    token_ids = [prompt_token_ids[i] for i in order] if prompt_token_ids else None
+    responses = backend.generate([prompts[i] for i in order], sampling, token_ids)
+
+    completions = [None] * len(prompts)
+    for index, response in zip(order, responses):
+        completions[index] = response
+
+    if stats is not None:
+        token_lists = [c.prompt_token_ids for c in responses if c.prompt_token_ids is not None]
+        stats += analyze_prefixes(token_lists, block_size)
+
+    return completions
+
+
+def read_prompts(file_name: str, max_rows: int | None = None):
+    return list(islice(iter_prompts(file_name), max_rows))
+
+
+def main():
+    from persona_impact.pipeline import filenames_in_a_folder
+
+    parser = argparse.ArgumentParser(
+        description="Report shared-prefix token fractions across the prompt files of a sweep."
+    )
+    parser.add_argument("input_folders", nargs="+", help="Folders containing .jsonl prompt files")
+    parser.add_argument(
+        "--tokenizer",
+        default="fake",
+        help="'fake' for the stand-in tokenizer, otherwise a Hugging Face tokenizer name",
+    )
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE)
+    parser.add_argument(
+        "--max-rows-per-file",
+        type=int,
+        default=None,
+        help="Only analyse the first N rows of each file",
+    )
+    args = parser.parse_args()
+
+    tokenizer = load_tokenizer(args.tokenizer)
+    sweep_tokens = []
+
+    for input_folder in args.input_folders:
+        for file in sorted(filenames_in_a_folder(input_folder)):
+            prompts = read_prompts(file, args.max_rows_per_file)
+            token_lists = [tokenizer.encode(prompt) for prompt in prompts]
+            stats = analyze_prefixes(token_lists, args.block_size)
+            print(f"{os.path.basename(file)}: {stats.summary()}")
+            sweep_tokens.extend(token_lists)
+
+    print(f"Sweep: {analyze_prefixes(sweep_tokens, args.block_size).summary()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""Pre-tokenized prompt files.
+
+The prompts of a sweep repeat the same text many times over: every persona file
+of a task renders the same contexts, endings and few-shot block, and only the
+persona preamble differs. Pre-tokenizing splits each prompt into segments at
+line starts, tokenizes every distinct segment once, and assembles the prompt's
+token ids from them. The ids of each prompt file are stored next to it,
+
+    prompts/hellaswag_v1/Human_v1.jsonl
+    prompts/hellaswag_v1/Human_v1.tokens.npz   token_ids, bounds, offsets, meta
+
+as one flat array of token ids (uint16 when the vocabulary allows it) with the
+bounds of every row and the byte offset of the row in the prompt file. With
+`--pretokenized`, the runners pass them to the backend, which then skips
+tokenizing those prompts. A token file only applies to the tokenizer it was
+written with, and is ignored once its prompt file changes.
+
+Segment tokenization is only exact when no token spans a segment boundary, so
+prompts are checked against full-string tokenization: every `verify_every`-th
+prompt, or all prompts of a file as soon as one of them differs. Prompts that
+differ are stored with their full-string ids.
+
+    python -m persona_impact.pretokenize prompts/hellaswag_v1 --tokenizer <hf-tokenizer-name>
+"""
+
+import argparse
+import functools
+import os
+import re
+import time
+from dataclasses import dataclass
+
+import numpy as np
+import ujson as json
+
+from persona_impact.backends import load_tokenizer
+from persona_impact.jsonl_io import jsonl_suffix
+from persona_impact.prefix import common_prefix_length
+from persona_impact.reader import IndexedJsonl
+from persona_impact.score_cache import file_digest
+
+FORMAT_VERSION = 1
+# Prompts are cut after a newline that is followed by neither a newline nor a space,
+# where tokenizers do not merge across
+SEGMENT_BOUNDARY = re.compile(r"(?<=\n)(?=\S)")
+# Distinct segments whose token ids are kept
+MAX_CACHED_SEGMENTS = 1 << 16
+
+
+def token_file_for(prompt_file: str) -> str:
+    """The token file stored next to `prompt_file` (any compression)."""
+    return prompt_file[: -len(jsonl_suffix(prompt_file))] + ".tokens.npz"
+
+
+def split_segments(prompt: str) -> list[str]:
+    return SEGMENT_BOUNDARY.split(prompt)
+
+
+class SegmentTokenizer:
+    """Tokenizes prompts segment by segment, each distinct segment once."""
+
+    def __init__(self, tokenizer, max_cached_segments: int = MAX_CACHED_SEGMENTS):
+        self.tokenizer = tokenizer
+        # A segment is tokenized after a newline, like it follows one in the
+        # prompt, and the newline's ids are dropped
+        self._anchor = tokenizer.encode("\n")
+        self._encode_first = functools.lru_cache(maxsize=max_cached_segments)(self._tokenize_first)
+        self._encode_next = functools.lru_cache(maxsize=max_cached_segments)(self._tokenize_next)
+
+    def _tokenize_first(self, segment: str) -> tuple[int, ...]:
+        return tuple(self.tokenizer.encode(segment))
+
+    def _tokenize_next(self, segment: str) -> tuple[int, ...]:
+        token_ids = self.tokenizer.encode("\n" + segment)
+        return tuple(token_ids[common_prefix_length(self._anchor, token_ids) :])
+
+    def encode(self, prompt: str) -> list[int]:
+        first, *rest = split_segments(prompt)
+        token_ids = list(self._encode_first(first))
+        for segment in rest:
+            token_ids.extend(self._encode_next(segment))
+        return token_ids
+
+    def segments_reused(self) -> tuple[int, int]:
+        """Segments served from the cache, and segments tokenized."""
+        first, rest = self._encode_first.cache_info(), self._encode_next.cache_info()
+        return first.hits + rest.hits, first.misses + rest.misses
+
+
+@dataclass
+class PretokenizeStats:
+    n_files: int = 0
+    n_prompts: int = 0
+    n_tokens: int = 0
+    verified: int = 0
+    mismatched: int = 0
+    seconds: float = 0.0
+
+    def summary(self) -> str:
+        return (
+            f"{self.n_files} files, {self.n_prompts} prompts, {self.n_tokens} tokens in {self.seconds:.2f}s, "
+            f"{self.verified} checked against full-string tokenization, {self.mismatched} differed"
+        )
+
+
+def pretokenize_file(
+    prompt_file: str,
+    tokenizer: SegmentTokenizer,
+    tokenizer_name: str,
+    verify_every: int = 100,
+    stats: PretokenizeStats | None = None,
+) -> str:
+    """Write the token file of `prompt_file` and return its path.
+
+    Every `verify_every`-th prompt (0: none) is checked against full-string
+    tokenization; after a mismatch, all prompts of the file are.
+    """
+    stats = stats if stats is not None else PretokenizeStats()
+    start = time.perf_counter()
+    stat = os.stat(prompt_file)
+    encode_full = tokenizer.tokenizer.encode
+    token_lists, offsets = [], []
+    verify_all = verify_every == 1
+    verified = mismatched = 0
+
+    with IndexedJsonl(prompt_file) as reader:
+        # Index positions follow the file's row order with the default duplicate policy
+        for i in range(len(reader)):
+            prompt = reader.prompt(reader.entry(i))
+            token_ids = tokenizer.encode(prompt)
+            if verify_all or (verify_every and i % verify_every == 0):
+                expected = encode_full(prompt)
+                verified += 1
+                if token_ids != expected:
+                    token_ids = expected
+                    mismatched += 1
+                    if not verify_all:
+                        # Segments are not exact for this file: check the unchecked prompts so far, then all
+                        verify_all = True
+                        for n in range(i):
+                            if n % verify_every:
+                                expected = encode_full(reader.prompt(reader.entry(n)))
+                                verified += 1
+                                if token_lists[n].tolist() != expected:
+                                    token_lists[n] = np.asarray(expected, dtype=np.uint32)
+                                    mismatched += 1
+            token_lists.append(np.asarray(token_ids, dtype=np.uint32))
+            offsets.append(reader.offsets[i])
+
+    bounds = np.zeros(len(token_lists) + 1, dtype=np.int64)
+    np.cumsum([len(token_ids) for token_ids in token_lists], out=bounds[1:])
+    token_ids = np.concatenate(token_lists) if token_lists else np.zeros(0, dtype=np.uint32)
+    if not len(token_ids) or token_ids.max() <= np.iinfo(np.uint16).max:
+        token_ids = token_ids.astype(np.uint16)
+    meta = {
+        "format": FORMAT_VERSION,
+        "tokenizer": tokenizer_name,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "digest": file_digest(prompt_file),
+        "verified": verified,
+        "mismatched": mismatched,
+    }
+
+    path = token_file_for(prompt_file)
+    tmp_path = path + ".tmp.npz"
+    offsets = np.asarray(offsets, dtype=np.int64)
+    np.savez(tmp_path, token_ids=token_ids, bounds=bounds, offsets=offsets, meta=json.dumps(meta))
+    os.replace(tmp_path, path)
+
+    stats.n_files += 1
+    stats.n_prompts += len(token_lists)
+    stats.n_tokens += int(bounds[-1])
+    stats.verified += verified
+    stats.mismatched += mismatched
+    stats.seconds += time.perf_counter() - start
+    return path
+
+
+class TokenIds:
+    """The token ids of a prompt file's rows, looked up by the row's byte offset."""
+
+    def __init__(self, path: str):
+        with np.load(path) as data:
+            self.meta = json.loads(str(data["meta"]))
+            self.token_ids = data["token_ids"]
+            self.bounds = data["bounds"]
+            self.rows = {int(offset): n for n, offset in enumerate(data["offsets"])}
+
+    def get(self, offset: int) -> list[int] | None:
+        n = self.rows.get(offset)
+        if n is None:
+            return None
+        return self.token_ids[self.bounds[n] : self.bounds[n + 1]].tolist()
+
+
+def is_current(meta: dict, prompt_file: str, tokenizer_name: str) -> bool:
+    """Whether a token file was written for `tokenizer_name` from the current `prompt_file`."""
+    if meta.get("format") != FORMAT_VERSION or meta["tokenizer"] != tokenizer_name:
+        return False
+    stat = os.stat(prompt_file)
+    if meta["size"] != stat.st_size:
+        return False
+    return meta["mtime_ns"] == stat.st_mtime_ns or meta["digest"] == file_digest(prompt_file)
+
+
+def load_token_ids(prompt_file: str, tokenizer_name: str) -> TokenIds | None:
+    """The token ids stored for `prompt_file`, or None if it has no current token file for `tokenizer_name`."""
+    path = token_file_for(prompt_file)
+    if not os.path.exists(path):
+        return None
+    token_ids = TokenIds(path)
+    if not is_current(token_ids.meta, prompt_file, tokenizer_name):
+        print(f"Ignoring {path}: written for another tokenizer or an older version of {prompt_file}")
+        return None
+    return token_ids
+
+
+def main():
+    from persona_impact.pipeline import filenames_in_a_folder
+
+    parser = argparse.ArgumentParser(
+        description="Tokenize the prompt files of input folders once and store their token ids next to them."
+    )
+    parser.add_argument("input_folders", nargs="+", help="Folders containing .jsonl prompt files")
+    parser.add_argument(
+        "--tokenizer",
+        default="fake",
+        help="'fake' for the stand-in tokenizer, otherwise the model (Hugging Face tokenizer) name",
+    )
+    parser.add_argument(
+        "--verify-every",
+        type=int,
+        default=100,
+        help="Check every N-th prompt against full-string tokenization (1: all, 0: none)",
+    )
+    parser.add_argument("--force", action="store_true", help="Rewrite token files that are already current")
+    args = parser.parse_args()
+
+    tokenizer = SegmentTokenizer(load_tokenizer(args.tokenizer))
+    stats = PretokenizeStats()
+    for input_folder in args.input_folders:
+        for file in sorted(filenames_in_a_folder(input_folder)):
+            path = token_file_for(file)
+            if not args.force and os.path.exists(path) and is_current(TokenIds(path).meta, file, args.tokenizer):
+                print(f"Skipping {file} as {path} is current.")
+                continue
+            mismatched = stats.mismatched
+            pretokenize_file(file, tokenizer, args.tokenizer, args.verify_every, stats)
+            note = f" ({stats.mismatched - mismatched} prompts differed from full-string tokenization)"
+            print(f"{path}{note if stats.mismatched > mismatched else ''}")
+
+    reused, tokenized = tokenizer.segments_reused()
+    print(f"Pre-tokenized {stats.summary()}; {reused} of {reused + tokenized} segments reused")
+
+
+if __name__ == "__main__":
+    main()
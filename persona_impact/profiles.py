@@ -0,0 +1,118 @@
+"""Task-aware sampling profiles.
+
+HellaSwag answers need a single label and CNN/DM summaries a few sentences, so
+each input folder is generated with the profile of its task: tight token
+budgets and stop strings instead of one 128-token setting for everything.
+The task is read from a compact file header, inferred from the row schema
+(`correct_label` for HellaSwag, `abstract` for CNN/DM) or assigned explicitly
+in a JSON config:
+
+    {
+        "profiles": {"hellaswag": {"max_tokens": 4, "stop": ["\\n\\n", "###"]}},
+        "folders": {"prompts/hellaswag_v1": "hellaswag-guided"}
+    }
+
+Profiles in the config override or extend the built-in ones field by field.
+"""
+
+import dataclasses
+import os
+from dataclasses import dataclass
+
+import ujson as json
+
+from persona_impact.backends import SamplingConfig
+from persona_impact.jsonl_io import open_jsonl
+from persona_impact.prompt_store import parse_header
+
+DEFAULT_PROFILE = "default"
+
+PROFILES = {
+    # The settings every folder used to be generated with
+    DEFAULT_PROFILE: SamplingConfig(max_tokens=128, top_k=10, top_p=0.95, temperature=0.69),
+    # A label, possibly followed by the start of another few-shot example
+    "hellaswag": SamplingConfig(
+        max_tokens=8, top_k=10, top_p=0.95, temperature=0.69, stop=("\n\n", "###", "Context:")
+    ),
+    # A single constrained label token
+    "hellaswag-guided": SamplingConfig(
+        max_tokens=1, top_k=10, top_p=0.95, temperature=0.69, guided_choice=("0", "1", "2", "3")
+    ),
+    # 2-3 sentences; stop before the model starts another section or article
+    "cnn_dm": SamplingConfig(
+        max_tokens=100, top_k=10, top_p=0.95, temperature=0.69, stop=("###", "\nArticle:", "\n\n")
+    ),
+}
+
+
+def infer_task(input_folder: str) -> str | None:
+    """Guess the task of a folder from the first row of its first prompt file."""
+    from persona_impact.pipeline import filenames_in_a_folder
+
+    for file in sorted(filenames_in_a_folder(input_folder)):
+        with open_jsonl(file, "r") as reader:
+            line = reader.readline()
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        header = parse_header(entry)
+        if header is not None:
+            return header["task"]
+        if "correct_label" in entry:
+            return "hellaswag"
+        if "abstract" in entry:
+            return "cnn_dm"
+        return None
+    return None
+
+
+class ProfileSet:
+    def __init__(self, config_path: str | None = None):
+        self.profiles = dict(PROFILES)
+        self.folders = {}
+        if config_path is not None:
+            with open(config_path, "r") as file:
+                config = json.load(file)
+            for name, fields in config.get("profiles", {}).items():
+                base = self.profiles.get(name, self.profiles[DEFAULT_PROFILE])
+                for key in ("stop", "guided_choice"):
+                    if fields.get(key) is not None:
+                        fields[key] = tuple(fields[key])
+                self.profiles[name] = dataclasses.replace(base, **fields)
+            self.folders = {os.path.normpath(k): v for k, v in config.get("folders", {}).items()}
+
+    def profile_name(self, input_folder: str) -> str:
+        name = self.folders.get(os.path.normpath(input_folder))
+        if name is None:
+            task = infer_task(input_folder)
+            name = task if task in self.profiles else DEFAULT_PROFILE
+        return name
+
+    def __getitem__(self, name: str) -> SamplingConfig:
+        if name not in self.profiles:
+            raise KeyError(f"Unknown sampling profile {name!r}, expected one of {sorted(self.profiles)}")
+        return self.profiles[name]
+
+
+@dataclass
+class DecodeStats:
+    """Decode tokens of a run against the budget of the old single profile."""
+
+    n_prompts: int = 0
+    output_tokens: int = 0
+    budget_tokens: int = 0
+    baseline_budget_tokens: int = 0
+
+    def add(self, sampling: SamplingConfig, output_tokens: list[int]):
+        self.n_prompts += len(output_tokens)
+        self.output_tokens += sum(output_tokens)
+        self.budget_tokens += sampling.max_tokens * len(output_tokens)
+        self.baseline_budget_tokens += PROFILES[DEFAULT_PROFILE].max_tokens * len(output_tokens)
+
+    def summary(self) -> str:
+        saved = self.baseline_budget_tokens - self.budget_tokens
+        return (
+            f"{self.n_prompts} prompts decoded {self.output_tokens} tokens "
+            f"(budget {self.budget_tokens}, {saved} fewer than the "
+            f"{PROFILES[DEFAULT_PROFILE].max_tokens}-token default budget of {self.baseline_budget_tokens})"
+        )
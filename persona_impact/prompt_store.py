@@ -0,0 +1,118 @@
+"""Compact prompt files.
+
+Instead of a fully rendered `llm_instruction` per row, a compact prompt file
+starts with a header line holding what every row of the file shares (the
+template, the persona block and the few-shot examples block) and each row only
+carries its own fields. Prompts are rendered when they are read for generation:
+
+    {"__prompt_store__": {"task": "hellaswag", "template": ..., "persona": ..., "examples": ...}}
+    {"ind": 4, "activity": ..., "correct_label": ..., "split_type": ..., "ctx": ..., "endings": [...]}
+
+A compact row holds the fields of the rendered row plus those only needed to
+render its prompt, so `expand` gives back exactly the row of a non-compact file.
+"""
+
+import functools
+import string
+
+import ujson as json
+
+from persona_impact.jsonl_io import open_jsonl
+
+HEADER_KEY = "__prompt_store__"
+
+
+class CompiledTemplate:
+    """An f-string style template split once into literal text and field names.
+
+    Renders exactly like `str.format` (and LangChain's `PromptTemplate`) for
+    templates made of plain `{field}` placeholders, without re-parsing the
+    template on every call.
+    """
+
+    def __init__(self, template: str):
+        self.template = template
+        self.parts = []
+        for literal, field, format_spec, conversion in string.Formatter().parse(template):
+            if format_spec or conversion:
+                raise ValueError(f"Unsupported placeholder {{{field}!{conversion}:{format_spec}}} in template")
+            self.parts.append((literal, field))
+        self.fields = {field for _, field in self.parts if field is not None}
+
+    def render(self, **values) -> str:
+        out = []
+        for literal, field in self.parts:
+            out.append(literal)
+            if field is not None:
+                out.append(str(values[field]))
+        return "".join(out)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_template(template: str) -> CompiledTemplate:
+    return CompiledTemplate(template)
+
+
+def get_endings(endings):
+    return "\n".join([f"{str(i)}) {s.lower()}" for i, s in enumerate(endings)])
+
+
+def hellaswag_fields(row: dict) -> dict:
+    return {"sentence": row["ctx"].lower(), "endings": get_endings(row["endings"])}
+
+
+def cnn_dm_fields(row: dict) -> dict:
+    return {"article": row["article_text"]}
+
+
+# Per task, how a row's own template fields are derived from the stored row
+FIELD_BUILDERS = {
+    "hellaswag": hellaswag_fields,
+    "cnn_dm": cnn_dm_fields,
+}
+# Per task, the stored fields only used to render the prompt, which rendered rows do not carry
+RENDER_FIELDS = {
+    "hellaswag": ("ctx", "endings"),
+    "cnn_dm": ("article_text",),
+}
+
+
+def make_header(task: str, template: str, persona: str, examples: str) -> dict:
+    if task not in FIELD_BUILDERS:
+        raise ValueError(f"Unknown task {task!r}, expected one of {sorted(FIELD_BUILDERS)}")
+    return {HEADER_KEY: {"task": task, "template": template, "persona": persona, "examples": examples}}
+
+
+def parse_header(entry: dict) -> dict | None:
+    return entry.get(HEADER_KEY) if isinstance(entry, dict) else None
+
+
+def render(header: dict, row: dict) -> str:
+    fields = FIELD_BUILDERS[header["task"]](row)
+    return compile_template(header["template"]).render(
+        persona=header["persona"], examples=header["examples"], **fields
+    )
+
+
+def expand(header: dict, row: dict) -> dict:
+    """The row a non-compact file holds for `row`: its own fields and the rendered `llm_instruction`."""
+    render_fields = RENDER_FIELDS[header["task"]]
+    expanded = {name: value for name, value in row.items() if name not in render_fields}
+    expanded["llm_instruction"] = render(header, row)
+    return expanded
+
+
+def iter_prompts(file_name: str, fields=("prompt", "llm_instruction")):
+    """Yield the prompt of every row in file order, rendering compact files."""
+    header = None
+    with open_jsonl(file_name, "r") as file:
+        for n, line in enumerate(file):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if n == 0 and parse_header(entry) is not None:
+                header = parse_header(entry)
+            elif header is not None:
+                yield render(header, entry)
+            else:
+                yield next(entry[field] for field in fields if field in entry)
@@ -0,0 +1,151 @@
+"""Offset-indexed JSONL reader.
+
+`IndexedJsonl` makes one pass over a file to record, for every row, its sort
+key and where the row lives (byte offset and length). Only that index is
+sorted; rows are parsed lazily from a memory map when iterated, so memory grows
+with the number of rows rather than with the size of the prompts they carry.
+
+Compact prompt files (see `persona_impact.prompt_store`) are recognised by their
+header line, and `prompt()` renders their rows on demand. Compressed files are
+decompressed once, while indexing, into an anonymous temporary file that is
+memory-mapped in their place.
+"""
+
+import mmap
+import tempfile
+from array import array
+
+import ujson as json
+
+from persona_impact.jsonl_io import compression_of, open_jsonl
+from persona_impact.prompt_store import parse_header, render
+
+# How rows sharing a sort key are handled:
+#   keep  - keep every row; duplicates are ordered by their position in the file
+#   first - keep only the first row with a given key
+#   last  - keep only the last row (what the old dict-based extractor did)
+#   error - raise DuplicateKeyError
+DUPLICATE_POLICIES = ("keep", "first", "last", "error")
+
+
+class DuplicateKeyError(ValueError):
+    pass
+
+
+class IndexedJsonl:
+    def __init__(
+        self,
+        file_name: str,
+        key_fields=("question", "ind", "filename"),
+        duplicates: str = "keep",
+        prompt_fields=("prompt", "llm_instruction"),
+    ):
+        if duplicates not in DUPLICATE_POLICIES:
+            raise ValueError(f"Unknown duplicate policy {duplicates!r}, expected one of {DUPLICATE_POLICIES}")
+
+        self.file_name = file_name
+        self.key_fields = key_fields
+        self.prompt_fields = prompt_fields
+        self.header = None
+        self.keys = []
+        self.occurrences = array("l")
+        self.offsets = array("q")
+        self.lengths = array("l")
+        self.n_duplicates = 0
+
+        # Decompressed rows, when the file is compressed
+        spool = tempfile.TemporaryFile() if compression_of(file_name) is not None else None
+        try:
+            self._build_index(duplicates, spool)
+        except BaseException:
+            if spool is not None:
+                spool.close()
+            raise
+        # Sorting by (key, occurrence) keeps duplicates in file order
+        self.order = array(
+            "l", sorted(range(len(self.keys)), key=lambda i: (self.keys[i], self.occurrences[i]))
+        )
+
+        if spool is not None:
+            spool.flush()
+            self._file = spool
+        else:
+            self._file = open(file_name, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.offsets else None
+
+    def _key(self, entry: dict):
+        for field in self.key_fields:
+            if field in entry:
+                return entry[field]
+        raise KeyError(f"{self.file_name}: row has none of the key fields {self.key_fields}")
+
+    def _build_index(self, duplicates: str, spool=None):
+        seen = {}  # key -> index of its last kept row
+        offset = 0
+
+        with open_jsonl(self.file_name, "rb") as file:
+            for line in file:
+                if spool is not None:
+                    spool.write(line)
+                length = len(line)
+                entry = json.loads(line) if line.strip() else None
+                if offset == 0 and parse_header(entry) is not None:
+                    self.header = parse_header(entry)
+                elif entry is not None:
+                    key = self._key(entry)
+                    if key not in seen:
+                        seen[key] = len(self.keys)
+                        self._append(key, 0, offset, length)
+                    else:
+                        self.n_duplicates += 1
+                        if duplicates == "error":
+                            raise DuplicateKeyError(f"{self.file_name}: duplicate key {key!r}")
+                        if duplicates == "keep":
+                            previous = seen[key]
+                            seen[key] = len(self.keys)
+                            self._append(key, self.occurrences[previous] + 1, offset, length)
+                        elif duplicates == "last":
+                            self.offsets[seen[key]] = offset
+                            self.lengths[seen[key]] = length
+                offset += length
+
+    def _append(self, key, occurrence: int, offset: int, length: int):
+        self.keys.append(key)
+        self.occurrences.append(occurrence)
+        self.offsets.append(offset)
+        self.lengths.append(length)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def entry(self, i: int) -> dict:
+        """Parse row `i` (an index position, not a file line number)."""
+        offset = self.offsets[i]
+        entry = json.loads(self._map[offset : offset + self.lengths[i]])
+        entry["sort_key"] = self.keys[i]
+        return entry
+
+    def prompt(self, entry: dict) -> str:
+        """The prompt text of a row, rendered from the header for compact files."""
+        if self.header is not None:
+            return render(self.header, entry)
+        for field in self.prompt_fields:
+            if field in entry:
+                return entry[field]
+        raise KeyError(f"{self.file_name}: row has none of the prompt fields {self.prompt_fields}")
+
+    def __iter__(self):
+        """Yield rows in sort key order."""
+        for i in self.order:
+            yield self.entry(i)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,244 @@
+"""Columnar store of per-example results.
+
+Output folders hold full JSONL rows that repeat the prompt next to each
+response, so every evaluation rescans gigabytes to read one field per row. The
+evaluators' export functions convert each output file once into a segment of a
+store directory:
+
+    <store>/manifest.json          segments: source file, size and mtime, model,
+                                   dataset, persona, version, metric version,
+                                   rows and columns
+    <store>/keys.json              example keys (`ind`, `filename`) by code
+    <store>/segments/<id>/key.npy  int32 key codes, one per row
+    <store>/segments/<id>/<metric>.npy    e.g. accuracy, label, r1, r2, rl
+    <store>/segments/<id>/response.bin    UTF-8 responses, concatenated
+    <store>/segments/<id>/response.offsets.npy
+
+Numeric columns are `.npy` files opened memory-mapped, so a query only reads
+the columns (and segments) it needs; responses are decoded row by row on
+access. Exporting a file again replaces its segment, and files unchanged since
+they were scored with the evaluator's current metric version are skipped. Comparing models is a query over the manifest:
+
+    python -m persona_impact.results_store results_store --dataset hellaswag --metric accuracy
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+
+import numpy as np
+import ujson as json
+
+from persona_impact.score_cache import file_digest
+
+MANIFEST = "manifest.json"
+KEYS = "keys.json"
+FORMAT_VERSION = 1
+# Segment metadata that queries can filter and group on
+FIELDS = ("model", "dataset", "folder", "persona", "version")
+
+
+def _atomic_json(path: str, value):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(value, file)
+    os.replace(tmp_path, path)
+
+
+class StringColumn:
+    """A memory-mapped column of strings, decoded on access."""
+
+    def __init__(self, path: str):
+        self.offsets = np.load(path + ".offsets.npy", mmap_mode="r")
+        size = int(self.offsets[-1])
+        self.data = np.memmap(path + ".bin", dtype=np.uint8, mode="r") if size else np.zeros(0, np.uint8)
+
+    @staticmethod
+    def write(path: str, values: list[str]):
+        encoded = [value.encode("utf-8") for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        with open(path + ".bin", "wb") as file:
+            for value in encoded:
+                file.write(value)
+        np.save(path + ".offsets.npy", offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self.data[self.offsets[i] : self.offsets[i + 1]].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class ResultsStore:
+    def __init__(self, path: str):
+        self.path = path
+        self.segments = {}
+        self.key_names = []
+        if os.path.exists(os.path.join(path, MANIFEST)):
+            with open(os.path.join(path, MANIFEST), "r") as file:
+                manifest = json.load(file)
+            if manifest["format"] != FORMAT_VERSION:
+                raise ValueError(f"{path} has store format {manifest['format']}, expected {FORMAT_VERSION}")
+            self.segments = manifest["segments"]
+        self._key_codes = None
+
+    @staticmethod
+    def segment_id(source: str) -> str:
+        return hashlib.blake2b(os.path.abspath(source).encode("utf-8"), digest_size=8).hexdigest()
+
+    def _segment_path(self, segment_id: str) -> str:
+        return os.path.join(self.path, "segments", segment_id)
+
+    def _load_keys(self):
+        if self._key_codes is None:
+            if os.path.exists(os.path.join(self.path, KEYS)):
+                with open(os.path.join(self.path, KEYS), "r") as file:
+                    self.key_names = json.load(file)
+            self._key_codes = {key: code for code, key in enumerate(self.key_names)}
+        return self._key_codes
+
+    def is_current(self, source: str, metric_version: str | None = None, **meta) -> bool:
+        """Whether `source` was exported with the same metadata and metric version and has not changed since."""
+        segment = self.segments.get(self.segment_id(source))
+        if segment is None or any(segment[name] != value for name, value in meta.items()):
+            return False
+        if segment.get("metric_version") != metric_version:
+            return False
+        stat = os.stat(source)
+        if segment["size"] != stat.st_size:
+            return False
+        return segment["mtime_ns"] == stat.st_mtime_ns or segment["digest"] == file_digest(source)
+
+    def write_segment(
+        self,
+        source: str,
+        meta: dict,
+        keys: list,
+        responses: list[str],
+        columns: dict,
+        metric_version: str | None = None,
+    ):
+        """Store the rows of one output file, replacing any previous export of it.
+
+        `meta` holds the FIELDS of the file, `keys` and `responses` one value
+        per row and `columns` one array (or list) per row-level column, scored
+        by the evaluator's `metric_version`.
+        """
+        codes = self._load_keys()
+        key_column = np.empty(len(keys), dtype=np.int32)
+        for i, key in enumerate(keys):
+            key = str(key)
+            if key not in codes:
+                codes[key] = len(self.key_names)
+                self.key_names.append(key)
+            key_column[i] = codes[key]
+
+        segment_id = self.segment_id(source)
+        segment_path = self._segment_path(segment_id)
+        tmp_path = segment_path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, "key.npy"), key_column)
+        StringColumn.write(os.path.join(tmp_path, "response"), responses)
+        for name, values in columns.items():
+            values = np.asarray(values)
+            if len(values) != len(keys):
+                raise ValueError(f"Column {name!r} has {len(values)} values for {len(keys)} rows")
+            np.save(os.path.join(tmp_path, f"{name}.npy"), values)
+        shutil.rmtree(segment_path, ignore_errors=True)
+        os.replace(tmp_path, segment_path)
+
+        stat = os.stat(source)
+        self.segments[segment_id] = {
+            "source": os.path.abspath(source),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "digest": file_digest(source),
+            **{name: meta[name] for name in FIELDS},
+            "metric_version": metric_version,
+            "n_rows": len(keys),
+            "columns": sorted(columns),
+        }
+
+    def save(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        # Keys first: the manifest must never reference key codes that were not saved
+        if self._key_codes is not None:
+            _atomic_json(os.path.join(self.path, KEYS), self.key_names)
+        _atomic_json(os.path.join(self.path, MANIFEST), {"format": FORMAT_VERSION, "segments": self.segments})
+
+    def select(self, column: str | None = None, **where) -> list[tuple[str, dict]]:
+        """(segment id, metadata) of the segments matching `where` (and having `column`), in a stable order."""
+        selected = [
+            (segment_id, segment)
+            for segment_id, segment in self.segments.items()
+            if all(value is None or segment.get(name) == value for name, value in where.items())
+            and (column is None or column in segment["columns"])
+        ]
+        return sorted(selected, key=lambda item: tuple(item[1][name] for name in FIELDS))
+
+    def column(self, segment_id: str, name: str) -> np.ndarray:
+        return np.load(os.path.join(self._segment_path(segment_id), f"{name}.npy"), mmap_mode="r")
+
+    def keys(self, segment_id: str) -> np.ndarray:
+        return self.column(segment_id, "key")
+
+    def responses(self, segment_id: str) -> StringColumn:
+        return StringColumn(os.path.join(self._segment_path(segment_id), "response"))
+
+    def key_name(self, code: int) -> str:
+        self._load_keys()
+        return self.key_names[code]
+
+    def scores(self, metric: str, **where) -> dict:
+        """{model: {version: {persona: {key code: score}}}} of the matching segments."""
+        scores = {}
+        for segment_id, segment in self.select(metric, **where):
+            by_persona = scores.setdefault(segment["model"], {}).setdefault(segment["version"], {})
+            values = self.column(segment_id, metric)
+            by_persona.setdefault(segment["persona"], {}).update(zip(self.keys(segment_id).tolist(), values.tolist()))
+        return scores
+
+    def means(self, metric: str, **where) -> dict:
+        """{(model, dataset, folder, persona, version): (rows, mean)} of the matching segments."""
+        means = {}
+        for segment_id, segment in self.select(metric, **where):
+            # Summed in row order, so means equal the evaluators' file scores exactly
+            values = self.column(segment_id, metric).tolist()
+            means[tuple(segment[name] for name in FIELDS)] = (len(values), sum(values) / len(values) if values else None)
+        return means
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-persona means of a metric across the models of a results store.")
+    parser.add_argument("store", help="Results store directory")
+    parser.add_argument("--metric", required=True, help="Column to average, e.g. accuracy, r1, r2 or rl")
+    for name in FIELDS:
+        parser.add_argument(f"--{name}", default=None, help=f"Only segments with this {name}")
+    args = parser.parse_args()
+
+    store = ResultsStore(args.store)
+    means = store.means(args.metric, **{name: getattr(args, name) for name in FIELDS})
+    if not means:
+        parser.error(f"No segments with a {args.metric!r} column match")
+
+    models = sorted({key[0] for key in means})
+    rows = sorted({key[1:] for key in means})
+    print(f"{'dataset':10} {'folder':24} {'persona':24} {'version':8} " + " ".join(f"{model[-24:]:>24}" for model in models))
+    for row in rows:
+        cells = []
+        for model in models:
+            n, mean = means.get((model, *row), (0, None))
+            cells.append(f"{'-' if mean is None else f'{mean:.4f} ({n})':>24}")
+        dataset, folder, persona, version = row
+        print(f"{dataset:10} {folder[:24]:24} {persona[:24]:24} {version:8} " + " ".join(cells))
+
+
+if __name__ == "__main__":
+    main()
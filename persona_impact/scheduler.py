@@ -0,0 +1,150 @@
+"""Token-length-aware batching.
+
+CNN/DM prompts render whole articles, so a file mixes prompts of a few hundred
+tokens with the occasional one of several thousand, which can stall a batch or
+exceed the model's context. `LengthScheduler` tokenizes the prompts of a call
+up front and
+
+- handles prompts longer than `max_prompt_tokens`: "truncate" cuts tokens out of
+  the middle of the prompt (keeping the instruction and persona at the start
+  and the answer cue at the end), "reject" skips them with an empty response;
+- sorts prompts by length, longest first, and packs them into batches of at
+  most `max_batch_tokens`, counting each prompt's tokens plus the profile's
+  `max_tokens`, so similar lengths are decoded together and the longest
+  requests do not start last;
+
+and returns completions in the original order. Rows of truncated or rejected
+prompts record it in `llm_prompt_overflow`, and `LengthStats` counts them.
+"""
+
+from dataclasses import dataclass
+
+from persona_impact.backends import Backend, Completion, SamplingConfig
+from persona_impact.prefix import PrefixStats, generate_prefix_grouped
+
+OVERFLOW_POLICIES = ("truncate", "reject")
+# Replaces the tokens cut out of the middle of an over-long prompt
+TRUNCATION_MARKER = "\n...\n"
+
+
+@dataclass
+class LengthStats:
+    n_prompts: int = 0
+    n_batches: int = 0
+    prompt_tokens: int = 0
+    max_prompt_tokens: int = 0
+    truncated: int = 0
+    truncated_tokens: int = 0
+    rejected: int = 0
+
+    def summary(self) -> str:
+        mean = self.prompt_tokens / self.n_prompts if self.n_prompts else 0.0
+        return (
+            f"{self.n_prompts} prompts in {self.n_batches} length-bucketed batches "
+            f"({mean:.0f} prompt tokens on average, longest {self.max_prompt_tokens}), "
+            f"{self.truncated} truncated by {self.truncated_tokens} tokens, {self.rejected} rejected"
+        )
+
+
+def truncate_middle(backend: Backend, prompt: str, n_tokens: int, max_tokens: int) -> tuple[str, int]:
+    """`prompt` cut in the middle to at most `max_tokens` tokens, and its token count."""
+    ratio = max_tokens / n_tokens
+    while True:
+        # Estimate the characters to keep from the token ratio, then check with the tokenizer
+        keep = int(len(prompt) * ratio) // 2
+        text = prompt[:keep] + TRUNCATION_MARKER + prompt[len(prompt) - keep :]
+        length = backend.count_tokens(text)
+        if length <= max_tokens or keep == 0:
+            return text, length
+        ratio *= 0.98 * max_tokens / length
+
+
+def length_batches(costs: list[int], max_batch_tokens: int | None) -> list[list[int]]:
+    """Indices of `costs`, longest first, in consecutive batches of at most `max_batch_tokens`.
+
+    A prompt costing more than the budget on its own gets a batch of its own.
+    """
+    order = sorted(range(len(costs)), key=lambda i: -costs[i])
+    if max_batch_tokens is None:
+        return [order] if order else []
+    batches, batch, total = [], [], 0
+    for i in order:
+        if batch and total + costs[i] > max_batch_tokens:
+            batches.append(batch)
+            batch, total = [], 0
+        batch.append(i)
+        total += costs[i]
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class LengthScheduler:
+    def __init__(
+        self,
+        max_batch_tokens: int | None = None,
+        max_prompt_tokens: int | None = None,
+        overflow: str = "truncate",
+    ):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow!r}, expected one of {OVERFLOW_POLICIES}")
+        self.max_batch_tokens = max_batch_tokens
+        self.max_prompt_tokens = max_prompt_tokens
+        self.overflow = overflow
+        self.stats = LengthStats()
+
+    def generate(
+        self,
+        backend: Backend,
+        prompts: list[str],
+        sampling: SamplingConfig,
+        prefix_stats: PrefixStats | None = None,
+        prompt_token_ids: list[list[int] | None] | None = None,
+    ) -> tuple[list[Completion], list[dict | None]]:
+        """Completions of `prompts` in input order, and per prompt the overflow fields of its row (or None).
+
+        With `prefix_stats`, each batch is dispatched in prefix-grouped order.
+        Prompts with `prompt_token_ids` are measured without tokenizing them.
+        """
+        prompts = list(prompts)
+        token_lists = list(prompt_token_ids or [None] * len(prompts))
+        # Prompts without token ids are counted in one call: a data-parallel backend asks its replicas
+        untokenized = [i for i, token_ids in enumerate(token_lists) if token_ids is None]
+        counts = dict(zip(untokenized, backend.count_tokens_batch([prompts[i] for i in untokenized])))
+        lengths = [counts[i] if token_ids is None else len(token_ids) for i, token_ids in enumerate(token_lists)]
+        overflows = [None] * len(prompts)
+        completions = [None] * len(prompts)
+
+        for i, length in enumerate(lengths):
+            if self.max_prompt_tokens is None or length <= self.max_prompt_tokens:
+                continue
+            overflows[i] = {"llm_prompt_overflow": self.overflow, "llm_prompt_tokens": length}
+            if self.overflow == "reject":
+                completions[i] = Completion(text="", prompt_tokens=length, output_tokens=0)
+                self.stats.rejected += 1
+                continue
+            prompts[i], lengths[i] = truncate_middle(backend, prompts[i], length, self.max_prompt_tokens)
+            token_lists[i] = None
+            self.stats.truncated += 1
+            self.stats.truncated_tokens += length - lengths[i]
+
+        scheduled = [i for i in range(len(prompts)) if completions[i] is None]
+        costs = [lengths[i] + sampling.max_tokens for i in scheduled]
+        for batch in length_batches(costs, self.max_batch_tokens):
+            rows = [scheduled[j] for j in batch]
+            batch_prompts = [prompts[i] for i in rows]
+            batch_token_ids = [token_lists[i] for i in rows] if prompt_token_ids else None
+            if prefix_stats is None:
+                responses = backend.generate(batch_prompts, sampling, batch_token_ids)
+            else:
+                responses = generate_prefix_grouped(
+                    backend, batch_prompts, sampling, prefix_stats, prompt_token_ids=batch_token_ids
+                )
+            for i, response in zip(rows, responses):
+                completions[i] = response
+            self.stats.n_batches += 1
+
+        self.stats.n_prompts += len(prompts)
+        self.stats.prompt_tokens += sum(lengths[i] for i in scheduled)
+        self.stats.max_prompt_tokens = max([self.stats.max_prompt_tokens] + [lengths[i] for i in scheduled])
+        return completions, overflows
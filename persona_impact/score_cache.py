@@ -0,0 +1,76 @@
+"""Persistent per-file score cache for the evaluators.
+
+Scores are stored per output file together with the file's size, mtime and
+content hash, and the version of the metric that produced them. A file whose
+size and mtime are unchanged is a hit without being read; otherwise its
+content hash decides (so a `touch` or a copy does not force a rescore). Bump a
+metric's version string whenever its scoring changes.
+"""
+
+import hashlib
+import os
+
+import ujson as json
+
+
+def file_digest(file_name: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_name, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ScoreCache:
+    def __init__(self, path: str, metric_version: str):
+        self.path = path
+        self.metric_version = metric_version
+        self.hits = 0
+        self.misses = 0
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                self.entries = json.load(file)
+
+    def get(self, file_name: str):
+        """Return the cached scores of `file_name`, or None if it must be rescored."""
+        key = os.path.abspath(file_name)
+        entry = self.entries.get(key)
+        if entry is None or entry["metric_version"] != self.metric_version:
+            self.misses += 1
+            return None
+
+        stat = os.stat(file_name)
+        if entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            self.hits += 1
+            return entry["scores"]
+
+        if entry["size"] == stat.st_size and entry["digest"] == file_digest(file_name):
+            entry["mtime_ns"] = stat.st_mtime_ns
+            self.hits += 1
+            return entry["scores"]
+
+        self.misses += 1
+        return None
+
+    def put(self, file_name: str, scores):
+        stat = os.stat(file_name)
+        self.entries[os.path.abspath(file_name)] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "digest": file_digest(file_name),
+            "metric_version": self.metric_version,
+            "scores": scores,
+        }
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.entries, file)
+        os.replace(tmp_path, self.path)
+
+    def summary(self) -> str:
+        return f"{self.hits} files reused from the score cache, {self.misses} rescored"
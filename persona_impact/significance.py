@@ -0,0 +1,290 @@
+"""Significance tests for persona comparisons on per-example scores.
+
+Everything works on NumPy arrays of per-example values (0/1 correctness or
+ROUGE f-measures): one-way ANOVA and Kruskal-Wallis across personas, paired
+sign-flip permutation tests against a baseline persona and percentile
+bootstrap confidence intervals of means. Resampling is vectorized: resamples
+are drawn as (chunk, n) matrices sized to stay within `MAX_CHUNK_ELEMENTS`.
+Data with few distinct values (0/1 correctness and its paired differences) is
+resampled exactly through its sufficient statistic, a multinomial draw of
+value counts, without materializing any resample.
+
+The F and chi-squared tail probabilities use the regularized incomplete beta
+and gamma functions implemented below, so SciPy is not required.
+"""
+
+import math
+from dataclasses import dataclass
+
+import numpy as np
+
+DEFAULT_RESAMPLES = 10000
+# Elements per resampling matrix, bounding memory to ~128 MB of float64
+MAX_CHUNK_ELEMENTS = 1 << 24
+# Up to this many distinct values, resample value counts instead of examples
+MAX_COUNT_SUPPORT = 64
+
+
+def _betacf(a: float, b: float, x: float) -> float:
+    # Continued fraction of the incomplete beta function (modified Lentz)
+    tiny = 1e-300
+    c, d = 1.0, 1.0 - (a + b) * x / (a + 1.0)
+    d = 1.0 / (d if abs(d) > tiny else tiny)
+    h = d
+    for m in range(1, 10000):
+        m2 = 2 * m
+        for numerator in (
+            m * (b - m) * x / ((a + m2 - 1.0) * (a + m2)),
+            -(a + m) * (a + b + m) * x / ((a + m2) * (a + m2 + 1.0)),
+        ):
+            d = 1.0 + numerator * d
+            d = 1.0 / (d if abs(d) > tiny else tiny)
+            c = 1.0 + numerator / c
+            c = c if abs(c) > tiny else tiny
+            h *= d * c
+        if abs(d * c - 1.0) < 1e-15:
+            break
+    return h
+
+
+def betainc(a: float, b: float, x: float) -> float:
+    """Regularized incomplete beta function I_x(a, b)."""
+    if x <= 0.0:
+        return 0.0
+    if x >= 1.0:
+        return 1.0
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log1p(-x))
+    if x < (a + 1.0) / (a + b + 2.0):
+        return front * _betacf(a, b, x) / a
+    return 1.0 - front * _betacf(b, a, 1.0 - x) / b
+
+
+def gammaincc(a: float, x: float) -> float:
+    """Regularized upper incomplete gamma function Q(a, x)."""
+    if x <= 0.0:
+        return 1.0
+    log_front = -x + a * math.log(x) - math.lgamma(a)
+    if x < a + 1.0:
+        # Series for P(a, x)
+        term = total = 1.0 / a
+        n = a
+        while abs(term) > abs(total) * 1e-16:
+            n += 1.0
+            term *= x / n
+            total += term
+        return 1.0 - total * math.exp(log_front)
+    # Continued fraction for Q(a, x)
+    tiny = 1e-300
+    b = x + 1.0 - a
+    c, d = 1.0 / tiny, 1.0 / b
+    h = d
+    for i in range(1, 10000):
+        an = -i * (i - a)
+        b += 2.0
+        d = an * d + b
+        d = 1.0 / (d if abs(d) > tiny else tiny)
+        c = b + an / c
+        c = c if abs(c) > tiny else tiny
+        h *= d * c
+        if abs(d * c - 1.0) < 1e-15:
+            break
+    return math.exp(log_front) * h
+
+
+def f_sf(f: float, dfn: float, dfd: float) -> float:
+    """P(F > f) for an F(dfn, dfd) distribution."""
+    if not f > 0.0:
+        return 1.0
+    return betainc(dfd / 2.0, dfn / 2.0, dfd / (dfd + dfn * f))
+
+
+def chi2_sf(x: float, df: float) -> float:
+    """P(X > x) for a chi-squared distribution with df degrees of freedom."""
+    return gammaincc(df / 2.0, x / 2.0)
+
+
+@dataclass
+class TestResult:
+    statistic: float
+    p_value: float
+
+
+def anova(groups: list[np.ndarray]) -> TestResult:
+    """One-way ANOVA F test across groups."""
+    groups = [np.asarray(group, dtype=np.float64) for group in groups]
+    sizes = np.array([len(group) for group in groups], dtype=np.float64)
+    means = np.array([group.mean() for group in groups])
+    grand_mean = np.concatenate(groups).mean()
+    between = float((sizes * (means - grand_mean) ** 2).sum())
+    within = float(sum(((group - mean) ** 2).sum() for group, mean in zip(groups, means)))
+    dfn, dfd = len(groups) - 1, sizes.sum() - len(groups)
+    if within == 0.0:
+        return TestResult(math.inf if between > 0 else math.nan, 0.0 if between > 0 else math.nan)
+    f = (between / dfn) / (within / dfd)
+    return TestResult(f, f_sf(f, dfn, dfd))
+
+
+def rankdata(values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Average ranks (1-based) of values, and the sizes of their tie groups."""
+    values = np.asarray(values)
+    order = np.argsort(values, kind="mergesort")
+    ordered = values[order]
+    starts = np.flatnonzero(np.r_[True, ordered[1:] != ordered[:-1]])
+    bounds = np.r_[starts, len(values)]
+    ties = np.diff(bounds)
+    average = (bounds[:-1] + 1 + bounds[1:]) / 2.0
+    ranks = np.empty(len(values), dtype=np.float64)
+    ranks[order] = np.repeat(average, ties)
+    return ranks, ties
+
+
+def kruskal(groups: list[np.ndarray]) -> TestResult:
+    """Kruskal-Wallis H test across groups, with the tie correction."""
+    sizes = np.array([len(group) for group in groups])
+    ranks, ties = rankdata(np.concatenate([np.asarray(group, dtype=np.float64) for group in groups]))
+    n = len(ranks)
+    rank_sums = np.add.reduceat(ranks, np.r_[0, np.cumsum(sizes)[:-1]])
+    h = 12.0 / (n * (n + 1)) * float((rank_sums**2 / sizes).sum()) - 3.0 * (n + 1)
+    correction = 1.0 - float((ties.astype(np.float64) ** 3 - ties).sum()) / (n**3 - n)
+    if correction == 0.0:
+        return TestResult(math.nan, math.nan)
+    h /= correction
+    return TestResult(h, chi2_sf(h, len(groups) - 1))
+
+
+def _chunks(n_resamples: int, n: int):
+    size = max(1, MAX_CHUNK_ELEMENTS // max(n, 1))
+    for start in range(0, n_resamples, size):
+        yield min(size, n_resamples - start)
+
+
+def bootstrap_means(values: np.ndarray, n_resamples: int = DEFAULT_RESAMPLES, rng=None) -> np.ndarray:
+    """Means of `n_resamples` bootstrap resamples of `values`."""
+    rng = np.random.default_rng(rng)
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    unique, counts = np.unique(values, return_counts=True)
+    if len(unique) <= MAX_COUNT_SUPPORT:
+        # A resample is fully described by how often it draws each distinct value
+        return rng.multinomial(n, counts / n, size=n_resamples) @ unique / n
+    means = [
+        values[rng.integers(0, n, size=(size, n), dtype=np.int32)].mean(axis=1) for size in _chunks(n_resamples, n)
+    ]
+    return np.concatenate(means)
+
+
+def bootstrap_ci(
+    values: np.ndarray, n_resamples: int = DEFAULT_RESAMPLES, confidence: float = 0.95, rng=None
+) -> tuple[float, float]:
+    """Percentile bootstrap confidence interval of the mean of `values`."""
+    means = bootstrap_means(values, n_resamples, rng)
+    alpha = (1.0 - confidence) / 2.0
+    low, high = np.quantile(means, [alpha, 1.0 - alpha])
+    return float(low), float(high)
+
+
+def paired_permutation(
+    a: np.ndarray, b: np.ndarray, n_resamples: int = DEFAULT_RESAMPLES, rng=None
+) -> TestResult:
+    """Two-sided paired sign-flip permutation test of mean(a - b) == 0.
+
+    The statistic is the mean paired difference; the p-value counts the
+    observed statistic as one of the permutations.
+    """
+    rng = np.random.default_rng(rng)
+    differences = np.asarray(a, dtype=np.float64) - np.asarray(b, dtype=np.float64)
+    n = len(differences)
+    observed = differences.mean()
+    # Pairs with no difference are unchanged by a sign flip
+    differences = differences[differences != 0]
+    if len(differences) == 0:
+        return TestResult(0.0, 1.0)
+
+    if np.all(np.abs(differences) == np.abs(differences[0])):
+        # Equal magnitudes (e.g. 0/1 correctness): the flipped sum is a scaled Binomial
+        m = len(differences)
+        flipped = [(2.0 * rng.binomial(m, 0.5, size=n_resamples) - m) * abs(differences[0]) / n]
+    else:
+        # With random bits B, the flipped sum is sum(d) - 2 B @ d (one matrix product per chunk)
+        m = len(differences)
+        flipped = []
+        for size in _chunks(n_resamples, m):
+            bits = np.unpackbits(rng.integers(0, 256, (size, (m + 7) // 8), dtype=np.uint8), axis=1, count=m)
+            flipped.append((differences.sum() - 2.0 * (bits.astype(np.float64) @ differences)) / n)
+    flipped = np.concatenate(flipped)
+    extreme = int((np.abs(flipped) >= abs(observed) - 1e-12).sum())
+    return TestResult(float(observed), (extreme + 1) / (n_resamples + 1))
+
+
+def _finite(value: float) -> float | None:
+    # NaN and infinite statistics (e.g. constant groups) are reported as null
+    return value if math.isfinite(value) else None
+
+
+def align(baseline: dict, other: dict) -> tuple[np.ndarray, np.ndarray]:
+    """Values of the examples scored in both {key: value} mappings, in key order."""
+    keys = sorted(baseline.keys() & other.keys(), key=str)
+    return (
+        np.fromiter((baseline[key] for key in keys), dtype=np.float64, count=len(keys)),
+        np.fromiter((other[key] for key in keys), dtype=np.float64, count=len(keys)),
+    )
+
+
+def compare_personas(
+    scores: dict[str, dict],
+    baseline: str | None = None,
+    n_resamples: int = DEFAULT_RESAMPLES,
+    confidence: float = 0.95,
+    seed: int = 0,
+) -> dict:
+    """Omnibus and pairwise tests for {persona: {example key: score}} of one metric.
+
+    Returns per-persona means and bootstrap intervals, ANOVA and Kruskal-Wallis
+    across all personas, and, when `baseline` is given, each persona's paired
+    difference from the baseline with its permutation p-value and bootstrap
+    interval.
+    """
+    rng = np.random.default_rng(seed)
+    arrays = {
+        persona: np.fromiter(values.values(), dtype=np.float64, count=len(values))
+        for persona, values in sorted(scores.items())
+    }
+    report = {"personas": {}}
+    for persona, values in arrays.items():
+        low, high = bootstrap_ci(values, n_resamples, confidence, rng)
+        report["personas"][persona] = {"n": len(values), "mean": float(values.mean()), "ci": [low, high]}
+
+    if len(arrays) > 1:
+        groups = list(arrays.values())
+        for name, test in (("anova", anova), ("kruskal", kruskal)):
+            result = test(groups)
+            report[name] = {"statistic": _finite(result.statistic), "p_value": _finite(result.p_value)}
+
+    if baseline is not None and baseline in scores:
+        for persona, values in sorted(scores.items()):
+            if persona == baseline:
+                continue
+            base, other = align(scores[baseline], values)
+            result = paired_permutation(other, base, n_resamples, rng)
+            low, high = bootstrap_ci(other - base, n_resamples, confidence, rng)
+            report["personas"][persona]["vs_baseline"] = {
+                "n_paired": len(base),
+                "difference": result.statistic,
+                "p_value": result.p_value,
+                "ci": [low, high],
+            }
+    return report
+
+
+def format_report(metric: str, report: dict) -> str:
+    lines = [metric]
+    for name in ("anova", "kruskal"):
+        if name in report and report[name]["p_value"] is not None:
+            lines.append(f"  {name}: statistic {report[name]['statistic']:.4f}, p = {report[name]['p_value']:.4g}")
+    for persona, row in report["personas"].items():
+        line = f"  {persona:24} n={row['n']:<7} mean {row['mean']:.4f} [{row['ci'][0]:.4f}, {row['ci'][1]:.4f}]"
+        if "vs_baseline" in row:
+            diff = row["vs_baseline"]
+            line += f"  diff {diff['difference']:+.4f} [{diff['ci'][0]:+.4f}, {diff['ci'][1]:+.4f}] p = {diff['p_value']:.4g}"
+        lines.append(line)
+    return "\n".join(lines)
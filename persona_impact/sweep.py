@@ -0,0 +1,373 @@
+"""Multi-model sweeps: every model x input folder x sampling profile of a plan.
+
+A plan is a JSON file:
+
+    {
+        "backend": "vllm",
+        "models": ["yunconglong/Truthful_DPO_TomGrc_FusionNet_7Bx2_MoE_13B", "google/gemma-7b-it"],
+        "input_folders": ["prompts/hellaswag_v1", "prompts/cnn_dm_v1"],
+        "profiles": ["auto"],
+        "output_dir": "sweep"
+    }
+
+plus, optionally, the generation options of `persona-impact infer`
+(`profile_config`, `global_batch`, `max_batch_prompts`, `pipelined`,
+`max_in_flight`, `chunk_size`, `duplicates`, `output_compression`, `cache`, `cache_dir`, `cache_size_gb`, `metrics`,
+`prometheus_file`, `prefix_caching`, `prefix_grouped`, `score_choices`, `replicas`, `length_bucketed`,
+`max_batch_tokens`, `max_prompt_tokens`, `prompt_overflow`, `pretokenized`) and
+`backend_options` passed to the backend (engine arguments, or the fake
+backend's seed and latencies).
+
+Jobs are run model by model: each model is loaded once, generates all of its
+folders and profiles, and is closed before the next one is loaded. Outputs go
+to `<output_dir>/<model>/<profile>/<folder>-output` and the status of every job
+is recorded in `<output_dir>/sweep_status.json`, so running the same plan again
+skips finished jobs and resumes interrupted ones from their checkpoints.
+"""
+
+import argparse
+import os
+import sys
+import time
+import traceback
+from dataclasses import dataclass, field
+
+import ujson as json
+
+from persona_impact.async_pipeline import process_folders_pipelined
+from persona_impact.data_parallel import load_data_parallel
+from persona_impact.generation_cache import DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES, CachedBackend, GenerationCache
+from persona_impact.metrics import MetricsRecorder, merge_prometheus, recorded_model
+from persona_impact.pipeline import process_folder, process_folders_batched
+from persona_impact.profiles import DecodeStats, ProfileSet
+from persona_impact.scheduler import LengthScheduler
+
+STATUS_FILE = "sweep_status.json"
+
+
+@dataclass
+class SweepPlan:
+    models: list[str]
+    input_folders: list[str]
+    backend: str = "vllm"
+    profiles: list[str] = field(default_factory=lambda: ["auto"])
+    profile_config: str | None = None
+    output_dir: str = "sweep"
+    global_batch: bool = False
+    max_batch_prompts: int | None = None
+    pipelined: bool = False
+    max_in_flight: int = 256
+    chunk_size: int | None = None
+    duplicates: str = "keep"
+    prefix_caching: bool = False
+    prefix_grouped: bool = False
+    score_choices: int | None = None
+    output_compression: str | None = None
+    cache: bool = True
+    cache_dir: str = DEFAULT_CACHE_DIR
+    cache_size_gb: float = DEFAULT_MAX_BYTES / 1024**3
+    metrics: bool = True
+    prometheus_file: str | None = None
+    replicas: int = 1
+    length_bucketed: bool = False
+    max_batch_tokens: int | None = None
+    max_prompt_tokens: int | None = None
+    prompt_overflow: str = "truncate"
+    pretokenized: bool = False
+    backend_options: dict = field(default_factory=dict)
+    # Written by `persona-impact plan`; not used to run the sweep
+    estimate: dict | None = None
+
+    def __post_init__(self):
+        # The same combinations `persona-impact infer` rejects; the runners would silently ignore them
+        scheduled = self.length_bucketed or self.max_batch_tokens or self.max_prompt_tokens
+        if self.pipelined and (
+            self.global_batch or self.prefix_grouped or self.score_choices or scheduled or self.pretokenized
+        ):
+            raise ValueError(
+                "pipelined cannot be combined with global_batch, prefix_grouped, score_choices, "
+                "length-bucketed batching or pretokenized"
+            )
+        if self.score_choices and scheduled:
+            raise ValueError("score_choices cannot be combined with length-bucketed batching")
+        if self.score_choices and self.pretokenized:
+            raise ValueError("score_choices cannot be combined with pretokenized")
+        if self.chunk_size is not None and (self.global_batch or self.pipelined):
+            raise ValueError("chunk_size cannot be combined with global_batch or pipelined")
+        if self.max_batch_prompts is not None and not self.global_batch:
+            raise ValueError("max_batch_prompts requires global_batch")
+        # Outputs are named after the input folder's basename, and resuming would mix up folders sharing one
+        by_name = {}
+        for input_folder in self.input_folders:
+            by_name.setdefault(os.path.basename(input_folder.rstrip("/")), set()).add(os.path.normpath(input_folder))
+        shared = sorted(name for name, folders in by_name.items() if len(folders) > 1)
+        if shared:
+            raise ValueError(f"input folders must have distinct names, several are named {', '.join(shared)}")
+
+    @classmethod
+    def from_file(cls, path: str) -> "SweepPlan":
+        with open(path, "r") as file:
+            return cls(**json.load(file))
+
+    @property
+    def choices(self) -> list[str] | None:
+        return [str(i) for i in range(self.score_choices)] if self.score_choices else None
+
+    def scheduler(self) -> LengthScheduler | None:
+        if not (self.length_bucketed or self.max_batch_tokens or self.max_prompt_tokens):
+            return None
+        return LengthScheduler(self.max_batch_tokens, self.max_prompt_tokens, self.prompt_overflow)
+
+    def tokenizer_name(self, model: str) -> str | None:
+        """The tokenizer whose token files the jobs of `model` use, or None without `pretokenized`."""
+        if not self.pretokenized:
+            return None
+        return "fake" if self.backend == "fake" else model
+
+
+@dataclass(frozen=True)
+class SweepJob:
+    model: str
+    profile: str
+    input_folder: str
+
+    @property
+    def key(self) -> str:
+        return f"{self.model}|{self.profile}|{self.input_folder}"
+
+    def output_root(self, plan: SweepPlan) -> str:
+        return os.path.join(plan.output_dir, self.model.replace("/", "__"), self.profile)
+
+
+def plan_jobs(plan: SweepPlan, profiles: ProfileSet) -> list[SweepJob]:
+    """Expand a plan into jobs, grouped by model in plan order."""
+    jobs = []
+    for model in plan.models:
+        for profile in plan.profiles:
+            for input_folder in plan.input_folders:
+                name = profiles.profile_name(input_folder) if profile == "auto" else profile
+                profiles[name]  # Fail on unknown profiles before loading any model
+                job = SweepJob(model, name, input_folder)
+                if job not in jobs:
+                    jobs.append(job)
+    return jobs
+
+
+class SweepStatus:
+    """Per-job status of a sweep, saved atomically after every change."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.jobs = {}
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                self.jobs = json.load(file)
+
+    def state(self, job: SweepJob) -> str:
+        return self.jobs.get(job.key, {}).get("status", "pending")
+
+    def mark(self, job: SweepJob, status: str, **info):
+        self.jobs[job.key] = {
+            "model": job.model,
+            "profile": job.profile,
+            "input_folder": job.input_folder,
+            "status": status,
+            "updated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            **info,
+        }
+        self.save()
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.jobs, file, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def backend_name(plan: SweepPlan) -> str:
+    # The pipelined runner submits requests one by one to vLLM's async engine;
+    # replicas batch the requests queued for them with the sync engine
+    return "vllm-async" if plan.pipelined and plan.backend == "vllm" and plan.replicas == 1 else plan.backend
+
+
+def backend_options(plan: SweepPlan) -> dict:
+    options = dict(plan.backend_options)
+    # Scoring submits every choice with the same prompt; caching prefills it once
+    if plan.prefix_caching or plan.score_choices:
+        options["enable_prefix_caching"] = True
+    return options
+
+
+def _run_jobs(
+    backend,
+    plan: SweepPlan,
+    profiles: ProfileSet,
+    jobs: list[SweepJob],
+    status: SweepStatus,
+    decode_stats,
+    metrics,
+    scheduler,
+):
+    """Run the pending jobs of one loaded model, grouped by profile."""
+    by_profile = {}
+    for job in jobs:
+        by_profile.setdefault(job.profile, []).append(job)
+
+    for profile, profile_jobs in by_profile.items():
+        sampling = profiles[profile]
+        # With global batching or pipelining all folders of a profile share one job run
+        shared = plan.global_batch or plan.pipelined
+        groups = [profile_jobs] if shared else [[job] for job in profile_jobs]
+        for group in groups:
+            for job in group:
+                status.mark(job, "running")
+            start = time.perf_counter()
+            try:
+                if plan.pipelined:
+                    process_folders_pipelined(
+                        backend,
+                        sampling,
+                        [job.input_folder for job in group],
+                        plan.max_in_flight,
+                        duplicates=plan.duplicates,
+                        decode_stats=decode_stats,
+                        output_root=group[0].output_root(plan),
+                        metrics=metrics,
+                        output_compression=plan.output_compression,
+                    )
+                elif plan.global_batch:
+                    process_folders_batched(
+                        backend,
+                        sampling,
+                        [job.input_folder for job in group],
+                        plan.max_batch_prompts,
+                        prefix_grouped=plan.prefix_grouped,
+                        duplicates=plan.duplicates,
+                        choices=plan.choices,
+                        decode_stats=decode_stats,
+                        output_root=group[0].output_root(plan),
+                        metrics=metrics,
+                        output_compression=plan.output_compression,
+                        scheduler=scheduler,
+                        pretokenized=plan.tokenizer_name(group[0].model),
+                    )
+                else:
+                    process_folder(
+                        backend,
+                        sampling,
+                        group[0].input_folder,
+                        prefix_grouped=plan.prefix_grouped,
+                        chunk_size=plan.chunk_size,
+                        duplicates=plan.duplicates,
+                        choices=plan.choices,
+                        decode_stats=decode_stats,
+                        output_root=group[0].output_root(plan),
+                        metrics=metrics,
+                        output_compression=plan.output_compression,
+                        scheduler=scheduler,
+                        pretokenized=plan.tokenizer_name(group[0].model),
+                    )
+            except Exception as error:
+                traceback.print_exc()
+                for job in group:
+                    status.mark(job, "failed", error=repr(error))
+                continue
+            seconds = time.perf_counter() - start
+            for job in group:
+                status.mark(job, "done", seconds=round(seconds, 2))
+
+
+def run_sweep(plan: SweepPlan) -> SweepStatus:
+    profiles = ProfileSet(plan.profile_config)
+    jobs = plan_jobs(plan, profiles)
+    status = SweepStatus(os.path.join(plan.output_dir, STATUS_FILE))
+    prometheus = []
+    # Scoring decodes nothing, so there is nothing to cache
+    cache = None
+    if plan.cache and not plan.choices:
+        cache = GenerationCache(plan.cache_dir, int(plan.cache_size_gb * 1024**3))
+
+    for model in plan.models:
+        pending = [job for job in jobs if job.model == model and status.state(job) != "done"]
+        if not pending:
+            print(f"{model}: all jobs done, not loading the model")
+            continue
+
+        print(f"{model}: {len(pending)} pending jobs")
+        try:
+            backend = load_data_parallel(backend_name(plan), plan.replicas, model=model, **backend_options(plan))
+            if cache is not None:
+                backend = CachedBackend(backend, cache)
+        except Exception as error:
+            traceback.print_exc()
+            for job in pending:
+                status.mark(job, "failed", error=repr(error))
+            continue
+
+        decode_stats = DecodeStats()
+        metrics = MetricsRecorder(recorded_model(plan.backend, model), backend.name) if plan.metrics else None
+        scheduler = plan.scheduler()
+        try:
+            _run_jobs(backend, plan, profiles, pending, status, decode_stats, metrics, scheduler)
+        finally:
+            backend.close()
+        if scheduler is not None and scheduler.stats.n_prompts:
+            print(f"{model} length scheduling: {scheduler.stats.summary()}")
+        if decode_stats.n_prompts:
+            print(f"{model} decoding: {decode_stats.summary()}")
+        if metrics is not None and metrics.files:
+            metrics.close()
+            prometheus.append(metrics)
+
+    if cache is not None:
+        print(f"Generation cache: {cache.summary()}")
+        cache.close()
+
+    if plan.prometheus_file is not None and prometheus:
+        tmp_path = plan.prometheus_file + ".tmp"
+        with open(tmp_path, "w") as file:
+            file.write(merge_prometheus(prometheus))
+        os.replace(tmp_path, plan.prometheus_file)
+
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run every model x input folder x sampling profile of a sweep plan, "
+        "loading each model once and resuming unfinished jobs."
+    )
+    parser.add_argument("plan", help="JSON sweep plan")
+    parser.add_argument(
+        "--status",
+        action="store_true",
+        help="Only print the status of every job of the plan",
+    )
+    args = parser.parse_args()
+
+    try:
+        plan = SweepPlan.from_file(args.plan)
+    except ValueError as error:
+        parser.error(f"{args.plan}: {error}")
+    jobs = plan_jobs(plan, ProfileSet(plan.profile_config))
+    if args.status:
+        status = SweepStatus(os.path.join(plan.output_dir, STATUS_FILE))
+    else:
+        status = run_sweep(plan)
+
+    counts = {}
+    for job in jobs:
+        state = status.state(job)
+        counts[state] = counts.get(state, 0) + 1
+        if args.status or state != "done":
+            print(f"{state:8} {job.model} {job.profile} {job.input_folder}")
+    print(", ".join(f"{n} {state}" for state, n in sorted(counts.items())))
+    if counts.get("failed"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import os
+
+import pytest
+import ujson as json
+
+from persona_impact.jsonl_io import jsonl_files, open_jsonl
+
+
+def write_prompt_file(path: str, prompts: list[str], key: str = "ind"):
+    with open_jsonl(path, "w") as file:
+        for n, prompt in enumerate(prompts):
+            file.write(json.dumps({key: n, "llm_instruction": prompt}) + "\n")
+
+
+def read_rows(path: str) -> list[dict]:
+    with open_jsonl(path, "r") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def outputs(output_folder: str) -> dict:
+    """Rows of every output file of `output_folder`, by file name."""
+    return {os.path.basename(path): read_rows(path) for path in sorted(jsonl_files(output_folder))}
+
+
+@pytest.fixture
+def prompt_folder(tmp_path):
+    """Make `<tmp_path>/<name>` with one prompt file per persona, each rendering the same contexts."""
+
+    def make(name: str = "hellaswag_v1", personas=("Human", "Teacher"), n_prompts: int = 7) -> str:
+        folder = tmp_path / name
+        os.makedirs(folder)
+        for persona in personas:
+            prompts = [
+                f"### Persona:\nYou are a {persona}.\n### Input:\nContext {n} of {name}.\nEndings:\n0) a\n1) b\n"
+                for n in range(n_prompts)
+            ]
+            write_prompt_file(str(folder / f"{persona}_v1.jsonl"), prompts)
+        return str(folder)
+
+    return make
@@ -0,0 +1,42 @@
+import pytest
+from conftest import outputs
+
+from persona_impact.backends import FakeBackend, SamplingConfig
+from persona_impact.data_parallel import DataParallelBackend, replica_devices
+from persona_impact.pipeline import output_folder_for, process_folder
+
+SAMPLING = SamplingConfig(max_tokens=16)
+PROMPTS = [f"### Input:\nContext {n}.\n" * (1 + n % 3) for n in range(11)]
+
+
+@pytest.fixture(scope="module")
+def replicas():
+    # Spawned workers, as on a GPU node
+    backend = DataParallelBackend("fake", 3)
+    yield backend
+    backend.close()
+
+
+def test_replicas_return_completions_in_input_order(replicas):
+    single = FakeBackend()
+    assert [c.text for c in replicas.generate(PROMPTS, SAMPLING)] == [
+        c.text for c in single.generate(PROMPTS, SAMPLING)
+    ]
+    assert replicas.score_continuations(PROMPTS, ["0", "1"]) == single.score_continuations(PROMPTS, ["0", "1"])
+    assert replicas.count_tokens_batch(PROMPTS) == single.count_tokens_batch(PROMPTS)
+    assert replicas.count_tokens_batch([]) == []
+
+
+def test_replicas_write_the_outputs_of_one_backend(replicas, prompt_folder, tmp_path):
+    folder = prompt_folder()
+    process_folder(FakeBackend(), SAMPLING, folder, chunk_size=4, output_root=str(tmp_path / "single"))
+    process_folder(replicas, SAMPLING, folder, chunk_size=4, output_root=str(tmp_path / "replicas"))
+    assert outputs(output_folder_for(folder, str(tmp_path / "replicas"))) == outputs(
+        output_folder_for(folder, str(tmp_path / "single"))
+    )
+
+
+def test_replica_devices_are_disjoint_slices():
+    assert replica_devices(2, 2, ["0", "1", "2", "3"]) == ["0,1", "2,3"]
+    with pytest.raises(ValueError):
+        replica_devices(3, 2, ["0", "1", "2", "3"])
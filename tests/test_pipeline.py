@@ -0,0 +1,81 @@
+import os
+
+from conftest import outputs
+
+from persona_impact.backends import FakeBackend, SamplingConfig
+from persona_impact.checkpoint import partial_path
+from persona_impact.pipeline import output_folder_for, process_folder, process_folders_batched
+
+SAMPLING = SamplingConfig(max_tokens=16)
+
+
+class CountingBackend(FakeBackend):
+    """Counts the prompts it generates."""
+
+    n_generated = 0
+
+    def _generate(self, prompts, sampling, prompt_token_ids=None):
+        self.n_generated += len(prompts)
+        return super()._generate(prompts, sampling, prompt_token_ids)
+
+
+def test_fake_backend_is_deterministic():
+    prompts = [f"prompt {n}" for n in range(5)]
+    first = FakeBackend(seed=1).generate(prompts, SAMPLING)
+    assert [c.text for c in first] == [c.text for c in FakeBackend(seed=1).generate(prompts, SAMPLING)]
+    assert [c.text for c in first] == [FakeBackend(seed=1).complete(prompt, SAMPLING).text for prompt in prompts]
+    assert [c.text for c in first] != [c.text for c in FakeBackend(seed=2).generate(prompts, SAMPLING)]
+
+
+def test_process_folder_answers_every_row(prompt_folder, tmp_path):
+    folder = prompt_folder()
+    backend = FakeBackend()
+    process_folder(backend, SAMPLING, folder, chunk_size=3, output_root=str(tmp_path / "out"))
+
+    written = outputs(output_folder_for(folder, str(tmp_path / "out")))
+    assert sorted(written) == ["Human_v1.jsonl", "Teacher_v1.jsonl"]
+    for name, rows in written.items():
+        assert [row["ind"] for row in rows] == list(range(7))
+        for row in rows:
+            assert row["llm_response"] == backend.complete(row["llm_instruction"], SAMPLING).text
+
+
+def test_resume_after_a_torn_checkpoint(prompt_folder, tmp_path):
+    folder = prompt_folder()
+    process_folder(FakeBackend(), SAMPLING, folder, chunk_size=2, output_root=str(tmp_path / "full"))
+    expected = outputs(output_folder_for(folder, str(tmp_path / "full")))
+
+    # A run that crashed while appending the fourth row of Human_v1.jsonl
+    output_folder = output_folder_for(folder, str(tmp_path / "resumed"))
+    os.makedirs(output_folder)
+    output_file = os.path.join(output_folder, "Human_v1.jsonl")
+    with open(os.path.join(output_folder_for(folder, str(tmp_path / "full")), "Human_v1.jsonl"), "rb") as file:
+        lines = file.readlines()
+    with open(partial_path(output_file), "wb") as file:
+        file.writelines(lines[:3])
+        file.write(lines[3][:20])
+
+    backend = CountingBackend()
+    process_folder(backend, SAMPLING, folder, chunk_size=2, output_root=str(tmp_path / "resumed"))
+
+    # Only the torn row and those after it are generated again
+    assert backend.n_generated == 2 * 7 - 3
+    assert not os.path.exists(partial_path(output_file))
+    assert outputs(output_folder) == expected
+
+
+def test_global_batches_are_routed_back_to_their_files(prompt_folder, tmp_path):
+    folders = [prompt_folder("hellaswag_v1", n_prompts=5), prompt_folder("cnn_dm_v1", ("Writer",), n_prompts=4)]
+    for folder in folders:
+        process_folder(FakeBackend(), SAMPLING, folder, output_root=str(tmp_path / "per_file"))
+
+    # Batches of 3 prompts straddle files and folders
+    process_folders_batched(
+        FakeBackend(), SAMPLING, folders, max_batch_prompts=3, output_root=str(tmp_path / "batched")
+    )
+
+    for folder in folders:
+        batched = outputs(output_folder_for(folder, str(tmp_path / "batched")))
+        assert batched == outputs(output_folder_for(folder, str(tmp_path / "per_file")))
+        for name, rows in batched.items():
+            assert all(name.split("_")[0] in row["llm_instruction"] for row in rows)
@@ -0,0 +1,77 @@
+import os
+
+from conftest import outputs, write_prompt_file
+
+from persona_impact.backends import FakeBackend, FakeTokenizer, SamplingConfig
+from persona_impact.pipeline import filenames_in_a_folder, output_folder_for, process_folder, process_folders_batched
+from persona_impact.pretokenize import PretokenizeStats, SegmentTokenizer, load_token_ids, pretokenize_file
+from persona_impact.reader import IndexedJsonl
+
+SAMPLING = SamplingConfig(max_tokens=16)
+
+
+class RecordingBackend(FakeBackend):
+    """Keeps the token ids it was given per prompt."""
+
+    def __init__(self):
+        super().__init__()
+        self.received = {}
+
+    def _generate(self, prompts, sampling, prompt_token_ids=None):
+        for prompt, token_ids in zip(prompts, prompt_token_ids or [None] * len(prompts)):
+            self.received[prompt] = token_ids
+        return super()._generate(prompts, sampling, prompt_token_ids)
+
+
+def pretokenize_folder(folder: str) -> PretokenizeStats:
+    tokenizer, stats = SegmentTokenizer(FakeTokenizer()), PretokenizeStats()
+    for file in sorted(filenames_in_a_folder(folder)):
+        pretokenize_file(file, tokenizer, "fake", verify_every=1, stats=stats)
+    return stats
+
+
+def test_token_files_hold_the_full_string_token_ids(prompt_folder):
+    folder = prompt_folder()
+    write_prompt_file(os.path.join(folder, "Writer_v1.jsonl.gz"), ["### Persona:\nYou are a Writer.\n  indented\n"])
+    stats = pretokenize_folder(folder)
+    assert stats.n_files == 3 and stats.n_prompts == 15 and stats.mismatched == 0
+
+    tokenizer = FakeTokenizer()
+    for file in filenames_in_a_folder(folder):
+        token_ids = load_token_ids(file, "fake")
+        with IndexedJsonl(file) as reader:
+            for i in range(len(reader)):
+                assert token_ids.get(reader.offsets[i]) == tokenizer.encode(reader.prompt(reader.entry(i)))
+
+
+def test_pretokenized_generation_matches_plain_prompts(prompt_folder, tmp_path):
+    folder = prompt_folder()
+    pretokenize_folder(folder)
+    process_folder(FakeBackend(), SAMPLING, folder, output_root=str(tmp_path / "plain"))
+    expected = outputs(output_folder_for(folder, str(tmp_path / "plain")))
+
+    for name, run in (("chunked", process_folder), ("batched", process_folders_batched)):
+        backend = RecordingBackend()
+        root = str(tmp_path / name)
+        if run is process_folder:
+            run(backend, SAMPLING, folder, chunk_size=3, output_root=root, pretokenized="fake")
+        else:
+            run(backend, SAMPLING, [folder], max_batch_prompts=5, output_root=root, pretokenized="fake")
+        assert outputs(output_folder_for(folder, root)) == expected
+        assert len(backend.received) == 14
+        assert all(token_ids == FakeTokenizer().encode(prompt) for prompt, token_ids in backend.received.items())
+
+
+def test_token_files_of_changed_prompt_files_are_ignored(prompt_folder, tmp_path):
+    folder = prompt_folder(personas=("Human",))
+    pretokenize_folder(folder)
+    file = os.path.join(folder, "Human_v1.jsonl")
+    assert load_token_ids(file, "fake") is not None
+    assert load_token_ids(file, "another-tokenizer") is None
+
+    write_prompt_file(file, ["### Persona:\nYou are a Human.\nA new context.\n"])
+    assert load_token_ids(file, "fake") is None
+
+    backend = RecordingBackend()
+    process_folder(backend, SAMPLING, folder, output_root=str(tmp_path / "out"), pretokenized="fake")
+    assert list(backend.received.values()) == [None]
@@ -0,0 +1,40 @@
+from persona_impact.cli import _task_module
+from persona_impact.prompt_store import expand, make_header
+
+HELLASWAG_EXAMPLE = {
+    "ind": 4,
+    "activity_label": "Removing ice from car",
+    "label": 3,
+    "split_type": "indomain",
+    "ctx": "Then, the man writes over the snow covering the window of a car.",
+    "endings": [
+        ", the man adds wax to the windshield.",
+        ", a person board a ski lift.",
+        ", the man puts on a christmas coat.",
+        ", the man continues removing the snow on his car.",
+    ],
+}
+ARTICLE = " ".join(f"word{i}" for i in range(400))
+ABSTRACT = " ".join(f"summary{i}" for i in range(150))
+
+
+def test_hellaswag_compact_row_expands_to_the_plain_row():
+    creator = _task_module("hellaswag", "hellaswag_prompt_creator")
+    for persona, _ in creator.PERSONAS[:3]:
+        examples = "## Examples:\nContext: a\nEndings:\n0) b\nAnswer: 0"
+        header = make_header("hellaswag", creator.TEMPLATE, creator.get_persona(persona), examples)["__prompt_store__"]
+        compact = creator.generate_compact_row(HELLASWAG_EXAMPLE)
+        assert expand(header, compact) == creator.generate_instruction(HELLASWAG_EXAMPLE, persona, examples)
+
+
+def test_cnn_dm_compact_row_expands_to_the_plain_row():
+    creator = _task_module("cnn_dm", "cnn_dm_prompt_creator")
+    for persona, _ in creator.PERSONAS[:3]:
+        examples = creator.get_example_template([("An article.", "A summary.")])
+        header = make_header("cnn_dm", creator.TEMPLATE, creator.get_persona(persona), examples)["__prompt_store__"]
+        compact = creator.generate_compact_row("stories/abc.story", ARTICLE, ABSTRACT)
+        plain = creator.generate_instruction("stories/abc.story", ARTICLE, ABSTRACT, persona, examples)
+        assert expand(header, compact) == plain
+        # The prompt renders the whole article, the row keeps its first 250 words
+        assert ARTICLE in plain["llm_instruction"]
+        assert len(plain["article"].split(" ")) == 250
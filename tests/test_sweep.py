@@ -0,0 +1,80 @@
+import os
+
+import pytest
+from conftest import outputs
+
+from persona_impact import sweep
+from persona_impact.checkpoint import partial_path
+from persona_impact.sweep import STATUS_FILE, SweepPlan, SweepStatus, run_sweep
+
+
+def make_plan(tmp_path, input_folders, **options) -> SweepPlan:
+    return SweepPlan(
+        models=["fake-a", "fake-b"],
+        input_folders=input_folders,
+        backend="fake",
+        profiles=["default"],
+        output_dir=str(tmp_path / "sweep"),
+        cache=False,
+        metrics=False,
+        **options,
+    )
+
+
+def sweep_outputs(plan: SweepPlan) -> dict:
+    return {
+        (model, os.path.basename(folder)): outputs(
+            os.path.join(plan.output_dir, model, "default", f"{os.path.basename(folder)}-output")
+        )
+        for model in plan.models
+        for folder in plan.input_folders
+    }
+
+
+def test_sweep_runs_every_job_and_resumes(prompt_folder, tmp_path, monkeypatch):
+    plan = make_plan(tmp_path, [prompt_folder("hellaswag_v1"), prompt_folder("cnn_dm_v1", ("Writer",))], chunk_size=2)
+    status = run_sweep(plan)
+    assert {job["status"] for job in status.jobs.values()} == {"done"}
+    expected = sweep_outputs(plan)
+    # Models differ, so their outputs do
+    assert expected["fake-a", "hellaswag_v1"] != expected["fake-b", "hellaswag_v1"]
+
+    # fake-b crashed while appending the second row of one of its files
+    job_key = f"fake-b|default|{plan.input_folders[0]}"
+    status.jobs[job_key]["status"] = "running"
+    status.save()
+    output_file = os.path.join(plan.output_dir, "fake-b", "default", "hellaswag_v1-output", "Human_v1.jsonl")
+    with open(output_file, "rb") as file:
+        lines = file.readlines()
+    os.remove(output_file)
+    with open(partial_path(output_file), "wb") as file:
+        file.writelines(lines[:1])
+        file.write(lines[1][:10])
+
+    loaded = []
+    load_data_parallel = sweep.load_data_parallel
+
+    def load(name, replicas, model=None, **options):
+        loaded.append(model)
+        return load_data_parallel(name, replicas, model=model, **options)
+
+    monkeypatch.setattr(sweep, "load_data_parallel", load)
+    status = run_sweep(plan)
+
+    # Only the model with an unfinished job is loaded again
+    assert loaded == ["fake-b"]
+    assert status.jobs[job_key]["status"] == "done"
+    assert SweepStatus(os.path.join(plan.output_dir, STATUS_FILE)).jobs == status.jobs
+    assert sweep_outputs(plan) == expected
+
+
+def test_sweep_plans_reject_options_the_runner_ignores(tmp_path):
+    with pytest.raises(ValueError):
+        make_plan(tmp_path, ["hellaswag_v1"], pipelined=True, global_batch=True)
+    with pytest.raises(ValueError):
+        make_plan(tmp_path, ["hellaswag_v1"], score_choices=4, length_bucketed=True)
+    with pytest.raises(ValueError):
+        make_plan(tmp_path, ["hellaswag_v1"], global_batch=True, chunk_size=8)
+    with pytest.raises(ValueError):
+        make_plan(tmp_path, ["a/hellaswag_v1", "b/hellaswag_v1/"])
+    make_plan(tmp_path, ["hellaswag_v1", "./hellaswag_v1/"])
@@ -1,38 +1,15 @@
-import torch
 import ujson as json
-from vllm import LLM, SamplingParams
 
-
-def prompt_extractor(file_name: str):
-    entries = []
-
-    # Read the .jsonl file line by line
-    with open(file_name, "r") as file:
-        for line in file:
-            # Parse the JSON line and append to the list
-            entry = json.loads(line.strip())
-            # Use 'ind' if it exists, otherwise fallback to 'filename'
-            entry_key = entry.get("ind", entry.get("filename"))
-            entry["sort_key"] = entry_key
-            entries.append(entry)
-
-    # Sort the list of dictionaries by the 'sort_key' field
-    sorted_entries = sorted(entries, key=lambda x: x["sort_key"])
-
-    # Create a dictionary with 'sort_key' values as keys
-    ordered_dict = {entry["sort_key"]: entry for entry in sorted_entries}
-
-    return ordered_dict
+from persona_impact.backends import BACKENDS, DEFAULT_MODEL, SamplingConfig, load_backend
+from persona_impact.jsonl_io import jsonl_files, open_jsonl
+from persona_impact.metrics import MetricsRecorder, recorded_model
+from persona_impact.pipeline import run_prompts
+from persona_impact.reader import DUPLICATE_POLICIES, IndexedJsonl
 
 
 def filenames_in_a_folder(folder_path: str):
-    import os
-
-    return [
-        os.path.join(folder_path, file)
-        for file in os.listdir(folder_path)
-        if file.endswith(".jsonl")
-    ]
+    # Plain, gzip and Zstandard JSONL files
+    return jsonl_files(folder_path)
 
 
 def main():
@@ -42,7 +19,30 @@ def main():
     parser = argparse.ArgumentParser(description="VLLM Inference")
     parser.add_argument("--input", type=str, help="Input folder path")
     parser.add_argument("--output", type=str, help="Output folder path")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="vllm")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help="Model name or path")
+    parser.add_argument(
+        "--duplicates",
+        choices=DUPLICATE_POLICIES,
+        default="keep",
+        help="How to handle rows sharing the same key",
+    )
+    parser.add_argument(
+        "--score-choices",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Instead of generating, score the answer labels 0..N-1 by log-likelihood",
+    )
+    parser.add_argument(
+        "--metrics",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Append per-file throughput and latency metrics to <output>-metrics.ndjson",
+    )
+    parser.add_argument("--prometheus-file", default=None, help="Also write metrics in Prometheus text format")
     args = parser.parse_args()
+    choices = [str(i) for i in range(args.score_choices)] if args.score_choices else None
 
     input_folder = args.input
     output_folder = args.output
@@ -51,19 +51,18 @@ def main():
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
-    # Get the list of .jsonl files in the input folder
+    # Get the list of .jsonl (.jsonl.gz, .jsonl.zst) files in the input folder
     input_files = filenames_in_a_folder(input_folder)
 
     print("Input files: ", input_files)
 
-    llm = LLM(
-        model="yunconglong/Truthful_DPO_TomGrc_FusionNet_7Bx2_MoE_13B",
-        tensor_parallel_size=torch.cuda.device_count(),
-    )
+    engine_kwargs = {"enable_prefix_caching": True} if choices else {}
+    backend = load_backend(args.backend, model=args.model, **engine_kwargs)
 
-    sampling_params = SamplingParams(
-        max_tokens=128, top_k=10, top_p=0.95, temperature=0.69
-    )
+    sampling = SamplingConfig(max_tokens=128, top_k=10, top_p=0.95, temperature=0.69)
+    metrics = None
+    if args.metrics or args.prometheus_file:
+        metrics = MetricsRecorder(recorded_model(args.backend, args.model), backend.name)
 
     # Iterate through the input files
     for file in input_files:
@@ -73,24 +72,30 @@ def main():
             print(f"Skipping {file} as the output file {output_file} already exists.")
             continue
 
-        # Extract the prompts from the .jsonl file
-        prompts = prompt_extractor(file)
+        file_metrics = metrics.file(file, output_folder) if metrics is not None else None
+
+        # Index the prompts of the .jsonl file by 'ind' (or 'filename')
+        with IndexedJsonl(file, ("ind", "filename"), args.duplicates) as prompts:
+            prompt_texts = [prompts.prompt(entry) for entry in prompts]
 
-        # Create a list of prompt_texts using the sorted keys from the prompts dictionary
-        sorted_keys = sorted(prompts.keys())
-        prompt_texts = [prompts[key]["llm_instruction"] for key in sorted_keys]
+            # Generate (or score) the continuation
+            completions = []
+            model_seconds = backend.generate_seconds
+            results = run_prompts(backend, prompt_texts, sampling, choices=choices, completions=completions)
 
-        # Generate the continuation
-        responses = llm.generate(prompt_texts, sampling_params)
+            # Write the prompts with their continuation, in sort key order
+            with open_jsonl(output_file, "w") as file:
+                for entry, result in zip(prompts, results):
+                    entry.update(result)
+                    file.write(json.dumps(entry) + "\n")
 
-        # Add the continuation to the prompt dictionary using the correct keys
-        for key, response in zip(sorted_keys, responses):
-            prompts[key]["llm_response"] = response.outputs[0].text
+            if file_metrics is not None:
+                file_metrics.record(len(prompt_texts), completions, backend.generate_seconds - model_seconds)
+                metrics.commit_file(file_metrics)
 
-        # Write the prompt dictionary to a .jsonl file
-        with open(output_file, "w") as file:
-            for key in sorted_keys:  # Ensure the ordering is consistent
-                file.write(json.dumps(prompts[key]) + "\n")
+    if metrics is not None and metrics.files:
+        metrics.close(args.prometheus_file)
 
 
-main()
+if __name__ == "__main__":
+    main()